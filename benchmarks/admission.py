@@ -0,0 +1,119 @@
+""" Read latency during a burst of large group PUTs, with admission control
+
+Usage: python benchmarks/admission.py [writers] [seconds]
+
+Writer threads replace a group of its most members, over and over while
+reader threads fetch a user, all through the whole WSGI app, first with no
+limits and then with writes capped. Writes shed by the cap are counted
+rather than timed, and their writer pauses before trying again.
+"""
+
+import json
+import StringIO
+import sys
+import threading
+import time
+from wsgiref import util as wsgi_util
+
+from restytest import models
+from restytest.api import admission
+from restytest.api import app
+from restytest.api import controller
+from restytest.api import metrics
+from restytest.storage import impl
+
+
+DEFAULT_WRITERS = 16
+DEFAULT_SECONDS = 5.0
+READERS = 4
+MEMBERS = 50
+SHED_PAUSE = 0.05
+SETTINGS = (
+    ('unlimited', {}),
+    ('writes<=2', {admission.WRITE: (2, 2, None)}),
+    ('writes<=2 50ms', {admission.WRITE: (2, 16, 0.05)}),
+)
+
+
+def _call(application, method, path, body=''):
+    environ = {}
+    wsgi_util.setup_testing_defaults(environ)
+    environ.update({
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path,
+        'CONTENT_TYPE': app.API_MIMETYPE,
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': StringIO.StringIO(body),
+    })
+    status = []
+    response = application(environ, lambda line, *args: status.append(line))
+    ''.join(response)
+    if hasattr(response, 'close'):
+        response.close()
+    return status[0]
+
+
+def _loop(stop, func, latencies):
+    while not stop.is_set():
+        start = time.time()
+        if func().startswith('2'):
+            latencies.append(time.time() - start)
+        else:
+            # Back off as a client honouring Retry-After would, only scaled
+            # down to fit a run of a few seconds.
+            time.sleep(SHED_PAUSE)
+
+
+def _percentile(values, fraction):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(gates, writers, seconds):
+    db = impl.Storage()
+    users = ['user{}'.format(u) for u in range(MEMBERS)]
+    db.create_users([models.User(u, 'F', 'L') for u in users])
+    db.create_group(models.Group('big'))
+    app.cntrlr = controller.Controller(db)
+    registry = metrics.Metrics()
+    application = admission.Middleware(app.app, dict(
+        (route_class, admission.Gate(*settings))
+        for route_class, settings in gates.items()), metrics=registry)
+    body = json.dumps({'userids': users})
+
+    stop = threading.Event()
+    reads, writes = [], []
+    threads = [threading.Thread(target=_loop, args=(
+        stop, lambda: _call(application, 'PUT', '/groups/big', body), writes))
+        for _ in range(writers)]
+    threads.extend(threading.Thread(target=_loop, args=(
+        stop, lambda: _call(application, 'GET', '/users/user0'), reads))
+        for _ in range(READERS))
+    [t.start() for t in threads]
+    time.sleep(seconds)
+    stop.set()
+    [t.join() for t in threads]
+
+    reads.sort()
+    shed = sum(int(line.rsplit(' ', 1)[1]) for line in
+               registry.render().splitlines()
+               if line.startswith('restytest_requests_shed_total{'))
+    return (len(reads) / seconds, _percentile(reads, 0.5) * 1e3,
+            _percentile(reads, 0.99) * 1e3, len(writes) / seconds,
+            shed / seconds)
+
+
+def main(argv):
+    writers = int(argv[0]) if argv else DEFAULT_WRITERS
+    seconds = float(argv[1]) if len(argv) > 1 else DEFAULT_SECONDS
+    print('{:<16} {:>8} {:>12} {:>12} {:>9} {:>8}'.format(
+        'setting', 'reads/s', 'read p50 ms', 'read p99 ms', 'writes/s',
+        'shed/s'))
+    for name, gates in SETTINGS:
+        print('{:<16} {:>8.0f} {:>12.2f} {:>12.2f} {:>9.0f} {:>8.0f}'.format(
+            name, *run(gates, writers, seconds)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
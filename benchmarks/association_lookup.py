@@ -0,0 +1,55 @@
+""" Membership lookup latency as the association table grows
+
+Usage: python benchmarks/association_lookup.py [sizes...]
+
+Each size is a total number of memberships. Every user belongs to the same
+number of groups, so a flat latency curve means lookups scale with the size of
+the one user or group rather than with the table.
+"""
+
+import sys
+import timeit
+
+from restytest.storage import impl
+from restytest.storage import schema
+
+
+GROUPS = 100
+GROUPS_PER_USER = 10
+LOOKUPS = 2000
+DEFAULT_SIZES = (10000, 100000, 500000)
+
+
+def _populate(db, memberships):
+    users = memberships // GROUPS_PER_USER
+    db.conn.execute(schema.groups.insert(),
+                    [dict(id='group{}'.format(g)) for g in range(GROUPS)])
+    db.conn.execute(schema.users.insert(),
+                    [dict(id='user{}'.format(u), first_name='f',
+                          last_name='l') for u in range(users)])
+    db.conn.execute(
+        schema.user_group_associations.insert(),
+        [dict(user_id='user{}'.format(u),
+              group_id='group{}'.format((u + g) % GROUPS))
+         for u in range(users) for g in range(GROUPS_PER_USER)]
+    )
+    return users
+
+
+def run(memberships):
+    db = impl.Storage()
+    users = _populate(db, memberships)
+    user_id = 'user{}'.format(users // 2)
+    per_user = timeit.timeit(lambda: db.get_user(user_id), number=LOOKUPS)
+    return per_user / LOOKUPS * 1e6
+
+
+def main(argv):
+    sizes = [int(s) for s in argv] or DEFAULT_SIZES
+    print('{:>12} {:>16}'.format('memberships', 'get_user (us)'))
+    for size in sizes:
+        print('{:>12} {:>16.1f}'.format(size, run(size)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
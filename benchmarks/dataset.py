@@ -0,0 +1,113 @@
+""" Synthetic dataset generator
+
+Usage: python benchmarks/dataset.py DB_URI [users] [groups] [seed]
+
+Loads users and groups into the database at DB_URI through Storage's bulk
+creates. Group popularity follows a power law, so a few groups hold a large
+share of all memberships while most are small, and a slice of users sit at
+the 50-group cap. Ids are ``user<n>`` and ``group<n>``, which is what
+benchmarks/replay.py expects. The same arguments always produce the same
+dataset.
+"""
+
+import bisect
+import random
+import sys
+import time
+
+from restytest import models
+from restytest import storage
+
+
+# Share of users in as many groups as the model allows; the rest get a Pareto
+# distributed number of groups, so most belong to one or two.
+CAPPED = 0.05
+GROUPS_SHAPE = 1.2
+# Zipf exponent of group popularity.
+POPULARITY = 1.0
+BATCH_SIZE = 10000
+
+
+def user_id(n):
+    return 'user{}'.format(n)
+
+
+def group_id(n):
+    return 'group{}'.format(n)
+
+
+class PowerLaw(object):
+    """Draws integers in [0, n) with weight 1 / (i + 1) ** exponent."""
+
+    def __init__(self, n, exponent=POPULARITY, rand=random):
+        self._rand = rand
+        self._cumulative = []
+        total = 0.0
+        for i in range(n):
+            total += 1.0 / (i + 1) ** exponent
+            self._cumulative.append(total)
+
+    def draw(self):
+        point = self._rand.random() * self._cumulative[-1]
+        return bisect.bisect_right(self._cumulative, point)
+
+    def sample(self, k):
+        """Draw ``k`` distinct integers."""
+        k = min(k, len(self._cumulative))
+        chosen = []
+        seen = set()
+        while len(chosen) < k:
+            i = self.draw()
+            if i not in seen:
+                seen.add(i)
+                chosen.append(i)
+        return chosen
+
+
+def group_count(rand):
+    if rand.random() < CAPPED:
+        return models.MAX_USER_GROUPS
+    return min(models.MAX_USER_GROUPS, int(rand.paretovariate(GROUPS_SHAPE)))
+
+
+def generate_users(users, groups, seed=0):
+    rand = random.Random(seed)
+    popularity = PowerLaw(groups, rand=rand)
+    for n in range(users):
+        yield models.User(
+            user_id(n), 'First{}'.format(n), 'Last{}'.format(n),
+            groups=[group_id(g) for g in popularity.sample(group_count(rand))]
+        )
+
+
+def load(db, users, groups, seed=0):
+    """Create the dataset in ``db``, returning the number of memberships."""
+    db.create_groups([models.Group(group_id(g)) for g in range(groups)])
+    memberships = 0
+    batch = []
+    for user in generate_users(users, groups, seed):
+        batch.append(user)
+        memberships += len(user.groups)
+        if len(batch) == BATCH_SIZE:
+            db.create_users(batch)
+            batch = []
+    if batch:
+        db.create_users(batch)
+    return memberships
+
+
+def main(argv):
+    uri = argv[0]
+    users = int(argv[1]) if len(argv) > 1 else 1000000
+    groups = int(argv[2]) if len(argv) > 2 else 10000
+    seed = int(argv[3]) if len(argv) > 3 else 0
+    db = storage.Storage(uri, profile='fast')
+    start = time.time()
+    memberships = load(db, users, groups, seed)
+    elapsed = time.time() - start
+    print('{} users, {} groups, {} memberships in {:.1f}s ({:.0f} users/s)'
+          .format(users, groups, memberships, elapsed, users / elapsed))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,56 @@
+""" Write and read throughput of each storage durability profile
+
+Usage: python benchmarks/durability_profiles.py [writes] [reads]
+
+Each write is a separate create_user transaction, so its cost includes
+whatever syncing the profile asks for on commit.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from restytest import models
+from restytest.storage import impl
+
+
+DEFAULT_WRITES = 2000
+DEFAULT_READS = 20000
+GROUPS = ['group{}'.format(g) for g in range(10)]
+
+
+def _rate(count, func):
+    start = time.time()
+    for i in range(count):
+        func(i)
+    return count / (time.time() - start)
+
+
+def run(profile, writes, reads):
+    workdir = tempfile.mkdtemp()
+    try:
+        db = impl.Storage('sqlite:///{}'.format(
+            os.path.join(workdir, 'bench.db')), profile)
+        [db.create_group(models.Group(g)) for g in GROUPS]
+        write_rate = _rate(writes, lambda i: db.create_user(models.User(
+            'user{}'.format(i), 'F', 'L', groups=GROUPS[:i % 5])))
+        read_rate = _rate(reads, lambda i: db.get_user(
+            'user{}'.format(i % writes)))
+    finally:
+        shutil.rmtree(workdir)
+    return write_rate, read_rate
+
+
+def main(argv):
+    writes = int(argv[0]) if argv else DEFAULT_WRITES
+    reads = int(argv[1]) if len(argv) > 1 else DEFAULT_READS
+    print('{:<10} {:>12} {:>12}'.format('profile', 'writes/s', 'reads/s'))
+    for profile in ('stock', 'durable', 'balanced', 'fast'):
+        print('{:<10} {:>12.0f} {:>12.0f}'.format(
+            profile, *run(profile, writes, reads)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
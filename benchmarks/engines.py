@@ -0,0 +1,53 @@
+""" Per-call cost of each storage engine
+
+Usage: python benchmarks/engines.py [users]
+
+Compares the SQLite engine on an in-memory database with the pure-Python
+memory engine on the same dataset.
+"""
+
+import sys
+import timeit
+
+from restytest import models
+from restytest import storage
+
+
+DEFAULT_USERS = 10000
+GROUPS = ['group{}'.format(g) for g in range(50)]
+CALLS = 5000
+
+
+def _populate(db, users):
+    db.create_groups([models.Group(g) for g in GROUPS])
+    db.create_users([
+        models.User('user{}'.format(u), 'F', 'L',
+                    groups=GROUPS[u % 40:u % 40 + 10])
+        for u in range(users)
+    ])
+
+
+def run(db, users):
+    _populate(db, users)
+    user_id = 'user{}'.format(users // 2)
+    user = db.get_user(user_id)
+    results = []
+    for func in (lambda: db.get_user(user_id),
+                 lambda: db.get_group(GROUPS[0]),
+                 lambda: db.update_user(user_id, user)):
+        results.append(timeit.timeit(func, number=CALLS) / CALLS * 1e6)
+    return results
+
+
+def main(argv):
+    users = int(argv[0]) if argv else DEFAULT_USERS
+    print('{:<8} {:>14} {:>15} {:>17}'.format(
+        'engine', 'get_user (us)', 'get_group (us)', 'update_user (us)'))
+    for name, db in (('sqlite', storage.Storage()),
+                     ('memory', storage.MemoryStorage())):
+        print('{:<8} {:>14.1f} {:>15.1f} {:>17.1f}'.format(
+            name, *run(db, users)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
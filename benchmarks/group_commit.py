@@ -0,0 +1,83 @@
+""" Write throughput and latency with and without group commit
+
+Usage: python benchmarks/group_commit.py [writers] [writes per writer]
+
+Concurrent writer threads create and then update users in a file database,
+under the durable profile, where every commit waits for an fsync, and the
+balanced one, where it doesn't. Each (commit_batch, commit_window) setting
+is measured on a fresh database.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from restytest import models
+from restytest.storage import impl
+
+
+DEFAULT_WRITERS = 16
+DEFAULT_WRITES = 100
+SETTINGS = ((1, 0.0), (64, 0.0), (64, 0.001), (64, 0.005))
+GROUPS = ['group{}'.format(g) for g in range(10)]
+
+
+def _timed(latencies, func, *args):
+    start = time.time()
+    func(*args)
+    latencies.append(time.time() - start)
+
+
+def _writer(db, writer, writes, latencies):
+    for i in range(writes // 2):
+        user_id = 'user{}-{}'.format(writer, i)
+        _timed(latencies, db.create_user,
+               models.User(user_id, 'F', 'L', GROUPS[i % 5:i % 5 + 3]))
+        _timed(latencies, db.update_user, user_id,
+               models.User(user_id, 'G', 'L', GROUPS[i % 7:i % 7 + 3]))
+
+
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(profile, batch, window, writers, writes):
+    workdir = tempfile.mkdtemp()
+    try:
+        db = impl.Storage('sqlite:///{}'.format(
+            os.path.join(workdir, 'bench.db')), profile,
+            commit_batch=batch, commit_window=window)
+        [db.create_group(models.Group(g)) for g in GROUPS]
+        latencies = []
+        threads = [threading.Thread(target=_writer,
+                                    args=(db, w, writes, latencies))
+                   for w in range(writers)]
+        start = time.time()
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        elapsed = time.time() - start
+        db.close()
+    finally:
+        shutil.rmtree(workdir)
+    latencies.sort()
+    return (len(latencies) / elapsed, _percentile(latencies, 0.5) * 1e3,
+            _percentile(latencies, 0.99) * 1e3)
+
+
+def main(argv):
+    writers = int(argv[0]) if argv else DEFAULT_WRITERS
+    writes = int(argv[1]) if len(argv) > 1 else DEFAULT_WRITES
+    print('{:<10} {:>6} {:>8} {:>10} {:>10} {:>10}'.format(
+        'profile', 'batch', 'window', 'writes/s', 'p50 (ms)', 'p99 (ms)'))
+    for profile in ('durable', 'balanced'):
+        for batch, window in SETTINGS:
+            print('{:<10} {:>6} {:>8} {:>10.0f} {:>10.2f} {:>10.2f}'.format(
+                profile, batch, window,
+                *run(profile, batch, window, writers, writes)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
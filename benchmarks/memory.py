@@ -0,0 +1,104 @@
+""" Memory allocated at each step of serving a large group
+
+Usage: python benchmarks/memory.py [members...]
+
+Reads one group of each size from SQLite storage and follows it through the
+request path: the rows read, the model built from them, the view of the
+model, and the JSON body. For each step it reports the objects the step
+allocated that are still reachable from its output -- a copy of the
+membership list shows up as a new list, a shared one as nothing -- and their
+size as sys.getsizeof sees it. Also reported is what one model costs to keep,
+which is what a cached group holds on to.
+"""
+
+import sys
+
+import sqlalchemy as sa
+
+from restytest.api import app
+from restytest.api import views
+from restytest.storage import impl
+from restytest.storage import schema
+
+
+GROUP_ID = 'group'
+DEFAULT_SIZES = (1000, 10000, 100000)
+
+
+def _populate(db, members):
+    db.conn.execute(schema.groups.insert(), [dict(id=GROUP_ID)])
+    db.conn.execute(schema.users.insert(),
+                    [dict(id='user{}'.format(u), first_name='f',
+                          last_name='l') for u in range(members)])
+    db.conn.execute(schema.user_group_associations.insert(),
+                    [dict(user_id='user{}'.format(u), group_id=GROUP_ID)
+                     for u in range(members)])
+
+
+def _referents(obj):
+    if isinstance(obj, (list, tuple)):
+        return obj
+    if isinstance(obj, dict):
+        return list(obj.keys()) + list(obj.values())
+    if isinstance(obj, sa.engine.RowProxy):
+        # Only the values; the result metadata a row points at is shared by
+        # every row of every query.
+        return list(obj)
+    referents = [getattr(obj, s) for s in getattr(type(obj), '__slots__', ())]
+    if hasattr(obj, '__dict__'):
+        referents.append(obj.__dict__)
+    return referents
+
+
+def _allocated(root, seen):
+    """Count and size of the objects reachable from ``root`` not in ``seen``.
+
+    The objects found are added to ``seen``.
+    """
+    count = size = 0
+    stack = [root]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        count += 1
+        size += sys.getsizeof(obj)
+        if not isinstance(obj, basestring):
+            stack.extend(_referents(obj))
+    return count, size
+
+
+def run(members):
+    db = impl.Storage()
+    _populate(db, members)
+    rows = db._read(impl._group_select(), entity_id=GROUP_ID)
+    model = impl._to_group(rows)
+    view = views.group(model)
+    steps = [
+        ('rows', rows),
+        ('model', model),
+        ('view', view),
+        ('json', app.json_codec.dumps(view)),
+        ('group_json', views.group_json(model)),
+    ]
+    # Every output is kept alive until the end, so no id in seen can be reused
+    # by a later allocation.
+    seen = set()
+    results = [(name, _allocated(output, seen)) for name, output in steps]
+    results.append(('held', _allocated(model, set())))
+    return results
+
+
+def main(argv):
+    sizes = [int(s) for s in argv] or DEFAULT_SIZES
+    print('{:>10} {:>12} {:>10} {:>12}'.format(
+        'members', 'step', 'objects', 'KiB'))
+    for size in sizes:
+        for step, (count, nbytes) in run(size):
+            print('{:>10} {:>12} {:>10} {:>12.1f}'.format(
+                size, step, count, nbytes / 1024.0))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
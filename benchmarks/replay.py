@@ -0,0 +1,249 @@
+""" Replay a mixed request workload and report throughput and latency
+
+Usage: python benchmarks/replay.py [--url HOST:PORT] [--db URI]
+                                   [--users N] [--groups N] [--mix MIX]
+                                   [--requests N] [--clients N] [--seed N]
+
+Generates a request sequence per client from the seed -- the same arguments
+always replay the same requests -- then sends them concurrently and reports
+throughput and p50/p99/p999 latency per operation.
+
+With --url the requests go to a running server, which should hold a dataset
+made by benchmarks/dataset.py with the same --users and --groups. Without it
+they go to the WSGI app in-process, backed by --db if given or by a freshly
+generated in-memory dataset otherwise.
+
+MIX is a comma separated list of operation=weight. Operations are get_user,
+get_group, put_user, post_user, delete_user, put_group, post_group and
+delete_group. Creates use ids of their own, and puts and deletes of groups and
+deletes of users only touch what this run created, so the dataset itself is
+only changed by put_user.
+"""
+
+import argparse
+import bisect
+import collections
+import httplib
+import json
+import random
+import StringIO
+import sys
+import threading
+import time
+from wsgiref import util as wsgi_util
+
+import dataset
+
+from restytest import storage
+from restytest.api import app
+from restytest.api import controller
+
+
+DEFAULT_MIX = ('get_user=50,get_group=20,put_user=10,post_user=8,'
+               'delete_user=4,post_group=3,put_group=3,delete_group=2')
+# Operations that need something this client created first; without one, the
+# client creates it instead.
+NEEDS = {
+    'delete_user': 'post_user',
+    'put_group': 'post_group',
+    'delete_group': 'post_group',
+}
+
+
+def parse_mix(mix):
+    weights = []
+    for item in mix.split(','):
+        op, weight = item.split('=')
+        if not hasattr(Workload, op):
+            raise ValueError("Unknown operation {}".format(op))
+        weights.append((op, float(weight)))
+    return weights
+
+
+class Workload(object):
+    """Deterministic request sequence for one client."""
+
+    def __init__(self, mix, users, groups, seed, client):
+        self._rand = random.Random(seed * 1000003 + client)
+        self._prefix = 'r{}-{}-'.format(seed, client)
+        self._ops = [op for op, _ in mix]
+        self._cumulative = []
+        total = 0
+        for _, weight in mix:
+            total += weight
+            self._cumulative.append(total)
+        self._users = users
+        self._popularity = dataset.PowerLaw(groups, rand=self._rand)
+        self._created = collections.defaultdict(list)
+        self._count = 0
+
+    def requests(self, n):
+        for _ in range(n):
+            point = self._rand.random() * self._cumulative[-1]
+            op = self._ops[bisect.bisect_right(self._cumulative, point)]
+            if op in NEEDS and not self._created[NEEDS[op]]:
+                op = NEEDS[op]
+            yield (op,) + getattr(self, op)()
+
+    def _new_id(self, op):
+        self._count += 1
+        new_id = self._prefix + str(self._count)
+        self._created[op].append(new_id)
+        return new_id
+
+    def _user(self):
+        return dataset.user_id(self._rand.randrange(self._users))
+
+    def _groups(self):
+        return [dataset.group_id(g) for g in
+                self._popularity.sample(dataset.group_count(self._rand))]
+
+    def _user_body(self, user_id):
+        return json.dumps({
+            'userid': user_id,
+            'first_name': 'Replay',
+            'last_name': 'User',
+            'groups': self._groups(),
+        })
+
+    def get_user(self):
+        return 'GET', '/users/' + self._user(), ''
+
+    def get_group(self):
+        group_id = dataset.group_id(self._popularity.draw())
+        return 'GET', '/groups/' + group_id, ''
+
+    def put_user(self):
+        user_id = self._user()
+        return 'PUT', '/users/' + user_id, self._user_body(user_id)
+
+    def post_user(self):
+        return 'POST', '/users', self._user_body(self._new_id('post_user'))
+
+    def delete_user(self):
+        return 'DELETE', '/users/' + self._created['post_user'].pop(), ''
+
+    def post_group(self):
+        body = json.dumps({'name': self._new_id('post_group')})
+        return 'POST', '/groups', body
+
+    def put_group(self):
+        group_id = self._rand.choice(self._created['post_group'])
+        users = [self._user() for _ in range(self._rand.randrange(1, 51))]
+        return 'PUT', '/groups/' + group_id, json.dumps({'userids': users})
+
+    def delete_group(self):
+        return 'DELETE', '/groups/' + self._created['post_group'].pop(), ''
+
+
+def http_sender(address):
+    host, port = address.rsplit(':', 1)
+
+    def send(method, path, body):
+        conn = httplib.HTTPConnection(host, int(port))
+        conn.request(method, path, body or None,
+                     {'Content-Type': app.API_MIMETYPE})
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        return response.status
+    return send
+
+
+def wsgi_sender():
+    def send(method, path, body):
+        environ = {}
+        wsgi_util.setup_testing_defaults(environ)
+        environ.update({
+            'REQUEST_METHOD': method,
+            'PATH_INFO': path,
+            'CONTENT_TYPE': app.API_MIMETYPE,
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': StringIO.StringIO(body),
+        })
+        status = []
+        response = app.application(environ, lambda s, headers, exc=None:
+                                   status.append(s))
+        ''.join(response)
+        response.close()
+        return int(status[0].split()[0])
+    return send
+
+
+def _client(send, requests, results):
+    for op, method, path, body in requests:
+        start = time.time()
+        status = send(method, path, body)
+        results.append((op, status, time.time() - start))
+
+
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def report(results, elapsed):
+    print('{:<14} {:>8} {:>8} {:>10} {:>10} {:>10}'.format(
+        'operation', 'count', 'errors', 'p50 (ms)', 'p99 (ms)', 'p999 (ms)'))
+    latencies = collections.defaultdict(list)
+    errors = collections.Counter()
+    statuses = collections.Counter()
+    for op, status, latency in results:
+        latencies[op].append(latency)
+        latencies['all'].append(latency)
+        statuses[status] += 1
+        if status >= 500:
+            errors[op] += 1
+            errors['all'] += 1
+    for op in sorted(latencies, key=lambda o: (o == 'all', o)):
+        values = sorted(latencies[op])
+        print('{:<14} {:>8} {:>8} {:>10.2f} {:>10.2f} {:>10.2f}'.format(
+            op, len(values), errors[op],
+            _percentile(values, 0.5) * 1e3,
+            _percentile(values, 0.99) * 1e3,
+            _percentile(values, 0.999) * 1e3))
+    print('\n{:.0f} requests/s over {:.1f}s; statuses: {}'.format(
+        len(results) / elapsed, elapsed,
+        ', '.join('{}={}'.format(s, n) for s, n in sorted(statuses.items()))))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url')
+    parser.add_argument('--db')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--groups', type=int, default=100)
+    parser.add_argument('--mix', default=DEFAULT_MIX)
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.url:
+        send = http_sender(args.url)
+    else:
+        if args.db:
+            db = storage.Storage(args.db)
+        else:
+            db = storage.Storage()
+            dataset.load(db, args.users, args.groups, args.seed)
+        app.cntrlr = controller.Controller(db)
+        send = wsgi_sender()
+
+    mix = parse_mix(args.mix)
+    per_client = args.requests // args.clients
+    workloads = [
+        list(Workload(mix, args.users, args.groups, args.seed, c)
+             .requests(per_client))
+        for c in range(args.clients)
+    ]
+    results = []
+    threads = [threading.Thread(target=_client, args=(send, w, results))
+               for w in workloads]
+    start = time.time()
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    report(results, time.time() - start)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,136 @@
+""" Throughput and latency of each RESTYTEST_SERVER mode
+
+Usage: python benchmarks/server_modes.py [seconds] [clients] [slow]
+
+Starts the API once per mode on a shared file database, then has concurrent
+clients GET the same user for a fixed time. Meanwhile ``slow`` more clients
+each send the start of a PUT and then stall until the run ends, the way a
+slow mobile upload does. Modes that give a connection a thread for its whole
+request serve nobody once the slow clients outnumber their threads.
+"""
+
+import httplib
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+PORT = 18080
+TIMEOUT = 5
+MODES = (
+    ('wsgiref', {}),
+    ('threaded', {'RESTYTEST_WORKERS': '8'}),
+    ('evented', {'RESTYTEST_WORKERS': '8'}),
+    ('prefork', {'RESTYTEST_WORKERS': '4'}),
+)
+USER = {
+    "userid": "bc",
+    "first_name": "Bumbleywump",
+    "last_name": "Cucumberpatch",
+    "groups": []
+}
+
+
+def _wait_for_port():
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', PORT)).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError("server did not start")
+
+
+def _request(method, path, body=None):
+    conn = httplib.HTTPConnection('127.0.0.1', PORT, timeout=TIMEOUT)
+    conn.request(method, path, body)
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    return response.status
+
+
+def _client(deadline, latencies):
+    while time.time() < deadline:
+        start = time.time()
+        try:
+            _request('GET', '/users/bc')
+        except socket.error:
+            continue
+        latencies.append(time.time() - start)
+
+
+def _stall(stalled):
+    body = json.dumps(USER)
+    try:
+        sock = socket.create_connection(('127.0.0.1', PORT), TIMEOUT)
+        sock.sendall('PUT /users/bc HTTP/1.1\r\nContent-Length: {}\r\n\r\n'
+                     '{}'.format(len(body), body[:10]))
+    except socket.error:
+        return False
+    stalled.append(sock)
+    return True
+
+
+def _percentile(values, fraction):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(mode, env, seconds, clients, slow):
+    workdir = tempfile.mkdtemp()
+    env = dict(os.environ, RESTYTEST_SERVER=mode,
+               RESTYTEST_HOST='127.0.0.1', RESTYTEST_PORT=str(PORT),
+               RESTYTEST_DB_URI='sqlite:///{}/bench.db'.format(workdir),
+               **env)
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'restytest.api.app'], env=env,
+        stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w'))
+    try:
+        _wait_for_port()
+        _request('POST', '/users', json.dumps(USER))
+        stalled = []
+        # A server stuck on earlier stalls may stop accepting once its backlog
+        # fills; it's as blocked as it gets by then.
+        for _ in range(slow):
+            if not _stall(stalled):
+                break
+        latencies = []
+        deadline = time.time() + seconds
+        threads = [threading.Thread(target=_client,
+                                    args=(deadline, latencies))
+                   for _ in range(clients)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        [s.close() for s in stalled]
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        proc.wait()
+        shutil.rmtree(workdir)
+    latencies.sort()
+    return (len(latencies) / float(seconds),
+            _percentile(latencies, 0.5) * 1e3,
+            _percentile(latencies, 0.99) * 1e3)
+
+
+def main(argv):
+    seconds = float(argv[0]) if argv else 5
+    clients = int(argv[1]) if len(argv) > 1 else 16
+    slow = int(argv[2]) if len(argv) > 2 else 0
+    print('{:<10} {:>10} {:>10} {:>10}'.format(
+        'mode', 'req/s', 'p50 (ms)', 'p99 (ms)'))
+    for mode, env in MODES:
+        print('{:<10} {:>10.0f} {:>10.2f} {:>10.2f}'.format(
+            mode, *run(mode, env, seconds, clients, slow)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,98 @@
+""" Cost of compiling SQL on the GET and PUT paths, with and without caching
+
+Usage: python benchmarks/statement_cache.py [calls]
+
+Reads and replaces a user that belongs to a few groups, through storage
+and through the whole WSGI app, on storage that keeps compiled statements
+and on storage that compiles every statement every time it runs. Each call
+is timed, and profiled separately to attribute the time SQLAlchemy spends
+compiling statements. The profiler slows everything it watches, so compile
+times only compare with each other, not with the time per call.
+"""
+
+import cProfile
+import json
+import pstats
+import StringIO
+import sys
+import timeit
+from wsgiref import util as wsgi_util
+
+from restytest import models
+from restytest.api import app
+from restytest.api import controller
+from restytest.api import views
+from restytest.storage import impl
+
+
+DEFAULT_CALLS = 2000
+REPEAT = 3
+GROUPS = ['group{}'.format(g) for g in range(5)]
+USER = models.User('bc', 'Bumbleywump', 'Cucumberpatch', groups=GROUPS[:3])
+USER_JSON = json.dumps(views.user(USER))
+
+
+def _wsgi(method, path, body=''):
+    def call():
+        environ = {}
+        wsgi_util.setup_testing_defaults(environ)
+        environ.update({
+            'REQUEST_METHOD': method,
+            'PATH_INFO': path,
+            'CONTENT_TYPE': app.API_MIMETYPE,
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': StringIO.StringIO(body),
+        })
+        response = app.application(environ, lambda *args: 0)
+        ''.join(response)
+        response.close()
+    return call
+
+
+PATHS = [
+    ('storage.get_user', lambda db: lambda: db.get_user(USER.user_id)),
+    ('storage.update_user', lambda db: lambda: db.update_user(
+        USER.user_id, USER)),
+    ('wsgi GET /users', lambda db: _wsgi('GET', '/users/bc')),
+    ('wsgi PUT /users', lambda db: _wsgi('PUT', '/users/bc', USER_JSON)),
+]
+
+
+def _compile_seconds(func, calls):
+    """Seconds spent compiling statements over ``calls`` calls.
+
+    ClauseElement._compiler builds the compiled form of a statement, as
+    called by compile() on SQLAlchemy 1.3 and by the statement cache on 1.4.
+    """
+    profile = cProfile.Profile()
+    profile.runcall(lambda: [func() for _ in range(calls)])
+    stats = pstats.Stats(profile).stats
+    return sum(cumulative for (path, _, name), (_, _, _, cumulative, _)
+               in stats.items()
+               if name == '_compiler' and path.endswith('elements.py'))
+
+
+def run(statement_cache, calls):
+    db = impl.Storage(statement_cache=statement_cache)
+    [db.create_group(models.Group(g)) for g in GROUPS]
+    db.create_user(USER)
+    app.cntrlr = controller.Controller(db)
+    for name, make in PATHS:
+        func = make(db)
+        seconds = min(timeit.repeat(func, repeat=REPEAT, number=calls))
+        yield name, seconds / calls * 1e6, (
+            _compile_seconds(func, calls) / calls * 1e6)
+
+
+def main(argv):
+    calls = int(argv[0]) if argv else DEFAULT_CALLS
+    print('{:<22} {:>8} {:>10} {:>12}'.format(
+        'path', 'cache', 'us/call', 'compile us'))
+    for statement_cache in (0, impl.STATEMENT_CACHE_SIZE):
+        for name, per_call, compiling in run(statement_cache, calls):
+            print('{:<22} {:>8} {:>10.1f} {:>12.1f}'.format(
+                name, statement_cache, per_call, compiling))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,218 @@
+""" Per-layer micro-benchmarks of the request path
+
+Usage: python benchmarks/suite.py [--sizes small,medium] [--save]
+                                  [--baseline FILE] [--threshold 0.25]
+
+Times each layer of a request on its own -- JSON parsing, validation,
+controller conversion, storage, views -- and the whole WSGI app in-process,
+against datasets of several sizes. Each result is taken relative to a
+calibration loop timed in the same run, so baselines carry over between
+machines of different speeds. Results are compared with the saved baseline
+and the run fails if any benchmark is slower than its baseline by more than
+the threshold. --save records the current results as the new baseline
+instead.
+"""
+
+import argparse
+import json
+import os
+import StringIO
+import sys
+import timeit
+from wsgiref import util as wsgi_util
+
+from restytest import models
+from restytest import storage
+from restytest.api import app
+from restytest.api import controller
+from restytest.api import validations
+from restytest.api import views
+
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+DEFAULT_THRESHOLD = 0.25
+REPEAT = 5
+NUMBER = 200
+
+# Plain interpreter work that no change to the code under test can speed up or
+# slow down, to measure how fast this machine is.
+CALIBRATION_LOOPS = 1000
+
+# (users, groups, groups per user)
+SIZES = {
+    'small': (1000, 20, 5),
+    'medium': (10000, 200, 20),
+    'large': (50000, 1000, 50),
+}
+
+
+class Dataset(object):
+    def __init__(self, users, groups, per_user):
+        self.db = storage.Storage()
+        self.groups = ['group{}'.format(g) for g in range(groups)]
+        self.db.create_groups([models.Group(g) for g in self.groups])
+        self.db.create_users([
+            models.User('user{}'.format(u), 'Bumbleywump', 'Cucumberpatch',
+                        groups=[self.groups[(u + g) % groups]
+                                for g in range(per_user)])
+            for u in range(users)
+        ])
+        self.user_id = 'user{}'.format(users // 2)
+        self.user = self.db.get_user(self.user_id)
+        self.group_id = self.groups[0]
+        self.group = self.db.get_group(self.group_id)
+        self.user_body = views.user(self.user)
+        self.user_json = json.dumps(self.user_body)
+
+
+def _wsgi(method, path, body='', **headers):
+    def call():
+        environ = {}
+        wsgi_util.setup_testing_defaults(environ)
+        environ.update({
+            'REQUEST_METHOD': method,
+            'PATH_INFO': path,
+            'CONTENT_TYPE': app.API_MIMETYPE,
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': StringIO.StringIO(body),
+        })
+        environ.update(headers)
+        response = app.application(environ, lambda *args: 0)
+        ''.join(response)
+        response.close()
+    return call
+
+
+BENCHMARKS = [
+    ('json.load', lambda d: lambda: json.load(
+        StringIO.StringIO(d.user_json))),
+    ('codec.load', lambda d: lambda: app.json_codec.load(
+        StringIO.StringIO(d.user_json))),
+    ('validations.validate_user', lambda d: lambda: validations.validate_user(
+        d.user_body)),
+    ('controller._to_user', lambda d: lambda: controller._to_user(
+        d.user_body)),
+    ('storage.get_user', lambda d: lambda: d.db.get_user(d.user_id)),
+    ('storage.get_group', lambda d: lambda: d.db.get_group(d.group_id)),
+    ('storage.update_user', lambda d: lambda: d.db.update_user(
+        d.user_id, d.user)),
+    ('views.user', lambda d: lambda: views.user(d.user)),
+    ('views.group', lambda d: lambda: views.group(d.group)),
+    ('views.user_json', lambda d: lambda: views.user_json(d.user)),
+    ('views.group_json', lambda d: lambda: views.group_json(d.group)),
+    ('json.dumps views.user', lambda d: lambda: json.dumps(
+        views.user(d.user))),
+    ('wsgi GET /users', lambda d: _wsgi('GET', '/users/' + d.user_id)),
+    ('wsgi PUT /users', lambda d: _wsgi('PUT', '/users/' + d.user_id,
+                                        d.user_json)),
+    ('wsgi GET /groups', lambda d: _wsgi('GET', '/groups/' + d.group_id)),
+    # The ETag is read when the benchmark starts, as the PUT benchmark gives
+    # the user a new version.
+    ('wsgi GET /users 304', lambda d: _wsgi(
+        'GET', '/users/' + d.user_id,
+        HTTP_IF_NONE_MATCH='"{}"'.format(d.db.get_user_version(d.user_id)))),
+    ('wsgi GET /groups 304', lambda d: _wsgi(
+        'GET', '/groups/' + d.group_id,
+        HTTP_IF_NONE_MATCH='"{}"'.format(d.db.get_group_version(d.group_id)))),
+]
+
+
+def _calibration():
+    total = 0
+    for i in xrange(CALIBRATION_LOOPS):
+        total += i * i
+    return total
+
+
+def _time(func):
+    """Best time of one call to ``func``, in microseconds."""
+    timings = timeit.repeat(func, repeat=REPEAT, number=NUMBER)
+    return min(timings) / NUMBER * 1e6
+
+
+def calibrate():
+    return _time(_calibration)
+
+
+def run(size):
+    dataset = Dataset(*SIZES[size])
+    app.cntrlr = controller.Controller(dataset.db)
+    results = {}
+    for name, make in BENCHMARKS:
+        results['{} [{}]'.format(name, size)] = _time(make(dataset))
+    return results
+
+
+def _load_baseline(path):
+    """Saved ratios to the calibration loop, by benchmark name."""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        baseline = json.load(f)
+    if 'ratios' not in baseline:
+        # Baselines used to be absolute timings, which only mean anything on
+        # the machine that recorded them.
+        print('Ignoring {}: not relative to calibration; re-record it with '
+              '--save.\n'.format(path))
+        return {}
+    return baseline['ratios']
+
+
+def compare(results, calibration, baseline, threshold):
+    """Print results against the baseline, returning the regressions.
+
+    ``results`` are in microseconds and ``baseline`` holds ratios to the
+    calibration loop, which took ``calibration`` microseconds in this run.
+    """
+    regressions = []
+    print('calibration: {:.1f} us\n'.format(calibration))
+    print('{:<40} {:>12} {:>12} {:>12} {:>8}'.format(
+        'benchmark', 'current us', 'baseline x', 'current x', 'change'))
+    for name in sorted(results):
+        current = results[name] / calibration
+        previous = baseline.get(name)
+        if previous is None:
+            print('{:<40} {:>12.1f} {:>12} {:>12.3f} {:>8}'.format(
+                name, results[name], '-', current, 'new'))
+            continue
+        change = current / previous - 1
+        print('{:<40} {:>12.1f} {:>12.3f} {:>12.3f} {:>+7.0%}'.format(
+            name, results[name], previous, current, change))
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default=','.join(sorted(SIZES)))
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument('--save', action='store_true')
+    args = parser.parse_args(argv)
+
+    calibration = calibrate()
+    results = {}
+    for size in args.sizes.split(','):
+        results.update(run(size))
+
+    baseline = _load_baseline(args.baseline)
+    regressions = compare(results, calibration, baseline, args.threshold)
+
+    if args.save:
+        baseline.update((name, result / calibration)
+                        for name, result in results.items())
+        with open(args.baseline, 'w') as f:
+            json.dump(dict(calibration_us=calibration, ratios=baseline), f,
+                      indent=2, sort_keys=True)
+        return 0
+    if regressions:
+        print('\nSlower than baseline by more than {:.0%}:'.format(
+            args.threshold))
+        print('\n'.join('  ' + name for name in regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
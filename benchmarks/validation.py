@@ -0,0 +1,45 @@
+""" Per-call cost of request body validation
+
+Usage: python benchmarks/validation.py [calls]
+
+Compares jsonschema.validate, which resolves and checks the schema on every
+call, with the validators restytest.api.validations builds at import time.
+"""
+
+import sys
+import timeit
+
+import jsonschema
+
+from restytest.api import validations
+
+
+DEFAULT_CALLS = 20000
+
+CASES = [
+    ('user', validations.user, validations.validate_user, {
+        "userid": "bc",
+        "first_name": "Bumbleywump",
+        "last_name": "Cucumberpatch",
+        "groups": ["group{}".format(g) for g in range(50)],
+    }),
+    ('group_post', validations.group_post, validations.validate_group_post,
+     {"name": "admins"}),
+    ('group_put', validations.group_put, validations.validate_group_put,
+     {"userids": ["user{}".format(u) for u in range(50)]}),
+]
+
+
+def main(argv):
+    calls = int(argv[0]) if argv else DEFAULT_CALLS
+    print('{:<12} {:>14} {:>14}'.format('schema', 'before (us)', 'after (us)'))
+    for name, schema, validate, data in CASES:
+        before = timeit.timeit(lambda: jsonschema.validate(data, schema),
+                               number=calls)
+        after = timeit.timeit(lambda: validate(data), number=calls)
+        print('{:<12} {:>14.1f} {:>14.1f}'.format(
+            name, before / calls * 1e6, after / calls * 1e6))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
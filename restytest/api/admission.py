@@ -0,0 +1,216 @@
+""" Admission control and load shedding """
+
+import math
+import threading
+import time
+
+from restytest.api import wsgi
+
+
+READ = 'read'
+WRITE = 'write'
+ROUTE_CLASSES = (READ, WRITE)
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+QUEUE_FULL = 'queue_full'
+LATENCY_BUDGET = 'latency_budget'
+CLIENT_QUOTA = 'client_quota'
+SHED_STATUSES = {
+    QUEUE_FULL: '503 Service Unavailable',
+    LATENCY_BUDGET: '503 Service Unavailable',
+    CLIENT_QUOTA: '429 Too Many Requests',
+}
+
+# Weight of the latest request in the running average of how long requests hold
+# a slot.
+SERVICE_WEIGHT = 0.2
+
+
+def route_class(environ):
+    """Whether the request is a READ or a WRITE."""
+    if environ.get('REQUEST_METHOD', 'GET') in READ_METHODS:
+        return READ
+    return WRITE
+
+
+def check_workers(gates, workers):
+    """Raise ValueError if requests held by ``gates`` can take every worker.
+
+    A request waiting at a gate, or admitted through it, holds one of the
+    server's ``workers`` threads. Unless every class can be held back only
+    as far as leaves the others a thread, one class filling its gate and
+    queue would keep the rest from reaching theirs at all.
+    """
+    held = sum(gate.limit + gate.queue for gate in gates.values())
+    if len(gates) < len(ROUTE_CLASSES):
+        held += 1
+    if held > workers:
+        raise ValueError(
+            "RESTYTEST_MAX_READS, RESTYTEST_MAX_WRITES and "
+            "RESTYTEST_ADMISSION_QUEUE can hold {} of {} "
+            "RESTYTEST_WORKERS".format(held, workers))
+
+
+class Gate(object):
+    """Admits ``limit`` requests at a time, with ``queue`` more waiting.
+
+    Waiting requests are admitted as others finish. With a ``budget``, in
+    seconds, a request is shed at once if the requests ahead of it are
+    expected to take longer than that to finish, from how long requests
+    have been holding a slot, and shed if it has waited that long anyway.
+    """
+
+    def __init__(self, limit, queue=0, budget=None):
+        self.limit = limit
+        self.queue = queue
+        self.budget = budget
+        self.in_flight = 0
+        self.waiting = 0
+        self.service = None
+        self._cond = threading.Condition()
+
+    def _expected_wait(self):
+        if self.service is None:
+            return 0.0
+        return self.service * (self.waiting + 1) / self.limit
+
+    def retry_after(self):
+        """Whole seconds a shed request should wait before trying again."""
+        with self._cond:
+            wait = max(self._expected_wait(), self.budget or 0)
+        return max(1, int(math.ceil(wait)))
+
+    def enter(self):
+        """None once the request is admitted, or why it was shed."""
+        with self._cond:
+            if self.in_flight < self.limit and not self.waiting:
+                self.in_flight += 1
+                return None
+            if self.waiting >= self.queue:
+                return QUEUE_FULL
+            if self.budget is not None:
+                if self._expected_wait() > self.budget:
+                    return LATENCY_BUDGET
+                deadline = time.time() + self.budget
+            self.waiting += 1
+            try:
+                while self.in_flight >= self.limit:
+                    if self.budget is None:
+                        self._cond.wait()
+                        continue
+                    # A timed wait polls on Python 2, so a budget costs waiting
+                    # requests up to a few milliseconds more before they are
+                    # admitted.
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return LATENCY_BUDGET
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.in_flight += 1
+            return None
+
+    def leave(self, seconds):
+        """Free the slot of a request that held it for ``seconds``."""
+        with self._cond:
+            self.in_flight -= 1
+            if self.service is None:
+                self.service = seconds
+            else:
+                self.service += SERVICE_WEIGHT * (seconds - self.service)
+            self._cond.notify()
+
+
+class ClientQuota(object):
+    """Caps the requests each client has in flight at ``limit``.
+
+    Clients are told apart by the ``header`` they send, or by their address
+    without one.
+    """
+
+    def __init__(self, limit, header=None):
+        self.limit = limit
+        self._key = 'HTTP_{}'.format(
+            header.upper().replace('-', '_')) if header else None
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def client(self, environ):
+        return (self._key and environ.get(self._key)) or environ.get(
+            'REMOTE_ADDR', '')
+
+    def enter(self, client):
+        """Whether ``client`` may have one more request in flight."""
+        with self._lock:
+            count = self._in_flight.get(client, 0)
+            if count >= self.limit:
+                return False
+            self._in_flight[client] = count + 1
+            return True
+
+    def leave(self, client):
+        with self._lock:
+            count = self._in_flight.pop(client) - 1
+            if count:
+                self._in_flight[client] = count
+
+
+class Middleware(object):
+    """WSGI middleware admitting requests through ``gates`` and ``quota``.
+
+    ``gates`` maps READ and WRITE to the Gate requests of that class go
+    through; a class without one is never held back. A request over its
+    client's ``quota`` is answered 429, and one shed by its gate 503, both
+    with a Retry-After header and without reaching ``app``. Every shed
+    request is counted in ``metrics`` by class and reason. A request keeps
+    its slot until its body has been sent.
+    """
+
+    def __init__(self, app, gates=None, quota=None, metrics=None):
+        self.app = app
+        self.gates = gates or {}
+        self.quota = quota
+        self.metrics = metrics
+
+    def _shed(self, start_response, request_class, reason, gate):
+        if self.metrics is not None:
+            self.metrics.shed(request_class, reason)
+        retry_after = 1 if reason == CLIENT_QUOTA else gate.retry_after()
+        start_response(SHED_STATUSES[reason], [
+            ('Content-Length', '0'), ('Retry-After', str(retry_after))])
+        return []
+
+    def _admit(self, gate, client):
+        """None once the request holds its slots, or why it was shed."""
+        if client is not None and not self.quota.enter(client):
+            return CLIENT_QUOTA
+        reason = gate.enter() if gate is not None else None
+        if reason is not None and client is not None:
+            self.quota.leave(client)
+        return reason
+
+    def _release(self, gate, client, start):
+        if gate is not None:
+            gate.leave(time.time() - start)
+        if client is not None:
+            self.quota.leave(client)
+
+    def __call__(self, environ, start_response):
+        if not self.gates and self.quota is None:
+            return self.app(environ, start_response)
+
+        request_class = route_class(environ)
+        gate = self.gates.get(request_class)
+        client = self.quota.client(environ) if self.quota else None
+        reason = self._admit(gate, client)
+        if reason is not None:
+            return self._shed(start_response, request_class, reason, gate)
+
+        start = time.time()
+        try:
+            body = self.app(environ, start_response)
+        except Exception:
+            self._release(gate, client, start)
+            raise
+        return wsgi.ClosingBody(
+            body, lambda size: self._release(gate, client, start))
@@ -1,13 +1,23 @@
 """ REST API Application """
 
 import functools
-import json
 import os
+import signal
+import threading
 
 import bottle
 
 from restytest import exceptions
+from restytest import storage
+from restytest.storage import snapshot
+from restytest.api import admission
+from restytest.api import codec
 from restytest.api import controller
+from restytest.api import evented
+from restytest.api import metrics
+from restytest.api import pagination
+from restytest.api import server
+from restytest.api import tracing
 from restytest.api import views
 
 
@@ -15,10 +25,109 @@ USERS_ROUTE = '/users'
 USER_ROUTE = '{}/<userid>'.format(USERS_ROUTE)
 GROUPS_ROUTE = '/groups'
 GROUP_ROUTE = '{}/<group_name>'.format(GROUPS_ROUTE)
+MEMBERS_ROUTE = '{}/members'.format(GROUP_ROUTE)
+MEMBER_ROUTE = '{}/<userid>'.format(MEMBERS_ROUTE)
+USERS_BULK_ROUTE = '{}/_bulk'.format(USERS_ROUTE)
+GROUPS_BULK_ROUTE = '{}/_bulk'.format(GROUPS_ROUTE)
 API_MIMETYPE = "application/json"
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+ERROR_STATUSES = (
+    ((TypeError, ValueError, exceptions.InvalidIdentifier), 400),
+    ((exceptions.GroupNotFound, exceptions.UserNotFound), 404),
+    ((exceptions.ValidationError,), 422),
+    ((exceptions.ResourceAlreadyExists,), 409),
+    ((exceptions.BatchAborted,), 424),
+    ((exceptions.PreconditionFailed,), 412),
+)
+HANDLED_ERRORS = sum((types for types, _ in ERROR_STATUSES), ())
+
+
+SERVERS = {
+    'wsgiref': 'wsgiref',
+    'threaded': server.ThreadedServer,
+    'evented': server.EventedServer,
+    'prefork': server.PreforkServer,
+}
+
+
+def _engine():
+    engine = os.environ.get('RESTYTEST_DB_ENGINE', 'sqlite')
+    if engine not in ('sqlite', 'memory'):
+        raise ValueError("Unknown RESTYTEST_DB_ENGINE {!r}".format(engine))
+    return engine
+
+
+def _in_process():
+    """Whether the data lives only in this process's memory."""
+    return _engine() == 'memory' or storage.is_memory(
+        os.environ.get('RESTYTEST_DB_URI', storage.MEMORY_URI))
+
+
+def _storage():
+    if _engine() == 'memory':
+        db = storage.MemoryStorage()
+    else:
+        db = storage.Storage(
+            os.environ.get('RESTYTEST_DB_URI', storage.MEMORY_URI),
+            os.environ.get('RESTYTEST_DB_PROFILE', storage.DEFAULT_PROFILE),
+            commit_batch=int(os.environ.get('RESTYTEST_COMMIT_BATCH', 1)),
+            commit_window=float(os.environ.get('RESTYTEST_COMMIT_WINDOW', 0))
+        )
+    cache_size = int(os.environ.get('RESTYTEST_CACHE_SIZE', 0))
+    if cache_size:
+        cache_ttl = float(os.environ.get('RESTYTEST_CACHE_TTL', 0))
+        db = storage.CachingStorage(db, cache_size, ttl=cache_ttl or None)
+    return db
+
+
+def _watch(db):
+    metrics.watch(db)
+    tracing.watch(db)
+
+
+def _tracing(wsgi_app):
+    return tracing.Middleware(
+        wsgi_app,
+        timing=os.environ.get('RESTYTEST_SERVER_TIMING', 'never'),
+        profile_dir=os.environ.get('RESTYTEST_PROFILE_DIR') or None,
+        profile_sample=float(os.environ.get('RESTYTEST_PROFILE_SAMPLE', 0)),
+        profile_secret=os.environ.get('RESTYTEST_PROFILE_SECRET') or None
+    )
+
+
+def _admission(wsgi_app, registry):
+    queue = int(os.environ.get('RESTYTEST_ADMISSION_QUEUE', 0))
+    budget = float(os.environ.get('RESTYTEST_LATENCY_BUDGET', 0)) or None
+    limits = {
+        admission.READ: int(os.environ.get('RESTYTEST_MAX_READS', 0)),
+        admission.WRITE: int(os.environ.get('RESTYTEST_MAX_WRITES', 0)),
+    }
+    quota = int(os.environ.get('RESTYTEST_CLIENT_QUOTA', 0))
+    return admission.Middleware(
+        wsgi_app,
+        dict((route_class, admission.Gate(limit, queue, budget))
+             for route_class, limit in limits.items() if limit),
+        admission.ClientQuota(
+            quota, os.environ.get('RESTYTEST_CLIENT_HEADER') or None
+        ) if quota else None,
+        registry
+    )
+
 
 app = bottle.default_app()
-cntrlr = controller.Controller()
+json_codec = codec.get(os.environ.get('RESTYTEST_JSON_CODEC', 'auto'))
+cntrlr = controller.Controller(_storage())
+_watch(cntrlr.db)
+registry = metrics.Metrics()
+admitter = _admission(_tracing(app), registry)
+application = metrics.Middleware(admitter, registry, lambda: cntrlr.db)
+
+
+def error_status(error):
+    for types, status in ERROR_STATUSES:
+        if isinstance(error, types):
+            return status
 
 
 def common_failures(func):
@@ -26,17 +135,78 @@ def common_failures(func):
     def wrapper(*args, **kwargs):
         try:
             return func(*args, **kwargs)
-        except (TypeError, ValueError, exceptions.InvalidIdentifier):
-            bottle.abort(400)
-        except (exceptions.GroupNotFound, exceptions.UserNotFound):
-            bottle.abort(404)
-        except exceptions.ValidationError:
-            bottle.abort(422)
-        except exceptions.ResourceAlreadyExists:
-            bottle.abort(409)
+        except HANDLED_ERRORS as e:
+            bottle.abort(error_status(e))
     return wrapper
 
 
+def _load_json():
+    return json_codec.load(bottle.request.body)
+
+
+def _load_items():
+    if bottle.request.content_type.startswith(NDJSON_MIMETYPE):
+        return [json_codec.loads(line) for line in bottle.request.body
+                if line.strip()]
+    return _load_json()
+
+
+def _page_args():
+    query = bottle.request.query
+    return dict(
+        cursor=query.get('cursor') or None,
+        limit=int(query.get('limit', pagination.DEFAULT_PAGE_SIZE)),
+    )
+
+
+def _atomic():
+    return bottle.request.query.get('atomic', '').lower() in ('1', 'true')
+
+
+def _etag(version):
+    return '"{}"'.format(version)
+
+
+def _etags(header):
+    return [tag.strip() for tag in header.split(',')]
+
+
+def _tagged(model, view):
+    bottle.response.set_header('ETag', _etag(model.version))
+    return view(model)
+
+
+def _not_modified(version_of, entity_id):
+    """A 304 response if If-None-Match names the entity's current version.
+
+    Only the version is read, so an unchanged entity is never loaded whole.
+    """
+    header = bottle.request.headers.get('If-None-Match')
+    if header is None:
+        return None
+    etag = _etag(version_of(entity_id))
+    # If-None-Match compares weakly, ignoring any W/ prefix.
+    tags = [tag[2:] if tag.startswith('W/') else tag for tag in _etags(header)]
+    if header.strip() == '*' or etag in tags:
+        return bottle.HTTPResponse(status=304, ETag=etag)
+
+
+def _if_match():
+    """Versions If-Match allows a write at, or None if it allows any."""
+    header = bottle.request.headers.get('If-Match')
+    if header is None or header.strip() == '*':
+        return None
+    versions = []
+    # If-Match compares strongly, so weak tags never match.
+    for tag in _etags(header):
+        if len(tag) > 1 and tag[0] == tag[-1] == '"':
+            try:
+                versions.append(int(tag[1:-1]))
+            except ValueError:
+                pass
+    return versions
+
+
 @bottle.hook('after_request')
 def set_content_type():
     bottle.response.set_header("Content-Type", API_MIMETYPE)
@@ -50,62 +220,186 @@ def handle500(error):
 @app.post(USERS_ROUTE)
 @common_failures
 def create_user():
-    request_json = json.load(bottle.request.body)
-    return views.user(cntrlr.create_user(request_json))
+    request_json = _load_json()
+    return _tagged(cntrlr.create_user(request_json), views.user_json)
+
+
+@app.get(USERS_ROUTE)
+@common_failures
+def list_users():
+    return views.page("userids", cntrlr.list_users(**_page_args()))
+
+
+@app.post(USERS_BULK_ROUTE)
+@common_failures
+def create_users():
+    results = cntrlr.create_users(_load_items(), atomic=_atomic())
+    return views.bulk_json(results, views.user_json, error_status)
 
 
 @app.get(USER_ROUTE)
 @common_failures
 def get_user(userid):
-    return views.user(cntrlr.get_user(userid))
+    not_modified = _not_modified(cntrlr.user_version, userid)
+    if not_modified is not None:
+        return not_modified
+    return _tagged(cntrlr.get_user(userid), views.user_json)
 
 
 @app.put(USER_ROUTE)
 @common_failures
 def update_user(userid):
-    request_json = json.load(bottle.request.body)
-    return views.user(cntrlr.update_user(userid, request_json))
+    request_json = _load_json()
+    user = cntrlr.update_user(userid, request_json, if_match=_if_match())
+    return _tagged(user, views.user_json)
 
 
 @app.delete(USER_ROUTE)
 @common_failures
 def delete_user(userid):
-    cntrlr.delete_user(userid)
+    cntrlr.delete_user(userid, if_match=_if_match())
     bottle.response.status = 204
 
 
 @app.post(GROUPS_ROUTE)
 @common_failures
 def create_group():
-    request_json = json.load(bottle.request.body)
-    return views.group(cntrlr.create_group(request_json))
+    request_json = _load_json()
+    return _tagged(cntrlr.create_group(request_json), views.group_json)
+
+
+@app.get(GROUPS_ROUTE)
+@common_failures
+def list_groups():
+    return views.page("names", cntrlr.list_groups(**_page_args()))
+
+
+@app.post(GROUPS_BULK_ROUTE)
+@common_failures
+def create_groups():
+    results = cntrlr.create_groups(_load_items(), atomic=_atomic())
+    return views.bulk_json(results, views.group_json, error_status)
 
 
 @app.get(GROUP_ROUTE)
 @common_failures
 def get_group(group_name):
-    return views.group(cntrlr.get_group(group_name))
+    not_modified = _not_modified(cntrlr.group_version, group_name)
+    if not_modified is not None:
+        return not_modified
+    return _tagged(cntrlr.get_group(group_name), views.group_json)
 
 
 @app.put(GROUP_ROUTE)
 @common_failures
 def update_group(group_name):
-    request_json = json.load(bottle.request.body)
-    return views.group(cntrlr.update_group(group_name, request_json))
+    request_json = _load_json()
+    group = cntrlr.update_group(group_name, request_json,
+                                if_match=_if_match())
+    return _tagged(group, views.group_json)
 
 
 @app.delete(GROUP_ROUTE)
 @common_failures
 def delete_group(group_name):
-    cntrlr.delete_group(group_name)
+    cntrlr.delete_group(group_name, if_match=_if_match())
+    bottle.response.status = 204
+
+
+@app.get(MEMBERS_ROUTE)
+@common_failures
+def list_members(group_name):
+    return views.page("userids",
+                      cntrlr.list_members(group_name, **_page_args()))
+
+
+@app.post(MEMBERS_ROUTE)
+@common_failures
+def update_members(group_name):
+    request_json = _load_json()
+    cntrlr.update_members(group_name, request_json)
+    bottle.response.status = 204
+
+
+@app.post(MEMBER_ROUTE)
+@common_failures
+def add_member(group_name, userid):
+    cntrlr.add_member(group_name, userid)
     bottle.response.status = 204
 
 
+@app.delete(MEMBER_ROUTE)
+@common_failures
+def remove_member(group_name, userid):
+    cntrlr.remove_member(group_name, userid)
+    bottle.response.status = 204
+
+
+def _reconnect():
+    cntrlr.db = _storage()
+    _watch(cntrlr.db)
+
+
+def _server_options(mode):
+    if mode not in SERVERS:
+        raise ValueError("Unknown RESTYTEST_SERVER {!r}".format(mode))
+    if mode == 'wsgiref':
+        return {}
+    options = dict(
+        workers=int(os.environ.get('RESTYTEST_WORKERS',
+                                   server.DEFAULT_WORKERS)),
+    )
+    if mode == 'prefork':
+        # Every worker process has its own storage, so they only agree when
+        # they share a database file and have no cache.
+        if _in_process():
+            raise ValueError("prefork requires a file RESTYTEST_DB_URI")
+        if int(os.environ.get('RESTYTEST_CACHE_SIZE', 0)):
+            raise ValueError("prefork can't be used with RESTYTEST_CACHE_SIZE")
+        options['on_fork'] = _reconnect
+        return options
+    # A prefork worker serves one request at a time, so only a pool of threads
+    # can be filled by requests waiting at a gate.
+    admission.check_workers(admitter.gates, options['workers'])
+    if mode == 'evented':
+        options['idle_timeout'] = float(os.environ.get(
+            'RESTYTEST_IDLE_TIMEOUT', evented.IDLE_TIMEOUT)) or None
+    return options
+
+
+def _start_snapshots():
+    path = os.environ.get('RESTYTEST_SNAPSHOT_PATH')
+    if not path:
+        return None
+    if _engine() == 'memory':
+        raise ValueError("Snapshots require RESTYTEST_DB_ENGINE=sqlite")
+    snapshots = snapshot.Snapshotter(
+        cntrlr.db, path,
+        float(os.environ.get('RESTYTEST_SNAPSHOT_INTERVAL', 0)) or None
+    )
+    if _in_process():
+        snapshots.restore()
+    snapshots.start()
+    # SIGUSR1 takes a snapshot on demand, off the thread that's serving
+    # requests.
+    signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(
+        target=snapshots.snapshot).start())
+    return snapshots
+
+
 def serve():
-    app.run(
+    mode = os.environ.get('RESTYTEST_SERVER', 'wsgiref')
+    options = _server_options(mode)
+    snapshots = _start_snapshots()
+    bottle.run(
+        application,
+        server=SERVERS.get(mode),
         host=os.environ.get('RESTYTEST_HOST', 'localhost'),
-        port=os.environ.get('RESTYTEST_PORT', 8080)
+        port=os.environ.get('RESTYTEST_PORT', 8080),
+        **options
     )
+    if snapshots:
+        snapshots.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,65 @@
+""" JSON codecs for request and response bodies """
+
+import collections
+import json
+from json import encoder
+
+
+# The C-accelerated string escaper behind json.dumps, used to write views
+# straight to JSON. Its ASCII-only output needs no re-encoding.
+encode_string = encoder.encode_basestring_ascii
+
+
+class Codec(object):
+    """A JSON implementation: ``loads`` raises ValueError on malformed input
+    and ``dumps`` returns a byte string.
+    """
+
+    def __init__(self, name, loads, dumps):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+    def load(self, fp):
+        return self.loads(fp.read())
+
+
+def _ujson():
+    import ujson
+    return Codec('ujson', ujson.loads, ujson.dumps)
+
+
+def _simplejson():
+    import simplejson
+    return Codec('simplejson', simplejson.loads,
+                 lambda obj: simplejson.dumps(obj, separators=(',', ':')))
+
+
+def _stdlib():
+    return Codec('json', json.loads,
+                 lambda obj: json.dumps(obj, separators=(',', ':')))
+
+
+# From fastest to slowest; "auto" uses the first installed.
+CODECS = collections.OrderedDict([
+    ('ujson', _ujson),
+    ('simplejson', _simplejson),
+    ('json', _stdlib),
+])
+
+
+def get(name='auto'):
+    """The codec called ``name``, or the fastest one installed for "auto".
+
+    Raises ValueError for unknown names and ImportError if the named codec
+    isn't installed.
+    """
+    if name == 'auto':
+        for make in CODECS.values():
+            try:
+                return make()
+            except ImportError:
+                pass
+    if name not in CODECS:
+        raise ValueError("Unknown JSON codec {!r}".format(name))
+    return CODECS[name]()
@@ -1,15 +1,19 @@
 """ RestyTest Controller """
 
+from sqlalchemy import exc as sa_exc
+
 from restytest import exceptions
 from restytest import models
 from restytest import storage
+from restytest.api import pagination
+from restytest.api import tracing
 from restytest.api import validations
 
 
 def _to_group(group_name, data):
     return models.Group(
         group_id=group_name,
-        users=[u for u in data.get('userids', [])]
+        users=data.get('userids')
     )
 
 
@@ -18,13 +22,36 @@ def _to_user(data):
         user_id=data['userid'],
         first_name=data['first_name'],
         last_name=data['last_name'],
-        groups=[g for g in data['groups']]
+        groups=data['groups']
     )
 
 
+def _bulk_entities(items, validate, convert):
+    """Validate and convert a batch, keeping failures in place."""
+    entities = []
+    failures = []
+    for data in items:
+        try:
+            validate(data)
+            entities.append(convert(data))
+            failures.append(None)
+        except (exceptions.ValidationError, KeyError, TypeError):
+            entities.append(None)
+            failures.append(exceptions.ValidationError())
+    return entities, failures
+
+
+def _bulk_create(create, entities, failures, atomic):
+    if atomic and any(failures):
+        return [f if f else exceptions.BatchAborted() for f in failures]
+    valid = [e for e, f in zip(entities, failures) if not f]
+    created = iter(create(valid, atomic=atomic))
+    return [f if f else next(created) for f in failures]
+
+
 class Controller(object):
-    def __init__(self):
-        self.db = storage.Storage()
+    def __init__(self, db=None):
+        self.db = db if db else storage.Storage()
 
     def _get_user_or_raise(self, userid):
         user = self.db.get_user(userid)
@@ -38,48 +65,157 @@ class Controller(object):
             raise exceptions.GroupNotFound()
         return group
 
+    def _ensure_group(self, group_name):
+        if not self.db.group_exists(group_name):
+            raise exceptions.GroupNotFound()
+
+    @staticmethod
+    def _conflict(version_of, entity_id, missing):
+        """What an IntegrityError from writing ``entity_id`` came from.
+
+        Writes aren't preceded by reads to rule conflicts out; this is only
+        read once one has failed.
+        """
+        if version_of(entity_id) is not None:
+            return exceptions.ResourceAlreadyExists()
+        return missing()
+
+    @tracing.traced('controller', describe=True)
     def create_user(self, data):
         validations.validate_user(data)
         user = _to_user(data)
-        if self.db.get_user(user.user_id):
-            raise exceptions.ResourceAlreadyExists()
-        return self.db.create_user(user)
-
+        try:
+            return self.db.create_user(user)
+        except sa_exc.IntegrityError:
+            raise self._conflict(self.db.get_user_version, user.user_id,
+                                 exceptions.GroupNotFound)
+
+    @tracing.traced('controller', describe=True)
+    def list_users(self, cursor=None,
+                   limit=pagination.DEFAULT_PAGE_SIZE):
+        pagination.validate_page_size(limit)
+        after = pagination.decode_cursor(cursor) if cursor else None
+        return pagination.Page(self.db.list_user_ids(after, limit + 1), limit)
+
+    @tracing.traced('controller', describe=True)
+    def create_users(self, items, atomic=False):
+        validations.validate_bulk(items)
+        entities, failures = _bulk_entities(
+            items, validations.validate_user, _to_user)
+        return _bulk_create(self.db.create_users, entities, failures, atomic)
+
+    @tracing.traced('controller', describe=True)
     def get_user(self, userid):
         validations.validate_userid(userid)
         return self._get_user_or_raise(userid)
 
-    def update_user(self, userid, data):
+    @tracing.traced('controller', describe=True)
+    def user_version(self, userid):
+        validations.validate_userid(userid)
+        version = self.db.get_user_version(userid)
+        if version is None:
+            raise exceptions.UserNotFound()
+        return version
+
+    @tracing.traced('controller', describe=True)
+    def update_user(self, userid, data, if_match=None):
         validations.validate_user(data)
         validations.validate_userid(userid)
         user = _to_user(data)
-        self._get_user_or_raise(userid)
-        return self.db.update_user(userid, user)
-
-    def delete_user(self, userid):
+        try:
+            return self.db.update_user(userid, user, if_match)
+        except sa_exc.IntegrityError:
+            if user.user_id == userid:
+                raise exceptions.GroupNotFound()
+            raise self._conflict(self.db.get_user_version, user.user_id,
+                                 exceptions.GroupNotFound)
+
+    @tracing.traced('controller', describe=True)
+    def delete_user(self, userid, if_match=None):
         validations.validate_userid(userid)
-        self._get_user_or_raise(userid)
-        self.db.delete_user(userid)
+        self.db.delete_user(userid, if_match)
 
+    @tracing.traced('controller', describe=True)
     def create_group(self, data):
         validations.validate_group_post(data)
         group = _to_group(data['name'], data)
-        if self.db.get_group(group.group_id):
-            raise exceptions.ResourceAlreadyExists()
-        return self.db.create_group(group)
-
+        try:
+            return self.db.create_group(group)
+        except sa_exc.IntegrityError:
+            raise self._conflict(self.db.get_group_version, group.group_id,
+                                 exceptions.UserNotFound)
+
+    @tracing.traced('controller', describe=True)
+    def list_groups(self, cursor=None,
+                    limit=pagination.DEFAULT_PAGE_SIZE):
+        pagination.validate_page_size(limit)
+        after = pagination.decode_cursor(cursor) if cursor else None
+        return pagination.Page(self.db.list_group_ids(after, limit + 1),
+                               limit)
+
+    @tracing.traced('controller', describe=True)
+    def create_groups(self, items, atomic=False):
+        validations.validate_bulk(items)
+        entities, failures = _bulk_entities(
+            items, validations.validate_group_post,
+            lambda data: _to_group(data['name'], data))
+        return _bulk_create(self.db.create_groups, entities, failures, atomic)
+
+    @tracing.traced('controller', describe=True)
     def get_group(self, group_name):
         validations.validate_group_name(group_name)
         return self._get_group_or_raise(group_name)
 
-    def update_group(self, group_name, data):
+    @tracing.traced('controller', describe=True)
+    def group_version(self, group_name):
+        validations.validate_group_name(group_name)
+        version = self.db.get_group_version(group_name)
+        if version is None:
+            raise exceptions.GroupNotFound()
+        return version
+
+    @tracing.traced('controller', describe=True)
+    def update_group(self, group_name, data, if_match=None):
         validations.validate_group_put(data)
         validations.validate_group_name(group_name)
         group = _to_group(group_name, data)
-        self._get_group_or_raise(group_name)
-        return self.db.update_group(group_name, group)
+        try:
+            return self.db.update_group(group_name, group, if_match)
+        except sa_exc.IntegrityError:
+            raise exceptions.UserNotFound()
+
+    @tracing.traced('controller', describe=True)
+    def delete_group(self, group_name, if_match=None):
+        validations.validate_group_name(group_name)
+        self.db.delete_group(group_name, if_match)
+
+    @tracing.traced('controller', describe=True)
+    def list_members(self, group_name, cursor=None,
+                     limit=pagination.DEFAULT_PAGE_SIZE):
+        validations.validate_group_name(group_name)
+        pagination.validate_page_size(limit)
+        after = pagination.decode_cursor(cursor) if cursor else None
+        self._ensure_group(group_name)
+        return pagination.Page(
+            self.db.list_member_ids(group_name, after, limit + 1), limit)
+
+    @tracing.traced('controller', describe=True)
+    def add_member(self, group_name, userid):
+        validations.validate_group_name(group_name)
+        validations.validate_userid(userid)
+        self.db.update_members(group_name, add=[userid])
+
+    @tracing.traced('controller', describe=True)
+    def remove_member(self, group_name, userid):
+        validations.validate_group_name(group_name)
+        validations.validate_userid(userid)
+        if not self.db.remove_member(group_name, userid):
+            self._ensure_group(group_name)
+            raise exceptions.UserNotFound()
 
-    def delete_group(self, group_name):
+    @tracing.traced('controller', describe=True)
+    def update_members(self, group_name, data):
+        validations.validate_group_members(data)
         validations.validate_group_name(group_name)
-        self._get_group_or_raise(group_name)
-        self.db.delete_group(group_name)
+        self.db.update_members(group_name, add=data.get('add', []),
+                               remove=data.get('remove', []))
@@ -0,0 +1,521 @@
+""" Event loop HTTP server handing complete requests to worker threads """
+
+import asyncore
+import collections
+import errno
+import fcntl
+import os
+import Queue
+import re
+import select
+import socket
+import StringIO
+import sys
+import threading
+import time
+import traceback
+import urllib
+import urlparse
+
+
+MAX_HEAD_BYTES = 64 * 1024
+MAX_BODY_BYTES = 16 * 1024 * 1024
+READ_SIZE = 64 * 1024
+SEND_SIZE = 256 * 1024
+LISTEN_BACKLOG = 1024
+ACCEPT_BATCH = 256
+POLL_TIMEOUT = 0.5
+DRAIN_TIMEOUT = 10.0
+IDLE_TIMEOUT = 60.0
+
+INTERNAL_ERROR = 'Internal server error'
+CONTINUE = 'HTTP/1.1 100 Continue\r\n\r\n'
+BODILESS_STATUSES = ('1', '204', '304')
+
+# Lines should end in CRLF, but a bare LF is accepted as well, as RFC 7230 asks
+# of a server.
+_LINE_END = re.compile(r'\r?\n')
+_HEAD_END = re.compile(r'\r?\n\r?\n')
+
+
+class _Rejected(Exception):
+    """A request that can't be handed to the application."""
+
+    def __init__(self, status):
+        Exception.__init__(self, status)
+        self.status = status
+
+
+def _headers(lines):
+    for line in lines:
+        name, separator, value = line.partition(':')
+        if not separator:
+            raise _Rejected('400 Bad Request')
+        yield name.strip().upper().replace('-', '_'), value.strip()
+
+
+def _environ(head, server_address, client_address):
+    """The WSGI environ of a request head, without its body."""
+    lines = _LINE_END.split(head)
+    request_line = lines[0].split()
+    if len(request_line) != 3 or not request_line[2].startswith('HTTP/'):
+        raise _Rejected('400 Bad Request')
+    method, target, protocol = request_line
+    authority = None
+    if not target.startswith('/') and '://' in target:
+        # An absolute-form target, as sent to proxies; the application only
+        # routes on its path.
+        parts = urlparse.urlsplit(target)
+        authority = parts.netloc
+        target = '{}?{}'.format(parts.path or '/', parts.query)
+    path, _, query = target.partition('?')
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': urllib.unquote(path),
+        'QUERY_STRING': query,
+        'SERVER_NAME': server_address[0],
+        'SERVER_PORT': str(server_address[1]),
+        'SERVER_PROTOCOL': protocol,
+        'REMOTE_ADDR': client_address[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in _headers(lines[1:]):
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = '{},{}'.format(environ[name], value)
+        environ[name] = value
+    if authority:
+        environ['HTTP_HOST'] = authority
+    return environ
+
+
+def _content_length(environ):
+    # Bodies are buffered whole before the application sees them, so they must
+    # say how long they are up front.
+    if 'HTTP_TRANSFER_ENCODING' in environ:
+        raise _Rejected('411 Length Required')
+    try:
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        raise _Rejected('400 Bad Request')
+    if length < 0:
+        raise _Rejected('400 Bad Request')
+    if length > MAX_BODY_BYTES:
+        raise _Rejected('413 Request Entity Too Large')
+    return length
+
+
+def _keep_alive(environ):
+    return (environ['SERVER_PROTOCOL'] == 'HTTP/1.1' and
+            environ.get('HTTP_CONNECTION', '').lower() != 'close')
+
+
+def _response(status, headers, body, keep_alive):
+    names = set(name.lower() for name, _ in headers)
+    lines = ['HTTP/1.1 ' + status]
+    lines.extend('{}: {}'.format(name, value) for name, value in headers)
+    if ('content-length' not in names and
+            not status.startswith(BODILESS_STATUSES)):
+        lines.append('Content-Length: {}'.format(len(body)))
+    if not keep_alive:
+        lines.append('Connection: close')
+    return '\r\n'.join(lines) + '\r\n\r\n' + body
+
+
+def call_application(application, environ):
+    """Run a WSGI application to completion on the calling thread.
+
+    Returns the status, headers and the whole body, after closing the
+    application's iterable.
+    """
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        if exc_info and started:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        started[:] = [status, list(headers)]
+
+    body = application(environ, start_response)
+    try:
+        data = ''.join(body)
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+    status, headers = started
+    return status, headers, data
+
+
+class _PollMap(dict):
+    """asyncore socket map whose dispatchers are registered with epoll.
+
+    Each dispatcher is registered once, as asyncore adds it to the map, and
+    what it's polled for only changes when watch() finds it readable or
+    writable for something else. A turn of the loop therefore costs the
+    events that happened, not a readable() and writable() call for every
+    open connection as asyncore.poll2 makes.
+    """
+
+    def __init__(self):
+        dict.__init__(self)
+        self._epoll = select.epoll()
+        self._masks = {}
+
+    def __setitem__(self, fd, dispatcher):
+        dict.__setitem__(self, fd, dispatcher)
+        self._masks[fd] = 0
+        self._epoll.register(fd, 0)
+
+    def __delitem__(self, fd):
+        dict.__delitem__(self, fd)
+        del self._masks[fd]
+        self._epoll.unregister(fd)
+
+    def watch(self, dispatcher):
+        """Poll ``dispatcher`` for what it's readable or writable for now."""
+        fd = dispatcher._fileno
+        if fd not in self._masks:
+            return
+        mask = 0
+        if dispatcher.readable():
+            mask |= select.EPOLLIN | select.EPOLLPRI
+        if dispatcher.writable():
+            mask |= select.EPOLLOUT
+        if mask != self._masks[fd]:
+            self._masks[fd] = mask
+            self._epoll.modify(fd, mask)
+
+    def poll(self, timeout):
+        try:
+            events = self._epoll.poll(timeout)
+        except IOError as e:
+            if e.errno != errno.EINTR:
+                raise
+            return
+        # An earlier event can close a dispatcher and a connection accepted
+        # after it can reuse its fd, so the events are matched to dispatchers
+        # before any is handled.
+        for dispatcher, flags in [(self.get(fd), flags)
+                                  for fd, flags in events]:
+            if dispatcher is not None and (
+                    self.get(dispatcher._fileno) is dispatcher):
+                asyncore.readwrite(dispatcher, flags)
+                self.watch(dispatcher)
+
+    def close(self):
+        self._epoll.close()
+
+
+class _Waker(asyncore.file_dispatcher):
+    """Runs callables on the loop's thread, queued from any thread."""
+
+    def __init__(self, socket_map):
+        read_fd, self._write_fd = os.pipe()
+        fcntl.fcntl(self._write_fd, fcntl.F_SETFL, os.O_NONBLOCK)
+        asyncore.file_dispatcher.__init__(self, read_fd, map=socket_map)
+        os.close(read_fd)
+        self._calls = collections.deque()
+        socket_map.watch(self)
+
+    def call(self, func, *args):
+        self._calls.append((func, args))
+        try:
+            os.write(self._write_fd, 'x')
+        except OSError as e:
+            # A full pipe already has the loop's attention.
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        while self._calls:
+            func, args = self._calls.popleft()
+            try:
+                func(*args)
+            except Exception:
+                # Left to asyncore, the error would close the waker and strand
+                # every response queued after it; only the connection it was
+                # for is closed.
+                traceback.print_exc()
+                owner = getattr(func, '__self__', None)
+                if isinstance(owner, _Connection):
+                    owner.close()
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self._write_fd)
+
+
+class _Workers(object):
+    """A fixed pool of threads running submitted calls in order."""
+
+    def __init__(self, count):
+        self._calls = Queue.Queue()
+        self._threads = [threading.Thread(target=self._work)
+                         for _ in range(count)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, func, *args):
+        self._calls.put((func, args))
+
+    def _work(self):
+        while True:
+            item = self._calls.get()
+            if item is None:
+                return
+            func, args = item
+            func(*args)
+
+    def stop(self):
+        for _ in self._threads:
+            self._calls.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+class _Connection(asyncore.dispatcher):
+    """One client connection, serving its requests one at a time.
+
+    The connection isn't read while the workers have one of its requests,
+    so pipelined requests wait in the socket and are answered in order.
+    Otherwise it's closed once nothing has been read from or written to it
+    for the server's idle timeout, between requests or partway through one.
+    """
+
+    def __init__(self, sock, client_address, server):
+        asyncore.dispatcher.__init__(self, sock, map=server.socket_map)
+        self.client_address = client_address
+        self.server = server
+        self.busy = False
+        self._closing = False
+        self._buffer = ''
+        self._environ = None
+        self._length = 0
+        self._body = []
+        self._body_bytes = 0
+        self._out = collections.deque()
+        self._sent = 0
+        self.last_active = time.time()
+        server.socket_map.watch(self)
+
+    def readable(self):
+        return self.connected and not self.busy and not self._closing
+
+    def writable(self):
+        return bool(self._out)
+
+    def handle_read(self):
+        data = self.recv(READ_SIZE)
+        if not data:
+            return
+        self.last_active = time.time()
+        if self._environ is None:
+            self._buffer += data
+        else:
+            self._body.append(data)
+            self._body_bytes += len(data)
+        self._consume()
+
+    def _consume(self):
+        try:
+            while self.readable() and self._read_head() and self._read_body():
+                self._dispatch()
+        except _Rejected as e:
+            self.respond(e.status, [('Content-Type', 'text/plain')],
+                         e.status, False)
+
+    def _read_head(self):
+        if self._environ is not None:
+            return True
+        self._buffer = self._buffer.lstrip('\r\n')
+        end = _HEAD_END.search(self._buffer)
+        if end is None:
+            if len(self._buffer) > MAX_HEAD_BYTES:
+                raise _Rejected('431 Request Header Fields Too Large')
+            return False
+        environ = _environ(self._buffer[:end.start()], self.server.address,
+                           self.client_address)
+        self._length = _content_length(environ)
+        self._environ = environ
+        self._body = [self._buffer[end.end():]]
+        self._body_bytes = len(self._body[0])
+        self._buffer = ''
+        if self._length and environ.get('HTTP_EXPECT') == '100-continue':
+            self._write(CONTINUE)
+        return True
+
+    def _read_body(self):
+        if self._body_bytes < self._length:
+            return False
+        data = ''.join(self._body)
+        self._environ['wsgi.input'] = StringIO.StringIO(data[:self._length])
+        self._buffer = data[self._length:]
+        return True
+
+    def _dispatch(self):
+        environ, self._environ = self._environ, None
+        self._body = []
+        self._body_bytes = 0
+        self.busy = True
+        self.server.workers.submit(self.server.handle, self, environ)
+
+    def respond(self, status, headers, body, keep_alive):
+        """Queue a response and read the next request, on the loop thread."""
+        self.busy = False
+        if not self.connected:
+            return
+        self._closing = not keep_alive
+        self.last_active = time.time()
+        self._write(_response(status, headers, body, keep_alive))
+        self._consume()
+        self.server.socket_map.watch(self)
+
+    def _write(self, data):
+        self._out.append(data)
+        self.handle_write()
+
+    def handle_write(self):
+        data = self._out[0]
+        sent = self.send(data[self._sent:self._sent + SEND_SIZE])
+        if sent:
+            self._sent += sent
+            self.last_active = time.time()
+        if self._sent < len(data):
+            return
+        self._out.popleft()
+        self._sent = 0
+        if self._closing and not self._out:
+            self.close()
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        traceback.print_exc()
+        self.close()
+
+
+class _Listener(asyncore.dispatcher):
+    def __init__(self, address, server):
+        asyncore.dispatcher.__init__(self, map=server.socket_map)
+        self.server = server
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(address)
+        self.listen(LISTEN_BACKLOG)
+        server.socket_map.watch(self)
+
+    def handle_accept(self):
+        # Take every connection that's waiting rather than one per turn of the
+        # loop, so a burst of clients isn't let in one turn at a time.
+        for _ in range(ACCEPT_BATCH):
+            pair = self.accept()
+            if pair is None:
+                return
+            _Connection(pair[0], pair[1], self.server)
+
+    def handle_error(self):
+        # Typically out of file descriptors; the connection stays in the
+        # backlog and the listener must keep going.
+        traceback.print_exc()
+
+
+class EventedWSGIServer(object):
+    """HTTP server multiplexing connections on one thread with epoll.
+
+    Request heads and bodies are read as they arrive, however slowly, and
+    responses written as the client takes them, without holding a thread.
+    Only a complete request is handed to one of ``workers`` threads, which
+    runs ``application`` -- storage access included -- and gives the whole
+    response back to the loop. A slow client therefore costs a socket and
+    its buffers, not a worker -- until it has sent or taken nothing for
+    ``idle_timeout`` seconds, when its connection is closed, as are idle
+    keep-alive connections. None leaves them open.
+    """
+
+    def __init__(self, address, application, workers, quiet=False,
+                 idle_timeout=IDLE_TIMEOUT):
+        self.socket_map = _PollMap()
+        self.application = application
+        self.quiet = quiet
+        self.idle_timeout = idle_timeout
+        self._stopping = False
+        self._next_sweep = 0
+        self._waker = _Waker(self.socket_map)
+        self._listener = _Listener(address, self)
+        self.address = self._listener.socket.getsockname()
+        self.server_port = self.address[1]
+        self.workers = _Workers(workers)
+
+    def handle(self, connection, environ):
+        """Serve one request; called on a worker thread."""
+        keep_alive = _keep_alive(environ)
+        try:
+            status, headers, body = call_application(
+                self.application, environ)
+        except Exception:
+            traceback.print_exc()
+            status, headers, body = ('500 Internal Server Error',
+                                     [('Content-Type', 'text/plain')],
+                                     INTERNAL_ERROR)
+            keep_alive = False
+        self._log(environ, status, len(body))
+        self._waker.call(connection.respond, status, headers, body,
+                         keep_alive)
+
+    def _log(self, environ, status, size):
+        if not self.quiet:
+            sys.stderr.write('{} - - [{}] "{} {} {}" {} {}\n'.format(
+                environ['REMOTE_ADDR'], time.strftime('%d/%b/%Y %H:%M:%S'),
+                environ['REQUEST_METHOD'], environ['PATH_INFO'],
+                environ['SERVER_PROTOCOL'], status.split(' ', 1)[0], size))
+
+    def _close_idle(self):
+        # Looking over every connection is only done once per POLL_TIMEOUT, not
+        # once per turn of the loop.
+        now = time.time()
+        if self.idle_timeout is None or now < self._next_sweep:
+            return
+        self._next_sweep = now + POLL_TIMEOUT
+        cutoff = now - self.idle_timeout
+        for connection in self.socket_map.values():
+            if (isinstance(connection, _Connection) and not connection.busy
+                    and connection.last_active < cutoff):
+                connection.close()
+
+    def _in_flight(self):
+        return any(isinstance(c, _Connection) and (c.busy or c.writable())
+                   for c in self.socket_map.values())
+
+    def serve_forever(self):
+        while not self._stopping:
+            self.socket_map.poll(POLL_TIMEOUT)
+            self._close_idle()
+        # Stop accepting, then give requests already read a chance to be
+        # answered before the connections are closed.
+        self._listener.close()
+        deadline = time.time() + DRAIN_TIMEOUT
+        while self._in_flight() and time.time() < deadline:
+            self.socket_map.poll(POLL_TIMEOUT)
+
+    def shutdown(self):
+        """Make serve_forever return; safe to call from any thread."""
+        self._waker.call(setattr, self, '_stopping', True)
+
+    def server_close(self):
+        # Workers answer through the waker, so they have to finish before it is
+        # closed.
+        self.workers.stop()
+        asyncore.close_all(self.socket_map)
+        self.socket_map.close()
@@ -0,0 +1,243 @@
+""" Request instrumentation exposed in Prometheus text format """
+
+import bisect
+import threading
+import time
+
+import sqlalchemy as sa
+
+from restytest.api import wsgi
+
+
+METRICS_PATH = '/metrics'
+METRICS_MIMETYPE = 'text/plain; version=0.0.4'
+UNMATCHED_ROUTE = 'unmatched'
+STATEMENTS_KEY = 'restytest.statements'
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = tuple(64 * 4 ** i for i in range(10))
+STATEMENT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128)
+
+_statements = threading.local()
+
+
+def _count_statement(*args):
+    _statements.count = statement_count() + 1
+
+
+def statement_count():
+    """Statements this thread has executed on watched storage."""
+    return getattr(_statements, 'count', 0)
+
+
+def watch(db):
+    """Count the statements ``db`` executes, if it runs SQL at all."""
+    engine = getattr(db, 'engine', None)
+    if engine is not None and not sa.event.contains(
+            engine, 'before_cursor_execute', _count_statement):
+        sa.event.listen(engine, 'before_cursor_execute', _count_statement)
+
+
+class Histogram(object):
+    """Counts of observations at or below each bucket bound."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def cumulative(self):
+        """(bound, count) pairs as Prometheus exposes them, ending at +Inf."""
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield bound, total
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', r'\\')
+                         .replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in pairs))
+
+
+def _histogram_lines(name, help_text, label_names, histograms):
+    yield '# HELP {} {}'.format(name, help_text)
+    yield '# TYPE {} histogram'.format(name)
+    for values in sorted(histograms):
+        histogram = histograms[values]
+        for bound, count in histogram.cumulative():
+            yield '{}_bucket{} {}'.format(
+                name, _labels(label_names, values, [('le', bound)]), count)
+        labels = _labels(label_names, values)
+        yield '{}_sum{} {}'.format(name, labels, histogram.sum)
+        yield '{}_count{} {}'.format(name, labels, sum(histogram.counts))
+
+
+def _counter_lines(name, help_text, label_names, counts):
+    yield '# HELP {} {}'.format(name, help_text)
+    yield '# TYPE {} counter'.format(name)
+    for values in sorted(counts):
+        yield '{}{} {}'.format(name, _labels(label_names, values),
+                               counts[values])
+
+
+def _scalar_lines(name, kind, help_text, value):
+    yield '# HELP {} {}'.format(name, help_text)
+    yield '# TYPE {} {}'.format(name, kind)
+    yield '{} {}'.format(name, value)
+
+
+class Metrics(object):
+    """Latency, size and statement histograms per route, and counts of
+    requests shed by admission control.
+
+    Everything observed for one request is recorded under a single lock
+    acquisition, which is all the overhead a request pays.
+    """
+
+    def __init__(self):
+        self.in_flight = 0
+        self._latency = {}
+        self._request_size = {}
+        self._response_size = {}
+        self._statements = {}
+        self._shed = {}
+        self._lock = threading.Lock()
+
+    def _observe(self, histograms, key, buckets, value):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def started(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def finished(self, route, method, status, seconds, request_bytes,
+                 response_bytes, statements):
+        with self._lock:
+            self.in_flight -= 1
+            self._observe(self._latency, (route, method, status),
+                          LATENCY_BUCKETS, seconds)
+            self._observe(self._request_size, (route, method),
+                          SIZE_BUCKETS, request_bytes)
+            self._observe(self._response_size, (route, method),
+                          SIZE_BUCKETS, response_bytes)
+            self._observe(self._statements, (route, method),
+                          STATEMENT_BUCKETS, statements)
+
+    def shed(self, route_class, reason):
+        with self._lock:
+            key = (route_class, reason)
+            self._shed[key] = self._shed.get(key, 0) + 1
+
+    def render(self, db=None):
+        with self._lock:
+            lines = list(self._lines())
+        cache = getattr(db, 'cache', None)
+        if cache is not None:
+            lines.extend(self._cache_lines(cache.stats()))
+        return '\n'.join(lines) + '\n'
+
+    def _lines(self):
+        route = ('route', 'method')
+        for line in _histogram_lines(
+                'restytest_request_duration_seconds',
+                'Time to serve a request, including sending its body.',
+                route + ('status',), self._latency):
+            yield line
+        for line in _histogram_lines(
+                'restytest_request_size_bytes', 'Size of request bodies.',
+                route, self._request_size):
+            yield line
+        for line in _histogram_lines(
+                'restytest_response_size_bytes', 'Size of response bodies.',
+                route, self._response_size):
+            yield line
+        for line in _histogram_lines(
+                'restytest_storage_statements',
+                'SQL statements executed per request.',
+                route, self._statements):
+            yield line
+        for line in _counter_lines(
+                'restytest_requests_shed_total',
+                'Requests turned away by admission control.',
+                ('class', 'reason'), self._shed):
+            yield line
+        for line in _scalar_lines(
+                'restytest_requests_in_flight', 'gauge',
+                'Requests being served.', self.in_flight):
+            yield line
+
+    def _cache_lines(self, stats):
+        for key in ('hits', 'misses', 'evictions'):
+            for line in _scalar_lines(
+                    'restytest_cache_{}_total'.format(key), 'counter',
+                    'Storage cache {}.'.format(key), stats[key]):
+                yield line
+        for line in _scalar_lines(
+                'restytest_cache_entries', 'gauge',
+                'Entries in the storage cache.', stats['size']):
+            yield line
+
+
+class Middleware(object):
+    """WSGI middleware recording every request into ``metrics``.
+
+    Requests are labelled with the route rule bottle matched rather than the
+    path, which keeps the number of series bounded. GET ``/metrics`` is
+    answered here, with the cache statistics of ``storage()`` if it has any.
+
+    How many statements a request executed is also left in its environ,
+    under STATEMENTS_KEY, once its body is closed, so tests can hold a route
+    to a budget.
+    """
+
+    def __init__(self, app, metrics, storage=lambda: None):
+        self.app = app
+        self.metrics = metrics
+        self.storage = storage
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') == METRICS_PATH:
+            body = self.metrics.render(self.storage())
+            start_response('200 OK', [('Content-Type', METRICS_MIMETYPE),
+                                      ('Content-Length', str(len(body)))])
+            return [body]
+
+        start = time.time()
+        statements = statement_count()
+        status = []
+
+        def recording_start_response(status_line, headers, exc_info=None):
+            status[:] = [status_line.split(' ', 1)[0]]
+            return start_response(status_line, headers, exc_info)
+
+        def record(response_bytes):
+            route = environ.get('bottle.route')
+            environ[STATEMENTS_KEY] = statement_count() - statements
+            self.metrics.finished(
+                route.rule if route else UNMATCHED_ROUTE,
+                environ.get('REQUEST_METHOD', ''),
+                status[0] if status else '500',
+                time.time() - start,
+                int(environ.get('CONTENT_LENGTH') or 0),
+                response_bytes,
+                environ[STATEMENTS_KEY],
+            )
+
+        self.metrics.started()
+        try:
+            body = self.app(environ, recording_start_response)
+        except Exception:
+            record(0)
+            raise
+        return wsgi.ClosingBody(body, record)
@@ -0,0 +1,52 @@
+""" Keyset pagination helpers """
+
+import base64
+import itertools
+import json
+
+from restytest import exceptions
+
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def encode_cursor(last_id):
+    return base64.urlsafe_b64encode(json.dumps([last_id]))
+
+
+def decode_cursor(cursor):
+    """Return the id a page starts after, raising ValueError if malformed."""
+    try:
+        last_id, = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ValueError("Malformed cursor")
+    if not isinstance(last_id, basestring):
+        raise ValueError("Malformed cursor")
+    return last_id
+
+
+def validate_page_size(limit):
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        raise exceptions.ValidationError()
+
+
+class Page(object):
+    """One page of ids, read from a keyset query as the page is made.
+
+    ``ids`` must yield up to ``limit + 1`` ids in key order; the extra one
+    only signals that another page exists, and sets ``next_cursor``. Reading
+    them up front keeps storage errors in the handler, where they can still
+    be answered with an error status.
+    """
+
+    def __init__(self, ids, limit):
+        self.limit = limit
+        self.next_cursor = None
+        self._ids = list(itertools.islice(ids, limit + 1))
+        if len(self._ids) > limit:
+            del self._ids[limit:]
+            self.next_cursor = encode_cursor(self._ids[-1])
+
+    def __iter__(self):
+        return iter(self._ids)
@@ -0,0 +1,184 @@
+""" WSGI servers for running the API """
+
+import errno
+import os
+import Queue
+import resource
+import signal
+import threading
+import traceback
+from wsgiref import simple_server
+
+import bottle
+
+from restytest.api import evented
+
+
+DEFAULT_WORKERS = 4
+
+
+class _RequestHandler(simple_server.WSGIRequestHandler):
+    quiet = False
+
+    def address_string(self):
+        # Skip the reverse DNS lookup wsgiref does by default.
+        return self.client_address[0]
+
+    def log_request(self, *args, **kwargs):
+        if not self.quiet:
+            simple_server.WSGIRequestHandler.log_request(
+                self, *args, **kwargs)
+
+
+class PooledWSGIServer(simple_server.WSGIServer):
+    """wsgiref server that hands connections to a fixed pool of threads.
+
+    Accepted connections wait in a queue bounded to a few per worker, so a
+    burst backs up into the listen backlog instead of into memory. Closing
+    the server lets the workers finish what was already accepted.
+    """
+
+    def __init__(self, address, handler_class, workers=DEFAULT_WORKERS):
+        simple_server.WSGIServer.__init__(self, address, handler_class)
+        self._requests = Queue.Queue(maxsize=workers * 4)
+        self._workers = [threading.Thread(target=self._work)
+                         for _ in range(workers)]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def _work(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        simple_server.WSGIServer.server_close(self)
+        for _ in self._workers:
+            self._requests.put(None)
+        for worker in self._workers:
+            worker.join()
+
+
+def _shutdown_on(server, signums):
+    # shutdown() blocks until serve_forever() returns, so it can't be called
+    # from the signal handler running on the serving thread.
+    def handler(signum, frame):
+        threading.Thread(target=server.shutdown).start()
+
+    for signum in signums:
+        signal.signal(signum, handler)
+
+
+def _serve(server):
+    _shutdown_on(server, (signal.SIGTERM, signal.SIGINT))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+class ThreadedServer(bottle.ServerAdapter):
+    """Serve requests on a pool of ``workers`` threads in one process."""
+
+    def run(self, handler):
+        _RequestHandler.quiet = self.quiet
+        server = PooledWSGIServer(
+            (self.host, self.port), _RequestHandler,
+            self.options.get('workers', DEFAULT_WORKERS)
+        )
+        server.set_app(handler)
+        _serve(server)
+
+
+def _raise_file_limit():
+    # Every connection holds a file descriptor, and the usual soft limit of
+    # 1024 would cap the connections long before the loop does.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+class EventedServer(bottle.ServerAdapter):
+    """Serve connections from one event loop and requests from a pool of
+    ``workers`` threads, so slow clients don't hold a thread while they
+    send or receive.
+    """
+
+    def run(self, handler):
+        _raise_file_limit()
+        server = evented.EventedWSGIServer(
+            (self.host, self.port), handler,
+            self.options.get('workers', DEFAULT_WORKERS), quiet=self.quiet,
+            idle_timeout=self.options.get('idle_timeout',
+                                          evented.IDLE_TIMEOUT)
+        )
+        _serve(server)
+
+
+class PreforkServer(bottle.ServerAdapter):
+    """Serve requests from ``workers`` processes sharing one listen socket.
+
+    Each worker handles one request at a time. ``on_fork`` is called in every
+    worker before it serves, which is where per-process resources such as
+    database connections must be opened. Workers that exit unexpectedly are
+    replaced; SIGTERM or SIGINT stops every worker after its current request.
+    """
+
+    def run(self, handler):
+        _RequestHandler.quiet = self.quiet
+        self._server = simple_server.WSGIServer(
+            (self.host, self.port), _RequestHandler)
+        self._server.set_app(handler)
+        self._stopping = False
+        self._children = set()
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for _ in range(self.options.get('workers', DEFAULT_WORKERS)):
+            self._spawn()
+        self._supervise()
+        self._server.server_close()
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self._children.add(pid)
+            return
+        status = 0
+        try:
+            self.options.get('on_fork', lambda: None)()
+            _serve(self._server)
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+    def _supervise(self):
+        while self._children:
+            try:
+                pid, _ = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            self._children.discard(pid)
+            if not self._stopping:
+                self._spawn()
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+        for pid in self._children:
+            os.kill(pid, signal.SIGTERM)
@@ -0,0 +1,201 @@
+""" Per-request timing spans and profiling """
+
+import collections
+import cProfile
+import functools
+import hmac
+import itertools
+import os
+import random
+import re
+import threading
+import time
+
+import sqlalchemy as sa
+
+from restytest.api import wsgi
+
+
+TIMING_MODES = ('never', 'requested', 'always')
+TIMING_HEADER = 'HTTP_X_RESTYTEST_TIMING'
+PROFILE_HEADER = 'HTTP_X_RESTYTEST_PROFILE'
+PROFILE_RESPONSE_HEADER = 'X-Restytest-Profile'
+
+
+class _Local(threading.local):
+    # A class default makes reading the trace of an untraced thread a plain
+    # attribute lookup; getattr with a default is several times slower, and
+    # every traced function pays it.
+    trace = None
+    statement_start = None
+
+
+_local = _Local()
+_profile_ids = itertools.count()
+
+
+class Trace(object):
+    """Time spent per span name within one request."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.spans = collections.OrderedDict()
+
+    def add(self, name, seconds, desc=None):
+        span = self.spans.get(name)
+        if span is None:
+            span = self.spans[name] = [0.0, 0, desc]
+        span[0] += seconds
+        span[1] += 1
+
+    def header(self):
+        """The spans as a Server-Timing header value, in milliseconds."""
+        entries = []
+        for name, (seconds, count, desc) in self.spans.items():
+            entry = '{};dur={:.3f}'.format(name, seconds * 1e3)
+            if desc:
+                entry += ';desc="{}"'.format(desc)
+            elif count > 1:
+                entry += ';desc="{} calls"'.format(count)
+            entries.append(entry)
+        entries.append('total;dur={:.3f}'.format(
+            (time.time() - self.start) * 1e3))
+        return ', '.join(entries)
+
+
+def current():
+    """The trace of the request this thread is serving, if it is traced."""
+    return _local.trace
+
+
+def traced(name, describe=False):
+    """Record calls to the decorated function as the span ``name``.
+
+    With ``describe`` the span is described by the function's name, which
+    tells apart the entry points that share a span name.
+    """
+    def decorator(func):
+        desc = func.__name__ if describe else None
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            trace = _local.trace
+            if trace is None:
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                trace.add(name, time.time() - start, desc)
+        return wrapper
+    return decorator
+
+
+def _statement_started(*args):
+    if current() is not None:
+        _local.statement_start = time.time()
+
+
+def _statement_finished(*args):
+    trace = current()
+    if trace is not None:
+        trace.add('db', time.time() - _local.statement_start)
+
+
+def watch(db):
+    """Time the statements ``db`` executes as the ``db`` span."""
+    engine = getattr(db, 'engine', None)
+    if engine is None or sa.event.contains(
+            engine, 'before_cursor_execute', _statement_started):
+        return
+    sa.event.listen(engine, 'before_cursor_execute', _statement_started)
+    sa.event.listen(engine, 'after_cursor_execute', _statement_finished)
+
+
+def _new_profile_path(directory, environ):
+    slug = re.sub(r'[^A-Za-z0-9]+', '-', environ.get('PATH_INFO', ''))
+    return os.path.join(directory, '{}-{}-{}-{}{}.prof'.format(
+        time.strftime('%Y%m%dT%H%M%S'), os.getpid(), next(_profile_ids),
+        environ.get('REQUEST_METHOD', ''), slug.rstrip('-')))
+
+
+def _finish(profile, profile_path):
+    _local.trace = None
+    if profile:
+        profile.disable()
+        profile.dump_stats(profile_path)
+
+
+class Middleware(object):
+    """WSGI middleware adding Server-Timing headers and profiling requests.
+
+    ``timing`` is one of TIMING_MODES: whether to time no requests, only
+    those sending an ``X-Restytest-Timing`` header, or all of them. Spans
+    finished by the time the handler responds are reported, which leaves out
+    the encoding of listings as they are written.
+
+    With a ``profile_dir``, a ``profile_sample`` fraction of requests are
+    run under cProfile and the stats written to a file there. With a
+    ``profile_secret`` as well, so are requests sending it in an
+    ``X-Restytest-Profile`` header, and only they are told the file's name,
+    in the ``X-Restytest-Profile`` response header. Without a secret the
+    header is ignored, so clients can't make the server profile requests.
+    """
+
+    def __init__(self, app, timing='never', profile_dir=None,
+                 profile_sample=0.0, profile_secret=None):
+        if timing not in TIMING_MODES:
+            raise ValueError("Unknown timing mode {!r}".format(timing))
+        self.app = app
+        self.timing = timing
+        self.profile_dir = profile_dir
+        self.profile_sample = profile_sample
+        self.profile_secret = profile_secret
+
+    def _timed(self, environ):
+        return self.timing == 'always' or (
+            self.timing == 'requested' and TIMING_HEADER in environ)
+
+    def _profile_requested(self, environ):
+        return bool(self.profile_secret) and hmac.compare_digest(
+            environ.get(PROFILE_HEADER, ''), self.profile_secret)
+
+    def _profile_path(self, environ, requested):
+        if self.profile_dir and (requested or
+                                 random.random() < self.profile_sample):
+            return _new_profile_path(self.profile_dir, environ)
+
+    def _start_response(self, start_response, shown_path):
+        """start_response adding this request's headers, with the name of
+        its profile if ``shown_path`` is one."""
+        def tracing_start_response(status, headers, exc_info=None):
+            headers = list(headers)
+            trace = current()
+            if trace:
+                headers.append(('Server-Timing', trace.header()))
+            if shown_path:
+                headers.append((PROFILE_RESPONSE_HEADER,
+                                os.path.basename(shown_path)))
+            return start_response(status, headers, exc_info)
+        return tracing_start_response
+
+    def __call__(self, environ, start_response):
+        timed = self._timed(environ)
+        requested = self._profile_requested(environ)
+        profile_path = self._profile_path(environ, requested)
+        if not timed and not profile_path:
+            return self.app(environ, start_response)
+
+        _local.trace = Trace() if timed else None
+        start_response = self._start_response(
+            start_response, profile_path if requested else None)
+        profile = cProfile.Profile() if profile_path else None
+        if profile:
+            profile.enable()
+        try:
+            body = self.app(environ, start_response)
+        except Exception:
+            _finish(profile, profile_path)
+            raise
+        return wsgi.ClosingBody(
+            body, lambda size: _finish(profile, profile_path))
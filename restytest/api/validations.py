@@ -3,9 +3,13 @@
 import jsonschema
 
 from restytest import exceptions
+from restytest import models
+from restytest.api import tracing
 
 
 NAME_LENGTH = 35
+BULK_LIMIT = 10000
+MEMBERS_LIMIT = 1000
 
 
 user = {
@@ -29,7 +33,7 @@ user = {
                 "type": "string",
                 "maxLength": NAME_LENGTH
             },
-            "maxItems": 50
+            "maxItems": models.MAX_USER_GROUPS
         }
     },
     "additionalProperties": False
@@ -61,25 +65,70 @@ group_put = {
     "additionalProperties": False
 }
 
+group_members = {
+    "type": "object",
+    "properties": {
+        "add": {
+            "type": "array",
+            "items": {
+                "type": "string",
+                "maxLength": NAME_LENGTH
+            },
+            "maxItems": MEMBERS_LIMIT
+        },
+        "remove": {
+            "type": "array",
+            "items": {
+                "type": "string",
+                "maxLength": NAME_LENGTH
+            },
+            "maxItems": MEMBERS_LIMIT
+        }
+    },
+    "additionalProperties": False
+}
+
 
-def validate_user(data):
+def _compile(schema):
+    # This is what jsonschema.validate does on every call; doing it once up
+    # front leaves only the instance check per request.
+    cls = jsonschema.validators.validator_for(schema)
+    cls.check_schema(schema)
+    return cls(schema)
+
+
+_user_validator = _compile(user)
+_group_post_validator = _compile(group_post)
+_group_put_validator = _compile(group_put)
+_group_members_validator = _compile(group_members)
+
+
+@tracing.traced('validate')
+def _validate(validator, data):
     try:
-        jsonschema.validate(data, user)
+        validator.validate(data)
     except:
         raise exceptions.ValidationError()
 
 
+def validate_user(data):
+    _validate(_user_validator, data)
+
+
 def validate_group_post(data):
-    try:
-        jsonschema.validate(data, group_post)
-    except:
-        raise exceptions.ValidationError()
+    _validate(_group_post_validator, data)
 
 
 def validate_group_put(data):
-    try:
-        jsonschema.validate(data, group_put)
-    except:
+    _validate(_group_put_validator, data)
+
+
+def validate_group_members(data):
+    _validate(_group_members_validator, data)
+
+
+def validate_bulk(items):
+    if not isinstance(items, list) or len(items) > BULK_LIMIT:
         raise exceptions.ValidationError()
 
 
@@ -1,16 +1,90 @@
 """ View logic for converting models """
 
+from restytest.api import codec
+from restytest.api import tracing
 
+
+# Listing items are written in chunks so a large page's body is neither built
+# whole nor costs the server a write per item.
+PAGE_CHUNK_SIZE = 100
+
+
+# Views share the model's lists rather than copying them; the documents they
+# return are only ever encoded.
+@tracing.traced('view')
 def user(user_model):
     return {
         "userid": user_model.user_id,
         "first_name": user_model.first_name,
         "last_name": user_model.last_name,
-        "groups": [g for g in user_model.groups]
+        "groups": user_model.groups
     }
 
 
+@tracing.traced('view')
 def group(group_model):
     return {
-        "userids": [u for u in group_model.users]
+        "userids": group_model.users
     }
+
+
+def _string(value):
+    return 'null' if value is None else codec.encode_string(value)
+
+
+# The *_json views write the same documents as user and group straight to
+# bytes, skipping the dict and the generic encoder's type checks.
+@tracing.traced('view')
+def user_json(user_model):
+    return ''.join((
+        '{"userid":', _string(user_model.user_id),
+        ',"first_name":', _string(user_model.first_name),
+        ',"last_name":', _string(user_model.last_name),
+        ',"groups":[', ','.join(map(codec.encode_string, user_model.groups)),
+        ']}'
+    ))
+
+
+@tracing.traced('view')
+def group_json(group_model):
+    return ''.join((
+        '{"userids":[', ','.join(map(codec.encode_string, group_model.users)),
+        ']}'
+    ))
+
+
+def _bulk_result_json(result, view_json, error_status):
+    if isinstance(result, Exception):
+        return '{{"status":{}}}'.format(error_status(result))
+    return '{"status":200,"result":' + view_json(result) + '}'
+
+
+@tracing.traced('view')
+def bulk_json(results, view_json, error_status):
+    """Bulk results as JSON, each written by ``view_json``."""
+    return ''.join((
+        '{"results":[',
+        ','.join(_bulk_result_json(r, view_json, error_status)
+                 for r in results),
+        ']}'
+    ))
+
+
+def page(key, ids):
+    """Encode a page of ids as JSON in chunks, then its continuation cursor.
+
+    The page has already been read from storage; only the encoding is done a
+    chunk at a time, as the response is written.
+    """
+    yield '{{"{}":['.format(key)
+    chunk = []
+    separator = ''
+    for item in ids:
+        chunk.append(codec.encode_string(item))
+        if len(chunk) == PAGE_CHUNK_SIZE:
+            yield separator + ','.join(chunk)
+            separator = ','
+            chunk = []
+    if chunk:
+        yield separator + ','.join(chunk)
+    yield '],"next":{}}}'.format(_string(ids.next_cursor))
@@ -0,0 +1,26 @@
+""" WSGI helpers shared by the middlewares """
+
+
+class ClosingBody(object):
+    """Response iterable that calls ``on_close`` once it has been sent.
+
+    ``on_close`` gets the number of bytes sent. Servers close the response
+    once they have written it, so this runs after any streamed body is done.
+    """
+
+    def __init__(self, body, on_close):
+        self._body = body
+        self._on_close = on_close
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self._body:
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self._body, 'close'):
+                self._body.close()
+        finally:
+            self._on_close(self.size)
@@ -19,3 +19,11 @@ class ResourceAlreadyExists(Exception):
 
 class InvalidIdentifier(Exception):
     pass
+
+
+class BatchAborted(Exception):
+    pass
+
+
+class PreconditionFailed(Exception):
+    pass
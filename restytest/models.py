@@ -1,15 +1,32 @@
 """ Application models """
 
 
+# Most groups one user may belong to, however the memberships are written: with
+# the user, with a group, or one member at a time.
+MAX_USER_GROUPS = 50
+
+
+# Models are slotted to keep the per-instance dict out of every cached entry,
+# and take ownership of the membership lists they are given rather than copying
+# them. Nothing along the request path mutates a model's list once it is built,
+# which is what lets storage, controller and views share one list instead of
+# each making their own.
 class User(object):
-    def __init__(self, user_id, first_name, last_name, groups=None):
+    __slots__ = ('user_id', 'first_name', 'last_name', 'groups', 'version')
+
+    def __init__(self, user_id, first_name, last_name, groups=None,
+                 version=None):
         self.user_id = user_id
         self.first_name = first_name
         self.last_name = last_name
         self.groups = groups if groups else []
+        self.version = version
 
 
 class Group(object):
-    def __init__(self, group_id, users=None):
+    __slots__ = ('group_id', 'users', 'version')
+
+    def __init__(self, group_id, users=None, version=None):
         self.group_id = group_id
         self.users = users if users else []
+        self.version = version
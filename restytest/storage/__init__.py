@@ -1,4 +1,11 @@
+from restytest.storage import cache
 from restytest.storage import impl
+from restytest.storage import memory
 
 
+DEFAULT_PROFILE = impl.DEFAULT_PROFILE
+MEMORY_URI = impl.MEMORY_URI
 Storage = impl.Storage
+is_memory = impl.is_memory
+CachingStorage = cache.CachingStorage
+MemoryStorage = memory.MemoryStorage
@@ -0,0 +1,222 @@
+""" Read-through caching in front of Storage """
+
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+    """Bounded mapping that evicts the least recently used entry.
+
+    Entries older than ``ttl`` seconds are treated as missing. A ``ttl`` of
+    None keeps entries until they are evicted or invalidated.
+
+    A value read from somewhere else should be set with the generation()
+    taken before reading it. The set is dropped if the key was invalidated
+    in between, so a slow reader can't put back what a write replaced.
+    Only the last ``size`` invalidations are remembered by key; sets from
+    before any older one are dropped, whatever their key.
+    """
+
+    def __init__(self, size, ttl=None, clock=time.time):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._clock = clock
+        self._entries = collections.OrderedDict()
+        self._generation = 0
+        self._invalidated = collections.OrderedDict()
+        self._forgotten = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires = entry
+            if expires is not None and expires <= self._clock():
+                self.misses += 1
+                return None
+            # Re-inserting moves the key to the most recently used end;
+            # OrderedDict has no move_to_end on Python 2.
+            self._entries[key] = entry
+            self.hits += 1
+            return value
+
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    def _stale(self, key, generation):
+        return generation is not None and (
+            self._forgotten > generation or
+            self._invalidated.get(key, 0) > generation)
+
+    def set(self, key, value, generation=None):
+        expires = self._clock() + self.ttl if self.ttl else None
+        with self._lock:
+            if self._stale(key, generation):
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._generation += 1
+            self._invalidated.pop(key, None)
+            self._invalidated[key] = self._generation
+            if len(self._invalidated) > self.size:
+                _, generation = self._invalidated.popitem(last=False)
+                self._forgotten = generation
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            self._invalidated.clear()
+            self._forgotten = self._generation
+
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            size=len(self._entries),
+        )
+
+
+def _user_key(user_id):
+    return ('user', user_id)
+
+
+def _group_key(group_id):
+    return ('group', group_id)
+
+
+class CachingStorage(object):
+    """Storage wrapper that serves get_user/get_group from an LRU cache.
+
+    Memberships are mirrored on users and groups, so every write drops the
+    cached entries on the other side of the memberships it adds or removes.
+    Those it removes are the ones the wrapped storage found in the write's
+    own transaction, not a read from before it, which another write might
+    have overtaken.
+    Writes only drop entries; the next read caches what was written, unless
+    another write has dropped it again since that read began.
+    Anything not overridden here is passed through to the wrapped storage.
+    """
+
+    def __init__(self, db, size, ttl=None):
+        self.db = db
+        self.cache = LRUCache(size, ttl)
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+    def _invalidate_users(self, user_ids):
+        for user_id in user_ids:
+            self.cache.invalidate(_user_key(user_id))
+
+    def _invalidate_groups(self, group_ids):
+        for group_id in group_ids:
+            self.cache.invalidate(_group_key(group_id))
+
+    def _read_through(self, key, read, entity_id):
+        value = self.cache.get(key)
+        if value is None:
+            generation = self.cache.generation()
+            value = read(entity_id)
+            if value:
+                self.cache.set(key, value, generation)
+        return value
+
+    def get_user(self, user_id):
+        return self._read_through(_user_key(user_id), self.db.get_user,
+                                  user_id)
+
+    def get_user_version(self, user_id):
+        user = self.cache.get(_user_key(user_id))
+        if user is None:
+            return self.db.get_user_version(user_id)
+        return user.version
+
+    def create_user(self, user):
+        result = self.db.create_user(user)
+        self._invalidate_users([user.user_id])
+        self._invalidate_groups(user.groups)
+        return result
+
+    def create_users(self, users, atomic=False):
+        results = self.db.create_users(users, atomic)
+        self._invalidate_groups(g for u in users for g in u.groups)
+        return results
+
+    def update_user(self, user_id, user, if_match=None):
+        former = []
+        result = self.db.update_user(user_id, user, if_match, former=former)
+        self._invalidate_users([user_id, user.user_id])
+        self._invalidate_groups(former + user.groups)
+        return result
+
+    def delete_user(self, user_id, if_match=None):
+        former = []
+        self.db.delete_user(user_id, if_match, former=former)
+        self._invalidate_users([user_id])
+        self._invalidate_groups(former)
+
+    def get_group(self, group_id):
+        return self._read_through(_group_key(group_id), self.db.get_group,
+                                  group_id)
+
+    def get_group_version(self, group_id):
+        group = self.cache.get(_group_key(group_id))
+        if group is None:
+            return self.db.get_group_version(group_id)
+        return group.version
+
+    def create_group(self, group):
+        result = self.db.create_group(group)
+        self._invalidate_groups([group.group_id])
+        self._invalidate_users(group.users)
+        return result
+
+    def create_groups(self, groups, atomic=False):
+        results = self.db.create_groups(groups, atomic)
+        self._invalidate_users(u for g in groups for u in g.users)
+        return results
+
+    def update_group(self, group_id, group, if_match=None):
+        former = []
+        result = self.db.update_group(group_id, group, if_match,
+                                      former=former)
+        self._invalidate_groups([group_id, group.group_id])
+        self._invalidate_users(former + group.users)
+        return result
+
+    def delete_group(self, group_id, if_match=None):
+        former = []
+        self.db.delete_group(group_id, if_match, former=former)
+        self._invalidate_groups([group_id])
+        self._invalidate_users(former)
+
+    def update_members(self, group_id, add=(), remove=()):
+        self.db.update_members(group_id, add, remove)
+        self._invalidate_groups([group_id])
+        self._invalidate_users(list(add) + list(remove))
+
+    def remove_member(self, group_id, user_id):
+        removed = self.db.remove_member(group_id, user_id)
+        self._invalidate_groups([group_id])
+        self._invalidate_users([user_id])
+        return removed
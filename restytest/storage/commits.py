@@ -0,0 +1,153 @@
+""" Group commit: concurrent writes applied in shared transactions """
+
+import Queue
+import threading
+import time
+
+
+class _Write(object):
+    """One caller's write: ``check`` may veto it before ``apply`` writes."""
+
+    def __init__(self, apply, check=None):
+        self.apply = apply
+        self.check = check
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def run(self, conn):
+        """Run the write; False if it failed after it may have written."""
+        self.result = self.error = None
+        if self.check:
+            try:
+                self.check(conn)
+            except Exception as e:
+                self.error = e
+                return True
+        try:
+            self.result = self.apply(conn)
+        except Exception as e:
+            self.error = e
+            return False
+        return True
+
+
+def _discard(trans):
+    """Roll ``trans`` back if there is one, whether or not that works."""
+    if trans is None:
+        return
+    try:
+        trans.rollback()
+    except Exception:
+        pass
+
+
+class GroupCommitter(object):
+    """Applies writes from many threads in as few transactions as it can.
+
+    A single thread takes the writes in the order they were submitted. It
+    waits up to ``window`` seconds after the first of a batch for others to
+    arrive, and commits once for up to ``max_batch`` of them, so concurrent
+    writers share one commit -- and one fsync -- instead of queueing for
+    their own.
+
+    Every caller still gets only its own result or exception. A write whose
+    check fails wrote nothing and is simply skipped. One that fails while
+    writing rolls the batch back, and the batch is applied again without it,
+    which leaves the others exactly as if the failed write had been applied
+    alone, in its turn. If the transaction itself can't be begun, committed
+    or rolled back, every write in the batch fails with that error, and the
+    thread carries on with the next batch.
+    """
+
+    def __init__(self, conn, lock, max_batch, window=0.0):
+        self.conn = conn
+        self.max_batch = max_batch
+        self.window = window
+        self._lock = lock
+        self._writes = Queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, apply, check=None):
+        """Run ``apply(conn)`` in a transaction, after ``check(conn)``.
+
+        Blocks until the transaction holding the write has committed, then
+        returns what ``apply`` returned or raises what it, or ``check``,
+        raised.
+        """
+        write = _Write(apply, check)
+        self._writes.put(write)
+        write.done.wait()
+        if write.error is not None:
+            raise write.error
+        return write.result
+
+    def close(self):
+        """Stop once the writes already submitted are committed."""
+        self._writes.put(None)
+        self._thread.join()
+
+    def _next(self, deadline):
+        remaining = deadline - time.time()
+        if remaining > 0:
+            return self._writes.get(timeout=remaining)
+        return self._writes.get_nowait()
+
+    def _batch(self, first):
+        batch = [first]
+        deadline = time.time() + self.window
+        while len(batch) < self.max_batch:
+            try:
+                write = self._next(deadline)
+            except Queue.Empty:
+                break
+            if write is None:
+                self._writes.put(None)
+                break
+            batch.append(write)
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._writes.get()
+            if first is None:
+                return
+            batch = self._batch(first)
+            try:
+                self._apply(batch)
+            except Exception as e:
+                for write in batch:
+                    write.error = e
+            finally:
+                # Callers block until their write is done, so it must be marked
+                # done whatever happened to it.
+                for write in batch:
+                    write.done.set()
+
+    def _apply(self, writes):
+        while writes:
+            failed = self._commit(writes)
+            writes = [w for w in writes if w is not failed]
+            if failed is None:
+                return
+
+    def _commit(self, writes):
+        """Commit the writes; the one that broke the transaction, if any."""
+        with self._lock:
+            trans = None
+            try:
+                trans = self.conn.begin()
+                for write in writes:
+                    if not write.run(self.conn):
+                        trans.rollback()
+                        return write
+                trans.commit()
+            except Exception as e:
+                # The transaction itself failed; nothing is written and every
+                # write in it shares the failure.
+                _discard(trans)
+                for write in writes:
+                    write.error = e
+            return None
@@ -1,164 +1,992 @@
 """ Data Access """
 
+import contextlib
+import functools
+import itertools
+import os
+import sqlite3
+import threading
+
 import sqlalchemy as sa
+from sqlalchemy import exc as sa_exc
+from sqlalchemy import pool
 
+from restytest import exceptions
 from restytest import models
+from restytest.storage import commits
+from restytest.storage import migrations
 from restytest.storage import schema
 
 
 MEMORY_URI = 'sqlite://'
-
-
-def _to_user(user, assocs):
+# In-memory databases are opened by a URI naming them, with a shared cache, so
+# a snapshot can read one from a connection of its own. Python 2's sqlite3 has
+# no uri flag, so that only works with an SQLite built to take URI filenames by
+# default; any other takes the URI for the name of a file to create.
+SHARED_MEMORY_URI = 'file:restytest-{}-{}?mode=memory&cache=shared'
+
+_memory_ids = itertools.count()
+
+# Compiled forms of the statements below, per engine. Each is built once and
+# only compiled again for a new set of parameter names, so the cache stays
+# small; it is bounded all the same, against statements that are built per
+# call.
+STATEMENT_CACHE_SIZE = 500
+
+# Connection settings for file databases, from most to least durable. WAL lets
+# readers run alongside the writer; synchronous decides how often a commit
+# waits for an fsync. "stock" leaves SQLite's defaults alone.
+_TUNING_PRAGMAS = (
+    ('temp_store', 'MEMORY'),
+    ('mmap_size', 256 * 1024 * 1024),
+    ('cache_size', -64 * 1024),
+)
+PROFILES = {
+    'stock': (),
+    'durable': (('journal_mode', 'WAL'), ('synchronous', 'FULL')) +
+    _TUNING_PRAGMAS,
+    'balanced': (('journal_mode', 'WAL'), ('synchronous', 'NORMAL')) +
+    _TUNING_PRAGMAS,
+    'fast': (('journal_mode', 'WAL'), ('synchronous', 'OFF')) +
+    _TUNING_PRAGMAS,
+}
+DEFAULT_PROFILE = 'balanced'
+
+# Kept under SQLite's default limit of 999 bound parameters so a chunk of ids
+# fits in a single IN clause.
+BULK_CHUNK_SIZE = 500
+
+# The association table is keyed on (user_id, group_id), so an index scan
+# returns memberships sorted by name. Ordering by rowid keeps them in the order
+# they were added.
+ASSOCIATION_ORDER = sa.literal_column('{}.rowid'.format(
+    schema.user_group_associations.name))
+
+
+def _members(rows):
+    # Rows come from a LEFT JOIN, so an entity without memberships is a single
+    # row with a NULL in the membership column. That column is selected first:
+    # reading a row by position is an order of magnitude cheaper than by name,
+    # which adds up over a large group.
+    if rows[0][0] is None:
+        return []
+    return [r[0] for r in rows]
+
+
+def _to_user(rows):
+    user = rows[0]
     return models.User(
         user_id=user.id,
         first_name=user.first_name,
         last_name=user.last_name,
-        groups=[a.group_id for a in assocs]
+        groups=_members(rows),
+        version=user.version
     )
 
 
-def _to_group(group, assocs):
+def _to_group(rows):
+    group = rows[0]
     return models.Group(
         group_id=group.id,
-        users=[a.user_id for a in assocs]
+        users=_members(rows),
+        version=group.version
     )
 
 
+def _statement(build):
+    """Build each shape of a statement once, from the arguments naming it.
+
+    The statements take every value as a bound parameter, so the same object
+    runs each time and the engine's compiled cache, keyed on it, saves
+    compiling it again.
+    """
+    statements = {}
+
+    @functools.wraps(build)
+    def statement(*shape):
+        if shape not in statements:
+            statements[shape] = build(*shape)
+        return statements[shape]
+    return statement
+
+
+@_statement
+def _user_select():
+    assocs = schema.user_group_associations
+    joined = schema.users.outerjoin(
+        assocs, assocs.c.user_id == schema.users.c.id)
+    return sa.select([assocs.c.group_id, schema.users]).select_from(
+        joined
+    ).where(schema.users.c.id == sa.bindparam('entity_id')).order_by(
+        ASSOCIATION_ORDER)
+
+
+@_statement
+def _group_select():
+    assocs = schema.user_group_associations
+    joined = schema.groups.outerjoin(
+        assocs, assocs.c.group_id == schema.groups.c.id)
+    return sa.select([assocs.c.user_id, schema.groups]).select_from(
+        joined
+    ).where(schema.groups.c.id == sa.bindparam('entity_id')).order_by(
+        ASSOCIATION_ORDER)
+
+
+@_statement
+def _version_select(table):
+    return sa.select([table.c.version]).where(
+        table.c.id == sa.bindparam('entity_id'))
+
+
+@_statement
+def _ids_in(table):
+    return sa.select([table.c.id]).where(
+        table.c.id.in_(sa.bindparam('ids', expanding=True)))
+
+
+def _paged(query, column, after, limited):
+    if after:
+        query = query.where(column > sa.bindparam('after'))
+    if limited:
+        query = query.limit(sa.bindparam('limit'))
+    return query
+
+
+@_statement
+def _ids_page(table, after, limited):
+    """Ids in order, past ``:after`` and up to ``:limit`` as the flags ask."""
+    return _paged(sa.select([table.c.id]).order_by(table.c.id),
+                  table.c.id, after, limited)
+
+
+@_statement
+def _members_page(after, limited):
+    """Ids of the members of ``:entity_id`` in order; see _ids_page."""
+    assocs = schema.user_group_associations
+    return _paged(sa.select([assocs.c.user_id]).where(
+        assocs.c.group_id == sa.bindparam('entity_id')
+    ).order_by(assocs.c.user_id), assocs.c.user_id, after, limited)
+
+
+@_statement
+def _insert(table):
+    return table.insert()
+
+
+@_statement
+def _insert_or_ignore(table):
+    return table.insert().prefix_with('OR IGNORE')
+
+
+def _where_entity(query, table, matched):
+    query = query.where(table.c.id == sa.bindparam('entity_id'))
+    if matched:
+        query = query.where(table.c.version.in_(
+            sa.bindparam('if_match', expanding=True)))
+    return query
+
+
+@_statement
+def _entity_update(table, matched):
+    """Update of ``:entity_id``, at one of ``:if_match`` if ``matched``.
+
+    It sets whichever columns it's given values for.
+    """
+    return _where_entity(table.update(), table, matched)
+
+
+@_statement
+def _entity_delete(table, matched):
+    """Delete of ``:entity_id``; see _entity_update."""
+    return _where_entity(table.delete(), table, matched)
+
+
+@_statement
+def _move_memberships(column_name):
+    assocs = schema.user_group_associations
+    return assocs.update().where(
+        assocs.c[column_name] == sa.bindparam('old_id')
+    ).values({column_name: sa.bindparam('new_id')})
+
+
+@_statement
+def _stale_memberships(column_name, other_name, keeping):
+    """Delete of the memberships ``:entity_id`` has beyond those in ``:keep``.
+
+    Together with an INSERT OR IGNORE of the kept ones, this leaves the
+    entity with exactly the given memberships. Only memberships that are
+    removed or added are written; kept ones are left alone.
+    """
+    assocs = schema.user_group_associations
+    stale = assocs.delete().where(
+        assocs.c[column_name] == sa.bindparam('entity_id'))
+    if keeping:
+        stale = stale.where(~assocs.c[other_name].in_(
+            sa.bindparam('keep', expanding=True)))
+    return stale
+
+
+@_statement
+def _members_delete(several):
+    """Delete of ``:member_id``, or ``:member_ids``, from ``:entity_id``."""
+    assocs = schema.user_group_associations
+    if several:
+        member = assocs.c.user_id.in_(
+            sa.bindparam('member_ids', expanding=True))
+    else:
+        member = assocs.c.user_id == sa.bindparam('member_id')
+    return assocs.delete().where(
+        assocs.c.group_id == sa.bindparam('entity_id')).where(member)
+
+
+@_statement
+def _memberships_of(column_name, other_name):
+    """Ids on the other side of ``:entity_id``'s memberships."""
+    assocs = schema.user_group_associations
+    return sa.select([assocs.c[other_name]]).where(
+        assocs.c[column_name] == sa.bindparam('entity_id'))
+
+
+@_statement
+def _overfull_users():
+    """Any one of ``:member_ids`` that is in more than ``:most`` groups."""
+    assocs = schema.user_group_associations
+    return sa.select([assocs.c.user_id]).where(
+        assocs.c.user_id.in_(sa.bindparam('member_ids', expanding=True))
+    ).group_by(assocs.c.user_id).having(
+        sa.func.count() > sa.bindparam('most')).limit(1)
+
+
+def _check_user_groups(conn, user_ids):
+    """Raise ValidationError if any of ``user_ids`` is in too many groups.
+
+    Run last in a write adding them to groups, so it sees what the write did
+    and a failure rolls the write back.
+    """
+    for chunk in _chunks(user_ids):
+        if conn.execute(_overfull_users(), member_ids=chunk,
+                        most=models.MAX_USER_GROUPS).first():
+            raise exceptions.ValidationError()
+
+
 def _get_user_values(user):
     return dict(
         id=user.user_id,
         first_name=user.first_name,
         last_name=user.last_name,
+        version=schema.new_version(),
     )
 
 
+def unique(ids):
+    """``ids`` in the order first seen, without repeats."""
+    seen = set()
+    result = []
+    for i in ids:
+        if i not in seen:
+            seen.add(i)
+            result.append(i)
+    return result
+
+
 def _get_group_assocs(user_id, groups):
     return [dict(user_id=user_id, group_id=group_id)
-            for group_id in groups]
+            for group_id in unique(groups)]
 
 
 def _get_group_values(group):
     return dict(
         id=group.group_id,
+        version=schema.new_version(),
     )
 
 
 def _get_user_assocs(group_id, users):
     return [dict(user_id=user_id, group_id=group_id)
-            for user_id in users]
+            for user_id in unique(users)]
 
 
-class Storage(object):
-    def __init__(self):
-        engine = sa.create_engine(MEMORY_URI)
-        schema.metadata.create_all(engine)
-        self.conn = engine.connect()
+def _chunks(items, size=BULK_CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
 
-        # NOTE(thomasem): SQLite needs to have Foreign Key constraints enabled
-        # as they aren't on by default.
-        self.conn.execute('PRAGMA foreign_keys=ON')
 
-    def _transaction(self, series):
-        trans = self.conn.begin()
-        try:
-            for query in series:
-                self.conn.execute(*query)
-            trans.commit()
-        except:
-            trans.rollback()
-            raise
+def _bulk_series(table, values, assocs):
+    series = [(_insert(table), values)]
+    if assocs:
+        series.append((_insert(schema.user_group_associations), assocs))
+    return series
 
-    def get_user(self, user_id):
-        # NOTE(thomasem): Willing to make two queries because it's in-memory.
-        # for a persistent storage solution, would want to use functionality
-        # that's not available for an in-memory solution, such as sub-query and
-        # array casting, if possible.
-        user_select = schema.users.select().where(schema.users.c.id == user_id)
-        groups_select = schema.user_group_associations.select().where(
-            schema.user_group_associations.c.user_id == user_id
+
+def _create_users_series(entries):
+    """Series creating users from (user, values) pairs."""
+    return _bulk_series(
+        schema.users,
+        [values for _, values in entries],
+        [a for u, _ in entries for a in _get_group_assocs(u.user_id, u.groups)]
+    )
+
+
+def _create_groups_series(entries):
+    """Series creating groups from (group, values) pairs."""
+    return _bulk_series(
+        schema.groups,
+        [values for _, values in entries],
+        [a for g, _ in entries for a in _get_user_assocs(g.group_id, g.users)]
+    )
+
+
+def _written_user(values, groups, changes):
+    """The user as written from ``values``, without reading it back.
+
+    ``changes`` is how many membership changes have counted its version up
+    since.
+    """
+    return models.User(
+        user_id=values['id'],
+        first_name=values['first_name'],
+        last_name=values['last_name'],
+        groups=groups,
+        version=values['version'] + changes
+    )
+
+
+def _written_group(values, users, changes):
+    """The group as written from ``values``; see _written_user."""
+    return models.Group(
+        group_id=values['id'],
+        users=users,
+        version=values['version'] + changes
+    )
+
+
+def _created(written, values, members):
+    """The entity as created from ``values``, one change per membership."""
+    members = unique(members)
+    return written(values, members, len(members))
+
+
+def _matching(entity_id, if_match, **values):
+    """Parameters for a statement on the entity, restricted by if_match."""
+    params = dict(values, entity_id=entity_id)
+    if if_match is not None:
+        params['if_match'] = list(if_match)
+    return params
+
+
+def _guard(table, statement, params, missing):
+    """Check that runs ``statement`` and raises if it matched no row.
+
+    ``statement`` writes the entity's own row, only at one of the versions
+    in ``params`` if there are any, so the one statement both finds the
+    entity and tests the precondition. What went wrong is only read when it
+    matched nothing. It fails only having written nothing, so it can run as
+    a write's check.
+    """
+    def check(conn):
+        if conn.execute(statement, params).rowcount:
+            return
+        if 'if_match' in params and conn.execute(
+                _version_select(table),
+                entity_id=params['entity_id']).first():
+            raise exceptions.PreconditionFailed()
+        raise missing()
+    return check
+
+
+def _entity_guard(table, old_id, values, if_match, missing):
+    """Guard updating the entity's own row; see _guard."""
+    if values['id'] != old_id:
+        # The row is about to be replaced by the renamed one; it only has to be
+        # found, and checked, first.
+        columns = dict(version=values['version'])
+    else:
+        columns = dict((k, v) for k, v in values.items() if k != 'id')
+    return _guard(table, _entity_update(table, if_match is not None),
+                  _matching(old_id, if_match, **columns), missing)
+
+
+def _recording(check, columns, entity_id, former):
+    """``check``, after it fills ``former`` with the entity's memberships.
+
+    They are read in the write's own transaction, so they are exactly the
+    memberships the write replaces. Without a ``former`` list, ``check`` is
+    left as it is.
+    """
+    if former is None:
+        return check
+    query = _memberships_of(*columns)
+
+    def recorded(conn):
+        # A group commit runs checks again after a failure elsewhere in the
+        # batch, so the list is replaced, not extended.
+        former[:] = [row[0] for row in
+                     conn.execute(query, entity_id=entity_id)]
+        check(conn)
+    return recorded
+
+
+def _rename_series(table, column_name, old_id, values):
+    """Series moving an entity, if its id changes, and its memberships."""
+    if values['id'] == old_id:
+        return []
+    return [
+        (_insert(table), values),
+        (_move_memberships(column_name),
+         dict(old_id=old_id, new_id=values['id'])),
+        (_entity_delete(table, False), dict(entity_id=old_id)),
+    ]
+
+
+def _execute(series):
+    def apply(conn):
+        for query in series:
+            conn.execute(*query)
+    return apply
+
+
+def _count_changes(series):
+    def apply(conn):
+        return sum(conn.execute(*query).rowcount for query in series)
+    return apply
+
+
+def _adding_members(series, user_ids):
+    """Like _count_changes, for a series adding ``user_ids`` to a group."""
+    count_changes = _count_changes(series)
+
+    def apply(conn):
+        changes = count_changes(conn)
+        _check_user_groups(conn, user_ids)
+        return changes
+    return apply
+
+
+def _nothing(conn):
+    pass
+
+
+def _abort_pending(results):
+    return [r if r else exceptions.BatchAborted() for r in results]
+
+
+def _uri_filenames():
+    """Whether SQLite opens ``file:`` names as URIs without being asked."""
+    conn = sqlite3.connect(':memory:')
+    try:
+        return any(row[0] in ('USE_URI', 'USE_URI=1') for row in
+                   conn.execute('PRAGMA compile_options'))
+    finally:
+        conn.close()
+
+
+URI_FILENAMES = _uri_filenames()
+
+
+def _in_memory(dbapi_conn):
+    """Whether the connection's main database has no file behind it."""
+    return not any(name == 'main' and filename for _, name, filename in
+                   dbapi_conn.execute('PRAGMA database_list'))
+
+
+def is_memory(uri):
+    return sa.engine.url.make_url(uri).database in (None, '', ':memory:')
+
+
+class _Locks(object):
+    """Several locks, taken in order and released in reverse, as one."""
+
+    def __init__(self, *locks):
+        self._locks = locks
+
+    def __enter__(self):
+        for lock in self._locks:
+            lock.acquire()
+
+    def __exit__(self, *exc_info):
+        for lock in reversed(self._locks):
+            lock.release()
+
+
+def _on_connect(pragmas, dbapi_conn, record):
+    # NOTE(thomasem): SQLite needs to have Foreign Key constraints enabled
+    # as they aren't on by default, and it's a per-connection setting.
+    dbapi_conn.execute('PRAGMA foreign_keys=ON')
+    for name, value in pragmas:
+        dbapi_conn.execute('PRAGMA {}={}'.format(name, value))
+
+
+class Storage(object):
+    """SQLite backed storage that is safe to share between threads.
+
+    All writes go through a single connection, one at a time, so transactions
+    are applied in the order they were issued. File databases are read through
+    a connection per thread. Reads of an in-memory database share the write
+    connection and take turns with the writes; only snapshots read it through
+    connections of their own, holding off writes but not reads. Where SQLite
+    can't open a second connection to the same in-memory database, there is
+    just the one, and snapshots hold off reads too.
+
+    ``profile`` names the PROFILES entry used to tune file databases.
+
+    With a ``commit_batch`` above 1, concurrent writes are group committed:
+    up to that many share a transaction, gathered for at most
+    ``commit_window`` seconds. See commits.GroupCommitter.
+
+    Statements are built once per shape, with their values bound as
+    parameters, and up to ``statement_cache`` of them are kept compiled; 0
+    compiles every statement every time it runs.
+    """
+
+    def __init__(self, uri=MEMORY_URI, profile=DEFAULT_PROFILE,
+                 commit_batch=1, commit_window=0.0,
+                 statement_cache=STATEMENT_CACHE_SIZE):
+        if profile not in PROFILES:
+            raise ValueError("Unknown storage profile {!r}".format(profile))
+        self._shared_reads = is_memory(uri)
+        pragmas = () if self._shared_reads else PROFILES[profile]
+        # SQLAlchemy 1.4 caches compiled statements on its own unless
+        # compiled_cache is explicitly None, so 0 has to say so.
+        options = {'compiled_cache': (sa.util.LRUCache(statement_cache)
+                                      if statement_cache else None)}
+        connect = {'connect_args': {'check_same_thread': False}}
+        if self._shared_reads:
+            self._memory_uri = None
+            if URI_FILENAMES:
+                self._memory_uri = SHARED_MEMORY_URI.format(
+                    os.getpid(), next(_memory_ids))
+            connect = {'creator': self._connect_memory}
+        self.engine = sa.create_engine(
+            uri,
+            poolclass=pool.StaticPool if self._shared_reads else pool.NullPool,
+            execution_options=options,
+            **connect
         )
-        user = self.conn.execute(user_select).fetchone()
-        assocs = self.conn.execute(groups_select)
-        return _to_user(user, assocs) if user else None
-
-    def _create_user_series(self, user):
-        user_insert = schema.users.insert().values(**_get_user_values(user))
-        group_assocs = _get_group_assocs(user.user_id, user.groups)
-        series = [(user_insert,)]
-        if group_assocs:
-            series.append(
-                (schema.user_group_associations.insert(), group_assocs)
-            )
-        return series
+        sa.event.listen(self.engine, 'connect',
+                        functools.partial(_on_connect, pragmas))
+        schema.metadata.create_all(self.engine)
+        self.conn = self.engine.connect()
+        self._lock = threading.RLock()
+        # Writers take _write_lock, then _lock. Readers only need _lock, so
+        # whatever holds just _write_lock keeps writes off without keeping
+        # reads waiting.
+        self._write_lock = threading.RLock()
+        self._writing = _Locks(self._write_lock, self._lock)
+        self._local = threading.local()
+        migrations.upgrade(self.conn)
+        self._committer = None
+        if commit_batch > 1:
+            self._committer = commits.GroupCommitter(
+                self.conn, self._writing, commit_batch, commit_window)
+
+    def close(self):
+        """Commit the writes still waiting for a group commit and stop."""
+        if self._committer:
+            self._committer.close()
+            self._committer = None
+
+    def _connect_memory(self):
+        conn = sqlite3.connect(self._memory_uri or ':memory:',
+                               check_same_thread=False)
+        if not _in_memory(conn):
+            conn.close()
+            raise RuntimeError(
+                "SQLite opened {!r} as a file, not an in-memory "
+                "database".format(self._memory_uri))
+        return conn
+
+    def _reader(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self.engine.connect()
+        return conn
+
+    @contextlib.contextmanager
+    def _reading(self):
+        if self._shared_reads:
+            with self._lock:
+                yield self.conn
+        else:
+            yield self._reader()
+
+    def _read(self, query, **params):
+        with self._reading() as conn:
+            return conn.execute(query, **params).fetchall()
+
+    def _run(self, apply, check=None):
+        """Run a write in a transaction of its own, on this thread."""
+        with self._writing:
+            trans = self.conn.begin()
+            try:
+                if check:
+                    check(self.conn)
+                result = apply(self.conn)
+                trans.commit()
+            except:
+                trans.rollback()
+                raise
+            return result
+
+    def _write(self, apply, check=None):
+        """Run a write, group committed with others' if that's enabled.
+
+        Returns what ``apply(conn)`` returns; with ``check``, runs
+        ``check(conn)`` first, in the same transaction.
+        """
+        if self._committer:
+            return self._committer.submit(apply, check)
+        return self._run(apply, check)
+
+    def _transaction(self, series, precondition=None):
+        self._write(_execute(series), precondition)
+
+    def _update(self, table, columns, old_id, values, assocs, if_match,
+                missing, former):
+        """Apply update_user or update_group in one guarded transaction.
+
+        ``columns`` names the entity's and the other side's association
+        columns. Returns how many memberships it removed and added.
+        """
+        column, other = columns
+        guard = _recording(
+            _entity_guard(table, old_id, values, if_match, missing),
+            columns, old_id, former)
+        rename = _execute(_rename_series(table, column, old_id, values))
+        stale = _stale_memberships(column, other, bool(assocs))
+        stale_params = dict(entity_id=values['id'],
+                            keep=[a[other] for a in assocs])
+        insert = _insert_or_ignore(schema.user_group_associations)
+
+        def apply(conn):
+            rename(conn)
+            removed = conn.execute(stale, stale_params).rowcount
+            added = conn.execute(insert, assocs).rowcount if assocs else 0
+            if added and other == 'user_id':
+                _check_user_groups(conn, [a['user_id'] for a in assocs])
+            return removed, added
+        return self._write(apply, guard)
+
+    def _delete(self, table, columns, entity_id, if_match, missing, former):
+        self._write(_nothing, _recording(_guard(
+            table, _entity_delete(table, if_match is not None),
+            _matching(entity_id, if_match), missing), columns, entity_id,
+            former))
+
+    def _existing_ids(self, table, ids):
+        existing = set()
+        for chunk in _chunks(list(set(ids))):
+            existing.update(
+                row.id for row in self._read(_ids_in(table), ids=chunk))
+        return existing
+
+    def _bulk_failures(self, ids, table, refs, ref_table, missing_ref):
+        """Find the entities a bulk create would reject before writing."""
+        existing = self._existing_ids(table, ids)
+        known_refs = self._existing_ids(
+            ref_table, [r for entity_refs in refs for r in entity_refs])
+        failures = []
+        for entity_id, entity_refs in zip(ids, refs):
+            if entity_id in existing:
+                failures.append(exceptions.ResourceAlreadyExists())
+            elif not known_refs.issuperset(entity_refs):
+                failures.append(missing_ref())
+            else:
+                failures.append(None)
+            # Later duplicates within the batch conflict with the first one.
+            existing.add(entity_id)
+        return failures
+
+    def _conflict(self, table, entity_id, missing_ref):
+        """What an IntegrityError from creating ``entity_id`` came from.
+
+        Like Controller._conflict, it is only read once a write has failed.
+        """
+        if self._version(table, entity_id) is not None:
+            return exceptions.ResourceAlreadyExists()
+        return missing_ref()
+
+    def _bulk_write(self, entries, failures, series_of, atomic, conflict):
+        """Write the (entity, values) ``entries`` that haven't failed yet.
+
+        ``conflict(entity_id)`` tells what a write that fails anyway ran
+        into.
+        """
+        pending = [i for i, f in enumerate(failures) if f is None]
+        if atomic:
+            self._bulk_write_atomic(entries, failures, pending, series_of)
+            return
+        for chunk in _chunks(pending):
+            try:
+                self._transaction(series_of([entries[i] for i in chunk]))
+            except sa_exc.IntegrityError:
+                # Something changed since the failures were computed; retry one
+                # at a time to find the culprits.
+                self._bulk_write_each(entries, failures, chunk, series_of,
+                                      conflict)
+
+    def _bulk_write_each(self, entries, failures, indexes, series_of,
+                         conflict):
+        for i in indexes:
+            try:
+                self._transaction(series_of([entries[i]]))
+            except sa_exc.IntegrityError:
+                failures[i] = conflict(entries[i][1]['id'])
+
+    def _bulk_write_atomic(self, entries, failures, pending, series_of):
+        if len(pending) == len(entries):
+            series = []
+            for chunk in _chunks(pending):
+                series.extend(series_of([entries[i] for i in chunk]))
+            try:
+                self._transaction(series)
+                return
+            except sa_exc.IntegrityError:
+                pass
+        failures[:] = _abort_pending(failures)
+
+    def _list_ids(self, table, after, limit):
+        # The page is fetched whole, not streamed from the cursor. Listings are
+        # bounded by their page size, and iterating the cursor would hold the
+        # connection -- and, for an in-memory database, the lock every write
+        # waits on -- for as long as the caller takes over the ids.
+        query = _ids_page(table, after is not None, limit is not None)
+        for row in self._read(query, after=after, limit=limit):
+            yield row.id
+
+    def list_user_ids(self, after=None, limit=None):
+        """Yield user ids in order, starting after the id ``after``."""
+        return self._list_ids(schema.users, after, limit)
+
+    def list_group_ids(self, after=None, limit=None):
+        """Yield group ids in order, starting after the id ``after``."""
+        return self._list_ids(schema.groups, after, limit)
+
+    def _version(self, table, entity_id):
+        rows = self._read(_version_select(table), entity_id=entity_id)
+        return rows[0].version if rows else None
+
+    def get_user(self, user_id):
+        rows = self._read(_user_select(), entity_id=user_id)
+        return _to_user(rows) if rows else None
+
+    def get_user_version(self, user_id):
+        """The user's version, without reading the rest of it."""
+        return self._version(schema.users, user_id)
 
     def create_user(self, user):
-        series = self._create_user_series(user)
-        self._transaction(series)
-        return self.get_user(user.user_id)
-
-    def update_user(self, user_id, user):
-        # NOTE(thomasem): Breaking apart the create and delete to only
-        # returning the query, or a series of queries, allows me a clean and
-        # transactional way to do an update as well, by removing the old and
-        # creating the new within a single transaction.
-        series = [(self._delete_user_query(user_id),)]
-        series.extend(self._create_user_series(user))
-        self._transaction(series)
-        return self.get_user(user.user_id)
-
-    @staticmethod
-    def _delete_user_query(user_id):
-        return schema.users.delete().where(schema.users.c.id == user_id)
-
-    def delete_user(self, user_id):
-        self.conn.execute(self._delete_user_query(user_id))
+        """Create a user, returning it as written without reading it back.
+
+        Raises IntegrityError if the user exists or a group doesn't.
+        """
+        values = _get_user_values(user)
+        groups = unique(user.groups)
+        self._transaction(_bulk_series(
+            schema.users, values, _get_group_assocs(user.user_id, groups)))
+        return _written_user(values, groups, len(groups))
+
+    def create_users(self, users, atomic=False):
+        """Create many users with chunked executemany inserts.
+
+        Returns one entry per user: the created User, or the exception that
+        kept it from being created. Unless ``atomic`` is set, a failing user
+        does not keep the others from being created.
+        """
+        failures = self._bulk_failures(
+            [u.user_id for u in users], schema.users,
+            [u.groups for u in users], schema.groups,
+            exceptions.GroupNotFound
+        )
+        entries = [(u, _get_user_values(u)) for u in users]
+        self._bulk_write(entries, failures, _create_users_series, atomic,
+                         lambda user_id: self._conflict(
+                             schema.users, user_id, exceptions.GroupNotFound))
+        return [f if f else _created(_written_user, values, u.groups)
+                for (u, values), f in zip(entries, failures)]
+
+    def update_user(self, user_id, user, if_match=None, former=None):
+        """Replace a user, renaming it if its id changes.
+
+        Raises UserNotFound if there is no such user and, with ``if_match``,
+        PreconditionFailed unless it is at one of those versions when the
+        write starts. A ``former`` list is filled with the ids of the groups
+        the user was in as the write found them.
+        """
+        values = _get_user_values(user)
+        groups = unique(user.groups)
+        removed, added = self._update(
+            schema.users, ('user_id', 'group_id'), user_id,
+            values, _get_group_assocs(user.user_id, groups), if_match,
+            exceptions.UserNotFound, former)
+        # Kept memberships stay where they were, in an order only the database
+        # knows; without any, they are in the order given.
+        if user.user_id != user_id or added < len(groups):
+            return self.get_user(user.user_id)
+        return _written_user(values, groups, removed + added)
+
+    def delete_user(self, user_id, if_match=None, former=None):
+        """Delete a user; raises, and fills ``former``, like update_user."""
+        self._delete(schema.users, ('user_id', 'group_id'), user_id,
+                     if_match, exceptions.UserNotFound, former)
 
     def get_group(self, group_id):
-        # NOTE(thomasem): Willing to make two queries because it's in-memory.
-        # for a persistent storage solution, would want to use functionality
-        # that's not available for an in-memory solution, such as sub-query and
-        # array casting, if possible.
-        group_select = schema.groups.select()
-        group_select = group_select.where(schema.groups.c.id == group_id)
-        users_select = schema.user_group_associations.select().where(
-            schema.user_group_associations.c.group_id == group_id
-        )
-        group = self.conn.execute(group_select).fetchone()
-        assocs = self.conn.execute(users_select)
-        return _to_group(group, assocs) if group else None
-
-    def _create_group_series(self, group):
-        group_id = group.group_id
-        group_insert = schema.groups.insert().values(
-            **_get_group_values(group))
-        user_assocs = _get_user_assocs(group_id, group.users)
-
-        series = [(group_insert,)]
-        if user_assocs:
-            series.append(
-                (schema.user_group_associations.insert(), user_assocs)
-            )
-        return series
+        rows = self._read(_group_select(), entity_id=group_id)
+        return _to_group(rows) if rows else None
+
+    def get_group_version(self, group_id):
+        """The group's version, without reading the rest of it."""
+        return self._version(schema.groups, group_id)
 
     def create_group(self, group):
-        series = self._create_group_series(group)
-        self._transaction(series)
-        return self.get_group(group.group_id)
-
-    def update_group(self, group_id, group):
-        # NOTE(thomasem): Breaking apart the create and delete to only
-        # returning the query, or a series of queries, allows me a clean and
-        # transactional way to do an update as well, by removing the old and
-        # creating the new within a single transaction.
-        series = [(self._delete_group_query(group_id),)]
-        series.extend(self._create_group_series(group))
-        self._transaction(series)
-        return self.get_group(group.group_id)
-
-    @staticmethod
-    def _delete_group_query(group_id):
-        return schema.groups.delete().where(schema.groups.c.id == group_id)
-
-    def delete_group(self, group_id):
-        self.conn.execute(self._delete_group_query(group_id))
+        """Create a group; behaves like create_user."""
+        values = _get_group_values(group)
+        users = unique(group.users)
+        self._transaction(_bulk_series(
+            schema.groups, values, _get_user_assocs(group.group_id, users)))
+        return _written_group(values, users, len(users))
+
+    def create_groups(self, groups, atomic=False):
+        """Create many groups with chunked executemany inserts.
+
+        Behaves like create_users.
+        """
+        failures = self._bulk_failures(
+            [g.group_id for g in groups], schema.groups,
+            [g.users for g in groups], schema.users,
+            exceptions.UserNotFound
+        )
+        entries = [(g, _get_group_values(g)) for g in groups]
+        self._bulk_write(entries, failures, _create_groups_series, atomic,
+                         lambda group_id: self._conflict(
+                             schema.groups, group_id, exceptions.UserNotFound))
+        return [f if f else _created(_written_group, values, g.users)
+                for (g, values), f in zip(entries, failures)]
+
+    def update_group(self, group_id, group, if_match=None, former=None):
+        """Replace a group's members, renaming it if its id changes.
+
+        Behaves like update_user, raising GroupNotFound for a missing group
+        and filling ``former`` with its members, and raises ValidationError
+        like update_members.
+        """
+        values = _get_group_values(group)
+        users = unique(group.users)
+        removed, added = self._update(
+            schema.groups, ('group_id', 'user_id'), group_id,
+            values, _get_user_assocs(group.group_id, users), if_match,
+            exceptions.GroupNotFound, former)
+        if group.group_id != group_id or added < len(users):
+            return self.get_group(group.group_id)
+        return _written_group(values, users, removed + added)
+
+    def delete_group(self, group_id, if_match=None, former=None):
+        """Delete a group; raises, and fills ``former``, like update_group."""
+        self._delete(schema.groups, ('group_id', 'user_id'), group_id,
+                     if_match, exceptions.GroupNotFound, former)
+
+    def group_exists(self, group_id):
+        return self._version(schema.groups, group_id) is not None
+
+    def list_member_ids(self, group_id, after=None, limit=None):
+        """Yield the ids of a group's members in order, after ``after``.
+
+        Like the other listings, the page is fetched whole; see _list_ids.
+        """
+        query = _members_page(after is not None, limit is not None)
+        for row in self._read(query, entity_id=group_id, after=after,
+                              limit=limit):
+            yield row.user_id
+
+    def update_members(self, group_id, add=(), remove=()):
+        """Add and remove members without touching the rest of the group.
+
+        Removals are applied first, so a user in both lists ends up a member.
+        Raises GroupNotFound if the group does not exist, UserNotFound if any
+        user to add does not, or ValidationError if it would leave one in
+        more than MAX_USER_GROUPS groups.
+        """
+        add = unique(add)
+        series = [
+            (_members_delete(True), dict(entity_id=group_id, member_ids=chunk))
+            for chunk in _chunks(unique(remove))
+        ]
+        if add:
+            series.append((_insert_or_ignore(schema.user_group_associations),
+                           _get_user_assocs(group_id, add)))
+        # Missing users and groups are found by the write itself; which of them
+        # was missing is only read when it fails.
+        try:
+            changes = self._write(_adding_members(series, add))
+        except sa_exc.IntegrityError:
+            if not self.group_exists(group_id):
+                raise exceptions.GroupNotFound()
+            raise exceptions.UserNotFound()
+        if not (changes or add or self.group_exists(group_id)):
+            raise exceptions.GroupNotFound()
+
+    def remove_member(self, group_id, user_id):
+        """Remove one member, returning whether it was a member at all."""
+        return self._write(lambda conn: conn.execute(
+            _members_delete(False), entity_id=group_id,
+            member_id=user_id).rowcount) > 0
+
+    def snapshot(self, path):
+        """Write a consistent copy of the database to ``path``.
+
+        The copy is written next to ``path`` and renamed over it, so a crash
+        never leaves a partial snapshot behind. Returns its size in bytes.
+        """
+        partial = '{}.partial'.format(path)
+        if os.path.exists(partial):
+            os.remove(partial)
+        # Python 2's sqlite3 has no binding for the online backup API; VACUUM
+        # INTO copies from a single read transaction.
+        if self._shared_reads:
+            self._snapshot_memory(partial)
+        else:
+            with self._reading() as conn:
+                conn.execute(sa.text('VACUUM INTO :path'), path=partial)
+        os.rename(partial, path)
+        return os.path.getsize(path)
+
+    def _snapshot_memory(self, path):
+        if self._memory_uri is None:
+            with self._writing:
+                self.conn.execute(sa.text('VACUUM INTO :path'), path=path)
+            return
+        # Tables of a shared cache can't be written while another connection
+        # reads them, so writes wait for the copy; reads go on through the
+        # write connection meanwhile.
+        with self._write_lock:
+            conn = self._connect_memory()
+            try:
+                conn.execute('VACUUM INTO ?', (path,))
+            finally:
+                conn.close()
+
+    def restore(self, path):
+        """Load the contents of a snapshot into this, empty, database."""
+        with self._writing:
+            self.conn.execute(sa.text('ATTACH DATABASE :path AS snapshot'),
+                              path=path)
+            try:
+                # Run here rather than through the committer, which would wait
+                # on the lock this thread is holding.
+                self._run(_execute([
+                    # Restored entities get new versions; clients revalidate
+                    # once rather than risk a version repeating with different
+                    # contents.
+                    (sa.text('INSERT INTO main.groups (id, version) '
+                             'SELECT id, {} FROM snapshot.groups'.format(
+                                 schema.RANDOM_VERSION)),),
+                    (sa.text('INSERT INTO main.users '
+                             '(id, first_name, last_name, version) '
+                             'SELECT id, first_name, last_name, {} '
+                             'FROM snapshot.users'.format(
+                                 schema.RANDOM_VERSION)),),
+                    (sa.text('INSERT OR IGNORE INTO main.users_groups '
+                             '(user_id, group_id) '
+                             'SELECT user_id, group_id '
+                             'FROM snapshot.users_groups ORDER BY rowid'),),
+                ]))
+            finally:
+                self.conn.execute('DETACH DATABASE snapshot')
@@ -0,0 +1,395 @@
+""" Pure-Python in-memory data access """
+
+import bisect
+import itertools
+import threading
+
+from sqlalchemy import exc as sa_exc
+
+from restytest import exceptions
+from restytest import models
+from restytest.storage import impl
+from restytest.storage import schema
+
+
+def _integrity_error(message):
+    # Raise what the SQLite engine raises for the same violation so callers
+    # don't need to know which engine they're using.
+    return sa_exc.IntegrityError(None, None, Exception(message))
+
+
+def _check_version(versions, entity_id, if_match, missing):
+    if entity_id not in versions:
+        raise missing()
+    if if_match is not None and versions[entity_id] not in if_match:
+        raise exceptions.PreconditionFailed()
+
+
+def _record(former, memberships):
+    """Fill a ``former`` list, if given, like the SQLite engine does."""
+    if former is not None:
+        former[:] = list(memberships)
+
+
+class _SortedKeys(object):
+    """Sorted view of a dict's keys, rebuilt only after keys change."""
+
+    def __init__(self, mapping):
+        self._mapping = mapping
+        self._keys = None
+
+    def changed(self):
+        self._keys = None
+
+    def after(self, after, limit):
+        if self._keys is None:
+            self._keys = sorted(self._mapping)
+        start = 0 if after is None else bisect.bisect_right(self._keys, after)
+        end = None if limit is None else start + limit
+        return self._keys[start:end]
+
+
+class _Memberships(object):
+    """One side's memberships: the other side's ids and sequence numbers.
+
+    Sequence numbers only count up, so a new membership goes on the end of
+    ``_ids`` and the memberships are kept in the order they were added
+    without sorting. A removed membership leaves a gap there, found by
+    bisecting its sequence number, and the gaps are dropped once they make
+    up half of ``_ids``.
+    """
+
+    def __init__(self):
+        self._seqs = {}
+        self._order = []
+        self._ids = []
+        self._gaps = 0
+        self._sorted = _SortedKeys(self._seqs)
+
+    def __contains__(self, other_id):
+        return other_id in self._seqs
+
+    def __iter__(self):
+        return iter(self._seqs)
+
+    def __len__(self):
+        return len(self._seqs)
+
+    def items(self):
+        return self._seqs.items()
+
+    def _index(self, other_id):
+        return bisect.bisect_left(self._order, self._seqs[other_id])
+
+    def add(self, other_id, seq):
+        self._seqs[other_id] = seq
+        self._order.append(seq)
+        self._ids.append(other_id)
+        self._sorted.changed()
+
+    def remove(self, other_id):
+        self._ids[self._index(other_id)] = None
+        del self._seqs[other_id]
+        self._sorted.changed()
+        self._gaps += 1
+        if self._gaps * 2 > len(self._ids):
+            kept = [(seq, i) for seq, i in zip(self._order, self._ids)
+                    if i is not None]
+            self._order = [seq for seq, _ in kept]
+            self._ids = [i for _, i in kept]
+            self._gaps = 0
+
+    def rename(self, old_id, new_id):
+        self._ids[self._index(old_id)] = new_id
+        self._seqs[new_id] = self._seqs.pop(old_id)
+        self._sorted.changed()
+
+    def in_order(self):
+        return [i for i in self._ids if i is not None]
+
+    def after(self, after, limit):
+        return self._sorted.after(after, limit)
+
+
+class MemoryStorage(object):
+    """Storage kept in Python dicts, with the SQLite engine's semantics.
+
+    Users are (first_name, last_name) tuples keyed by id. Memberships are
+    indexed both ways, user -> groups and group -> users, each _Memberships
+    of the other side's ids, so either side's lookup and every cascade only
+    touches that entity's own memberships. They are kept in the order they
+    were added, as the SQLite engine returns them. Every membership change
+    counts up the versions of both sides.
+    """
+
+    def __init__(self):
+        self._users = {}
+        self._user_groups = {}
+        self._group_users = {}
+        self._user_versions = {}
+        self._group_versions = {}
+        self._user_ids = _SortedKeys(self._users)
+        self._group_ids = _SortedKeys(self._group_users)
+        self._sequence = itertools.count()
+        self._lock = threading.RLock()
+
+    def _add_membership(self, user_id, group_id):
+        if group_id not in self._user_groups[user_id]:
+            seq = next(self._sequence)
+            self._user_groups[user_id].add(group_id, seq)
+            self._group_users[group_id].add(user_id, seq)
+            self._bump(user_id, group_id)
+
+    def _remove_membership(self, user_id, group_id):
+        self._user_groups[user_id].remove(group_id)
+        self._group_users[group_id].remove(user_id)
+        self._bump(user_id, group_id)
+
+    def _bump(self, user_id, group_id):
+        self._user_versions[user_id] += 1
+        self._group_versions[group_id] += 1
+
+    def _check_new_user(self, user):
+        if user.user_id in self._users:
+            raise _integrity_error("User {} exists".format(user.user_id))
+        self._check_groups(user.groups)
+
+    def _check_groups(self, group_ids):
+        if any(g not in self._group_users for g in group_ids):
+            raise _integrity_error("Unknown group")
+
+    def _check_users(self, user_ids):
+        if any(u not in self._users for u in user_ids):
+            raise _integrity_error("Unknown user")
+
+    def _check_user_groups(self, user_ids, group_id):
+        """Raise ValidationError unless adding ``user_ids`` to ``group_id``
+        leaves each in at most MAX_USER_GROUPS groups."""
+        for user_id in user_ids:
+            groups = self._user_groups[user_id]
+            if (group_id not in groups and
+                    len(groups) >= models.MAX_USER_GROUPS):
+                raise exceptions.ValidationError()
+
+    def _check_new_group(self, group):
+        if group.group_id in self._group_users:
+            raise _integrity_error("Group {} exists".format(group.group_id))
+        self._check_users(group.users)
+
+    def _insert_user(self, user):
+        self._users[user.user_id] = (user.first_name, user.last_name)
+        self._user_groups[user.user_id] = _Memberships()
+        self._user_versions[user.user_id] = schema.new_version()
+        self._user_ids.changed()
+        for group_id in impl.unique(user.groups):
+            self._add_membership(user.user_id, group_id)
+
+    def _insert_group(self, group):
+        self._group_users[group.group_id] = _Memberships()
+        self._group_versions[group.group_id] = schema.new_version()
+        self._group_ids.changed()
+        for user_id in impl.unique(group.users):
+            self._add_membership(user_id, group.group_id)
+
+    def _set_memberships(self, memberships, wanted, remove, add):
+        keep = set(wanted)
+        for other in [o for o in memberships if o not in keep]:
+            remove(other)
+        for other in impl.unique(wanted):
+            add(other)
+
+    def _user_failure(self, user, seen):
+        if user.user_id in self._users or user.user_id in seen:
+            return exceptions.ResourceAlreadyExists()
+        if any(g not in self._group_users for g in user.groups):
+            return exceptions.GroupNotFound()
+
+    def _group_failure(self, group, seen):
+        if group.group_id in self._group_users or group.group_id in seen:
+            return exceptions.ResourceAlreadyExists()
+        if any(u not in self._users for u in group.users):
+            return exceptions.UserNotFound()
+
+    def list_user_ids(self, after=None, limit=None):
+        with self._lock:
+            return iter(self._user_ids.after(after, limit))
+
+    def list_group_ids(self, after=None, limit=None):
+        with self._lock:
+            return iter(self._group_ids.after(after, limit))
+
+    def get_user(self, user_id):
+        with self._lock:
+            if user_id not in self._users:
+                return None
+            first_name, last_name = self._users[user_id]
+            return models.User(
+                user_id=user_id,
+                first_name=first_name,
+                last_name=last_name,
+                groups=self._user_groups[user_id].in_order(),
+                version=self._user_versions[user_id]
+            )
+
+    def get_user_version(self, user_id):
+        with self._lock:
+            return self._user_versions.get(user_id)
+
+    def create_user(self, user):
+        with self._lock:
+            self._check_new_user(user)
+            self._insert_user(user)
+            return self.get_user(user.user_id)
+
+    def create_users(self, users, atomic=False):
+        with self._lock:
+            return self._bulk_create(users, self._user_failure,
+                                     lambda u: u.user_id, self._insert_user,
+                                     self.get_user, atomic)
+
+    def update_user(self, user_id, user, if_match=None, former=None):
+        with self._lock:
+            _check_version(self._user_versions, user_id, if_match,
+                           exceptions.UserNotFound)
+            self._check_groups(user.groups)
+            _record(former, self._user_groups[user_id])
+            if user.user_id != user_id:
+                self._rename_user(user_id, user.user_id)
+            self._users[user.user_id] = (user.first_name, user.last_name)
+            self._user_versions[user.user_id] = schema.new_version()
+            self._set_memberships(
+                self._user_groups[user.user_id], user.groups,
+                lambda g: self._remove_membership(user.user_id, g),
+                lambda g: self._add_membership(user.user_id, g))
+            return self.get_user(user.user_id)
+
+    def _rename_user(self, old_id, new_id):
+        if new_id in self._users:
+            raise _integrity_error("User {} exists".format(new_id))
+        self._users[new_id] = self._users.pop(old_id)
+        del self._user_versions[old_id]
+        groups = self._user_groups[new_id] = self._user_groups.pop(old_id)
+        for group_id in groups:
+            self._group_users[group_id].rename(old_id, new_id)
+            self._group_versions[group_id] += 1
+        self._user_ids.changed()
+
+    def delete_user(self, user_id, if_match=None, former=None):
+        with self._lock:
+            _check_version(self._user_versions, user_id, if_match,
+                           exceptions.UserNotFound)
+            _record(former, self._user_groups[user_id])
+            for group_id in list(self._user_groups[user_id]):
+                self._remove_membership(user_id, group_id)
+            del self._users[user_id]
+            del self._user_groups[user_id]
+            del self._user_versions[user_id]
+            self._user_ids.changed()
+
+    def group_exists(self, group_id):
+        with self._lock:
+            return group_id in self._group_users
+
+    def get_group(self, group_id):
+        with self._lock:
+            if group_id not in self._group_users:
+                return None
+            return models.Group(
+                group_id=group_id,
+                users=self._group_users[group_id].in_order(),
+                version=self._group_versions[group_id]
+            )
+
+    def get_group_version(self, group_id):
+        with self._lock:
+            return self._group_versions.get(group_id)
+
+    def create_group(self, group):
+        with self._lock:
+            self._check_new_group(group)
+            self._insert_group(group)
+            return self.get_group(group.group_id)
+
+    def create_groups(self, groups, atomic=False):
+        with self._lock:
+            return self._bulk_create(groups, self._group_failure,
+                                     lambda g: g.group_id, self._insert_group,
+                                     self.get_group, atomic)
+
+    def update_group(self, group_id, group, if_match=None, former=None):
+        with self._lock:
+            _check_version(self._group_versions, group_id, if_match,
+                           exceptions.GroupNotFound)
+            self._check_users(group.users)
+            self._check_user_groups(group.users, group_id)
+            _record(former, self._group_users[group_id])
+            if group.group_id != group_id:
+                self._rename_group(group_id, group.group_id)
+            self._group_versions[group.group_id] = schema.new_version()
+            self._set_memberships(
+                self._group_users[group.group_id], group.users,
+                lambda u: self._remove_membership(u, group.group_id),
+                lambda u: self._add_membership(u, group.group_id))
+            return self.get_group(group.group_id)
+
+    def _rename_group(self, old_id, new_id):
+        if new_id in self._group_users:
+            raise _integrity_error("Group {} exists".format(new_id))
+        members = self._group_users[new_id] = self._group_users.pop(old_id)
+        self._group_versions[new_id] = schema.new_version()
+        del self._group_versions[old_id]
+        for user_id in members:
+            self._user_groups[user_id].rename(old_id, new_id)
+            self._user_versions[user_id] += 1
+        self._group_ids.changed()
+
+    def delete_group(self, group_id, if_match=None, former=None):
+        with self._lock:
+            _check_version(self._group_versions, group_id, if_match,
+                           exceptions.GroupNotFound)
+            _record(former, self._group_users[group_id])
+            for user_id in list(self._group_users[group_id]):
+                self._remove_membership(user_id, group_id)
+            del self._group_users[group_id]
+            del self._group_versions[group_id]
+            self._group_ids.changed()
+
+    def list_member_ids(self, group_id, after=None, limit=None):
+        with self._lock:
+            if group_id not in self._group_users:
+                return iter(())
+            return iter(self._group_users[group_id].after(after, limit))
+
+    def update_members(self, group_id, add=(), remove=()):
+        with self._lock:
+            if group_id not in self._group_users:
+                raise exceptions.GroupNotFound()
+            if any(u not in self._users for u in add):
+                raise exceptions.UserNotFound()
+            self._check_user_groups(add, group_id)
+            members = self._group_users[group_id]
+            for user_id in impl.unique(remove):
+                if user_id in members:
+                    self._remove_membership(user_id, group_id)
+            for user_id in impl.unique(add):
+                self._add_membership(user_id, group_id)
+
+    def remove_member(self, group_id, user_id):
+        with self._lock:
+            if user_id not in self._group_users.get(group_id, ()):
+                return False
+            self._remove_membership(user_id, group_id)
+            return True
+
+    def _bulk_create(self, entities, failure_of, key, insert, get, atomic):
+        seen = set()
+        failures = []
+        for entity in entities:
+            failures.append(failure_of(entity, seen))
+            seen.add(key(entity))
+        if atomic and any(failures):
+            return [f if f else exceptions.BatchAborted() for f in failures]
+        for entity, failure in zip(entities, failures):
+            if not failure:
+                insert(entity)
+        return [f if f else get(key(e)) for e, f in zip(entities, failures)]
@@ -0,0 +1,102 @@
+""" Schema migrations for existing databases """
+
+from restytest.storage import schema
+
+
+LEGACY_ASSOCIATIONS = 'users_groups_legacy'
+
+
+def _columns(conn, table):
+    return conn.execute('PRAGMA table_info({})'.format(table.name)).fetchall()
+
+
+def _has_association_key(conn):
+    # The sixth column of table_info is the column's position within the
+    # primary key, or 0 if it is not part of it.
+    return any(column[5] for column in
+               _columns(conn, schema.user_group_associations))
+
+
+def _randomize_versions(conn, table):
+    conn.execute('UPDATE {} SET version = {}'.format(
+        table.name, schema.RANDOM_VERSION))
+
+
+def _triggers(conn):
+    return dict(conn.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'trigger'"
+    ).fetchall())
+
+
+def _add_versions(conn):
+    trans = conn.begin()
+    try:
+        for table in (schema.users, schema.groups):
+            if 'version' in [column[1] for column in _columns(conn, table)]:
+                continue
+            # SQLite can only add a NOT NULL column with a constant default, so
+            # the random versions are filled in after.
+            conn.execute('ALTER TABLE {} ADD COLUMN version BIGINT NOT NULL '
+                         'DEFAULT 0'.format(table.name))
+            _randomize_versions(conn, table)
+        _replace_triggers(conn)
+        trans.commit()
+    except Exception:
+        trans.rollback()
+        raise
+
+
+def _replace_triggers(conn):
+    existing = _triggers(conn)
+    outdated = [name for name, sql in schema.VERSION_TRIGGERS
+                if name in existing and existing[name] != sql]
+    for name, sql in schema.VERSION_TRIGGERS:
+        if name in outdated:
+            conn.execute('DROP TRIGGER {}'.format(name))
+        if existing.get(name) != sql:
+            conn.execute(sql)
+    if outdated:
+        # Versions drawn by the old triggers can be too close to the largest
+        # integer to be counted up from.
+        for table in (schema.users, schema.groups):
+            _randomize_versions(conn, table)
+
+
+def _migrate_associations(conn):
+    table = schema.user_group_associations.name
+    trans = conn.begin()
+    try:
+        conn.execute('ALTER TABLE {} RENAME TO {}'.format(
+            table, LEGACY_ASSOCIATIONS))
+        schema.user_group_associations.create(conn)
+        # Ordering by rowid keeps memberships in the order they were created,
+        # which is the order they are returned in. Older databases didn't
+        # enforce their foreign keys, so memberships of users or groups since
+        # deleted are left behind.
+        conn.execute(
+            'INSERT OR IGNORE INTO {} (user_id, group_id) '
+            'SELECT user_id, group_id FROM {} '
+            'WHERE user_id IN (SELECT id FROM {}) '
+            'AND group_id IN (SELECT id FROM {}) '
+            'ORDER BY rowid'.format(table, LEGACY_ASSOCIATIONS,
+                                    schema.users.name, schema.groups.name)
+        )
+        conn.execute('DROP TABLE {}'.format(LEGACY_ASSOCIATIONS))
+        trans.commit()
+    except Exception:
+        trans.rollback()
+        raise
+
+
+def upgrade(conn):
+    """Bring a database created by an older schema up to date.
+
+    Databases created before the association table had a primary key are
+    rebuilt with the composite key and reverse index, dropping any duplicate
+    or dangling memberships along the way. Users and groups from before
+    versions existed are given one, and the triggers that keep versions up
+    to date are created if missing or replaced if outdated.
+    """
+    if not _has_association_key(conn):
+        _migrate_associations(conn)
+    _add_versions(conn)
@@ -1,14 +1,35 @@
 """ Database schema """
 
+import random
+
 import sqlalchemy as sa
 
 
 metadata = sa.MetaData()
 
+# Versions start out random, so an entity that is deleted and created again can
+# never repeat an earlier version, and then count up with every membership
+# change. Keeping them below 2**62 leaves room to count without overflowing
+# SQLite's 64-bit integers.
+VERSION_BITS = 62
+RANDOM_VERSION = '(random() & {})'.format(2 ** VERSION_BITS - 1)
+
+
+def new_version():
+    """A random version for an entity written in full."""
+    return random.getrandbits(VERSION_BITS)
+
+
+def _version_column():
+    return sa.Column('version', sa.BigInteger, nullable=False,
+                     default=new_version, onupdate=new_version)
+
+
 groups = sa.Table(
     'groups',
     metadata,
     sa.Column('id', sa.String(35), primary_key=True),
+    _version_column(),
 )
 
 users = sa.Table(
@@ -17,13 +38,46 @@ users = sa.Table(
     sa.Column('id', sa.String(35), primary_key=True),
     sa.Column('first_name', sa.String(35)),
     sa.Column('last_name', sa.String(35)),
+    _version_column(),
 )
 
 user_group_associations = sa.Table(
     'users_groups',
     metadata,
     sa.Column('group_id', sa.String(35),
-              sa.ForeignKey('groups.id', ondelete='CASCADE')),
+              sa.ForeignKey('groups.id', ondelete='CASCADE'),
+              nullable=False),
     sa.Column('user_id', sa.String(35),
-              sa.ForeignKey('users.id', ondelete='CASCADE')),
+              sa.ForeignKey('users.id', ondelete='CASCADE'),
+              nullable=False),
+    # The primary key serves lookups and cascades by user, the reverse index
+    # serves the same by group.
+    sa.PrimaryKeyConstraint('user_id', 'group_id',
+                            name='pk_users_groups'),
+    sa.Index('ix_users_groups_group_id_user_id', 'group_id', 'user_id'),
 )
+
+
+def _bump(row):
+    return ('UPDATE users SET version = version + 1 '
+            'WHERE id = {0}.user_id; '
+            'UPDATE groups SET version = version + 1 '
+            'WHERE id = {0}.group_id; '.format(row))
+
+
+# A membership is part of both the user and the group, so every change to one,
+# including those cascaded from deletes, bumps the version of both sides.
+# Counting, rather than drawing a new random version, lets a write work out the
+# versions it leaves behind without reading them.
+VERSION_TRIGGERS = [
+    ('users_groups_inserted',
+     'CREATE TRIGGER users_groups_inserted '
+     'AFTER INSERT ON users_groups BEGIN {} END'.format(_bump('NEW'))),
+    ('users_groups_deleted',
+     'CREATE TRIGGER users_groups_deleted '
+     'AFTER DELETE ON users_groups BEGIN {} END'.format(_bump('OLD'))),
+    ('users_groups_updated',
+     'CREATE TRIGGER users_groups_updated '
+     'AFTER UPDATE ON users_groups BEGIN {} {} END'.format(
+         _bump('OLD'), _bump('NEW'))),
+]
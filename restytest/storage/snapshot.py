@@ -0,0 +1,67 @@
+""" Periodic snapshots of a Storage to a file """
+
+import os
+import sys
+import threading
+import time
+
+
+class Snapshotter(object):
+    """Snapshot a Storage to ``path`` every ``interval`` seconds.
+
+    Snapshots can also be taken on demand with snapshot(). Each one is
+    reported with its duration and size, and the latest is kept in ``last``.
+    """
+
+    def __init__(self, db, path, interval=None, out=sys.stderr):
+        self.db = db
+        self.path = path
+        self.interval = interval
+        self.last = None
+        self._out = out
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def restore(self):
+        """Warm-start the storage from the latest snapshot, if there is one."""
+        if not os.path.exists(self.path):
+            return False
+        start = time.time()
+        self.db.restore(self.path)
+        self._report("Restored", os.path.getsize(self.path),
+                     time.time() - start)
+        return True
+
+    def snapshot(self):
+        with self._lock:
+            start = time.time()
+            size = self.db.snapshot(self.path)
+            self.last = dict(path=self.path, bytes=size,
+                             seconds=time.time() - start)
+        self._report("Snapshot", size, self.last['seconds'])
+        return self.last
+
+    def _report(self, action, size, seconds):
+        self._out.write("{} {} ({} bytes) in {:.3f}s\n".format(
+            action, self.path, size, seconds))
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.snapshot()
+            except Exception as e:
+                self._out.write("Snapshot failed: {}\n".format(e))
+
+    def start(self):
+        if self.interval:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """Stop the periodic snapshots and take a final one."""
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+        self.snapshot()
@@ -0,0 +1,224 @@
+""" Admission control tests """
+import httplib
+import os
+import threading
+import time
+import unittest
+
+import webtest
+
+from restytest.api import admission
+from restytest.api import app
+from restytest.api import metrics
+from restytest.api import server
+
+
+USER = {
+    "userid": "bc",
+    "first_name": "Bumbleywump",
+    "last_name": "Cucumberpatch",
+    "groups": []
+}
+
+
+class TestGate(unittest.TestCase):
+    def _enter_later(self, gate, results):
+        thread = threading.Thread(target=lambda: results.append(gate.enter()))
+        thread.start()
+        while not gate.waiting and thread.is_alive():
+            time.sleep(0.001)
+        return thread
+
+    def test_sheds_when_queue_full(self):
+        gate = admission.Gate(2)
+
+        self.assertIsNone(gate.enter())
+        self.assertIsNone(gate.enter())
+        self.assertEqual(gate.enter(), admission.QUEUE_FULL)
+
+        gate.leave(0.01)
+        self.assertIsNone(gate.enter())
+
+    def test_queued_request_admitted_when_slot_frees(self):
+        gate = admission.Gate(1, queue=1)
+        gate.enter()
+        results = []
+
+        thread = self._enter_later(gate, results)
+        self.assertEqual(gate.enter(), admission.QUEUE_FULL)
+        gate.leave(0.01)
+        thread.join()
+
+        self.assertEqual(results, [None])
+        self.assertEqual(gate.in_flight, 1)
+        self.assertEqual(gate.waiting, 0)
+
+    def test_sheds_after_waiting_out_budget(self):
+        gate = admission.Gate(1, queue=1, budget=0.01)
+        gate.enter()
+
+        self.assertEqual(gate.enter(), admission.LATENCY_BUDGET)
+        self.assertEqual(gate.waiting, 0)
+
+    def test_sheds_expected_to_exceed_budget_at_once(self):
+        gate = admission.Gate(1, queue=10, budget=0.5)
+        gate.enter()
+        gate.leave(2.0)
+        gate.enter()
+
+        start = time.time()
+        self.assertEqual(gate.enter(), admission.LATENCY_BUDGET)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(gate.retry_after(), 2)
+
+
+class TestClientQuota(unittest.TestCase):
+    def test_limits_each_client(self):
+        quota = admission.ClientQuota(1, 'X-Client-Id')
+        client = quota.client({'HTTP_X_CLIENT_ID': 'a', 'REMOTE_ADDR': 'h'})
+        self.assertEqual(client, 'a')
+
+        self.assertTrue(quota.enter(client))
+        self.assertFalse(quota.enter(client))
+        self.assertTrue(quota.enter(quota.client({'REMOTE_ADDR': 'h'})))
+
+        quota.leave(client)
+        self.assertTrue(quota.enter(client))
+
+
+class TestMiddleware(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Metrics()
+        self.reads = admission.Gate(1)
+
+    def tearDown(self):
+        reload(app)
+
+    def _app(self, **kwargs):
+        return webtest.TestApp(admission.Middleware(
+            app.app, metrics=self.registry, **kwargs))
+
+    def test_sheds_full_class(self):
+        test_app = self._app(gates={admission.READ: self.reads})
+        test_app.post_json('/users', USER)
+        self.reads.enter()
+
+        resp = test_app.get('/users/bc', status=503)
+
+        self.assertEqual(resp.headers['Retry-After'], '1')
+        self.assertIn('restytest_requests_shed_total{class="read",'
+                      'reason="queue_full"} 1', self.registry.render())
+        self.reads.leave(0.001)
+        test_app.get('/users/bc')
+        self.assertEqual(self.reads.in_flight, 0)
+
+    def test_classes_limited_separately(self):
+        test_app = self._app(gates={admission.READ: self.reads})
+        self.reads.enter()
+
+        test_app.post_json('/users', USER)
+        test_app.put_json('/users/bc', USER)
+
+    def test_sheds_client_over_quota(self):
+        quota = admission.ClientQuota(1, 'X-Client-Id')
+        test_app = self._app(quota=quota)
+        quota.enter('a')
+
+        resp = test_app.get('/users', headers={'X-Client-Id': 'a'},
+                            status=429)
+        test_app.get('/users', headers={'X-Client-Id': 'b'})
+
+        self.assertIn('Retry-After', resp.headers)
+        self.assertIn('restytest_requests_shed_total{class="read",'
+                      'reason="client_quota"} 1', self.registry.render())
+
+    def test_configured_from_environment(self):
+        self.assertEqual(app._admission(app.app, self.registry).gates, {})
+
+        for name, value in (('RESTYTEST_MAX_WRITES', '2'),
+                            ('RESTYTEST_ADMISSION_QUEUE', '3'),
+                            ('RESTYTEST_CLIENT_QUOTA', '4')):
+            os.environ[name] = value
+            self.addCleanup(os.environ.pop, name)
+        middleware = app._admission(app.app, self.registry)
+
+        self.assertEqual(list(middleware.gates), [admission.WRITE])
+        self.assertEqual(middleware.gates[admission.WRITE].limit, 2)
+        self.assertEqual(middleware.gates[admission.WRITE].queue, 3)
+        self.assertIsNone(middleware.gates[admission.WRITE].budget)
+        self.assertEqual(middleware.quota.limit, 4)
+
+
+class TestCheckWorkers(unittest.TestCase):
+    def test_gated_classes_leave_each_other_workers(self):
+        gates = {admission.READ: admission.Gate(2),
+                 admission.WRITE: admission.Gate(1, queue=1)}
+
+        admission.check_workers(gates, 4)
+        self.assertRaises(ValueError, admission.check_workers, gates, 3)
+
+    def test_ungated_class_keeps_a_worker(self):
+        gates = {admission.WRITE: admission.Gate(2, queue=2)}
+
+        admission.check_workers(gates, 5)
+        admission.check_workers({}, 1)
+        self.assertRaises(ValueError, admission.check_workers, gates, 4)
+
+
+class TestThreadedServer(unittest.TestCase):
+    """Reads are served while writes fill their gate and queue."""
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.writes = []
+
+        def wsgi_app(environ, start_response):
+            if environ['REQUEST_METHOD'] != 'GET':
+                self.writes.append(1)
+                self.release.wait(5)
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return ['']
+
+        gates = {admission.WRITE: admission.Gate(1, queue=1)}
+        admission.check_workers(gates, 3)
+        server._RequestHandler.quiet = True
+        self.server = server.PooledWSGIServer(
+            ('127.0.0.1', 0), server._RequestHandler, workers=3)
+        self.gate = gates[admission.WRITE]
+        self.server.set_app(admission.Middleware(wsgi_app, gates))
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def _request(self, method, results):
+        conn = httplib.HTTPConnection('127.0.0.1', self.server.server_port,
+                                      timeout=5)
+        conn.request(method, '/')
+        results.append((method, conn.getresponse().status))
+
+    def _until(self, condition):
+        for _ in range(500):
+            if condition():
+                return
+            time.sleep(0.01)
+        self.fail("timed out")
+
+    def test_reads_served_while_writes_wait(self):
+        results = []
+        writers = [threading.Thread(target=self._request,
+                                    args=('PUT', results)) for _ in range(2)]
+        [w.start() for w in writers]
+        self._until(lambda: self.writes and self.gate.waiting)
+
+        self._request('GET', results)
+        self.assertEqual(results, [('GET', 200)])
+
+        self.release.set()
+        [w.join() for w in writers]
+        self.assertEqual(sorted(results),
+                         [('GET', 200), ('PUT', 200), ('PUT', 200)])
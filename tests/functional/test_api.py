@@ -1,10 +1,15 @@
 """ API end-to-end tests """
 
+import json
 import unittest
 
+import mock
 import webtest
 
+from restytest import exceptions
+from restytest import models
 from restytest.api import app
+from restytest.api import metrics
 
 
 class APITestBase(unittest.TestCase):
@@ -205,3 +210,406 @@ class TestAPIUsers(APITestBase):
     def test_delete_invalid_userid(self):
         resp = self.app.delete("/users/{}".format("a" * 36), status=400)
         self.assertEqual(resp.status_code, 400)
+
+    def test_write_conflicts(self):
+        user = {
+            "userid": "bc",
+            "first_name": "Bumbleywump",
+            "last_name": "Cucumberpatch",
+            "groups": ["nope"]
+        }
+        self.app.post_json("/users", user, status=404)
+        user['groups'] = []
+        self.app.put_json("/users/bc", user, status=404)
+        self.app.post_json("/users", user)
+        self.app.post_json("/users", dict(user, userid="cb"))
+
+        self.app.put_json("/users/bc", dict(user, groups=["nope"]),
+                          status=404)
+        self.app.put_json("/users/bc", dict(user, userid="cb"), status=409)
+        self.app.delete("/users/nobody", status=404)
+
+
+class TestAPIBulk(APITestBase):
+    def setUp(self):
+        super(TestAPIBulk, self).setUp()
+        self.app.post_json('/groups', {'name': 'admins'})
+        self.app.post_json("/users", {
+            "userid": "thomasem",
+            "first_name": "Thomas",
+            "last_name": "Maddox",
+            "groups": []
+        })
+
+    def _user(self, userid, groups=None):
+        return {
+            "userid": userid,
+            "first_name": "Bumbleywump",
+            "last_name": "Cucumberpatch",
+            "groups": groups or []
+        }
+
+    def test_create_users(self):
+        users = [self._user("bc", ["admins"]), self._user("cb")]
+
+        resp = self.app.post_json("/users/_bulk", users)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['results'], [
+            {"status": 200, "result": users[0]},
+            {"status": 200, "result": users[1]},
+        ])
+        self.assertEqual(self.app.get('/users/bc').json, users[0])
+        self.assertEqual(self.app.get('/groups/admins').json['userids'],
+                         ['bc'])
+
+    def test_create_users_partial_failure(self):
+        users = [
+            self._user("bc"),
+            self._user("thomasem"),
+            self._user("bc"),
+            self._user("cb", ["wookiees"]),
+            {"userid": "x", "first_eman": "Bumbleywump"},
+        ]
+
+        resp = self.app.post_json("/users/_bulk", users)
+
+        self.assertEqual([r['status'] for r in resp.json['results']],
+                         [200, 409, 409, 404, 422])
+        self.app.get('/users/bc')
+        self.app.get('/users/cb', status=404)
+
+    def test_create_users_atomic_failure(self):
+        users = [self._user("bc"), self._user("thomasem")]
+
+        resp = self.app.post_json("/users/_bulk?atomic=true", users)
+
+        self.assertEqual([r['status'] for r in resp.json['results']],
+                         [424, 409])
+        self.app.get('/users/bc', status=404)
+
+    def test_create_users_written_like_single_users(self):
+        resp = self.app.post_json("/users/_bulk",
+                                  [self._user("bc"), self._user("thomasem")])
+
+        self.assertEqual(resp.body,
+                         '{{"results":[{{"status":200,"result":{}}},'
+                         '{{"status":409}}]}}'.format(
+                             self.app.get('/users/bc').body))
+
+    def test_create_users_ndjson(self):
+        body = "\n".join(json.dumps(self._user(u)) for u in ("bc", "cb"))
+
+        resp = self.app.post("/users/_bulk", body,
+                             content_type="application/x-ndjson")
+
+        self.assertEqual([r['status'] for r in resp.json['results']],
+                         [200, 200])
+        self.app.get('/users/cb')
+
+    def test_create_users_not_a_list(self):
+        resp = self.app.post_json("/users/_bulk", self._user("bc"),
+                                  status=422)
+        self.assertEqual(resp.status_code, 422)
+
+    def test_create_users_invalid_json(self):
+        resp = self.app.post("/users/_bulk", "[", status=400)
+        self.assertEqual(resp.status_code, 400)
+
+    def test_create_groups(self):
+        groups = [{"name": "developers"}, {"name": "admins"}, {"foo": "bar"}]
+
+        resp = self.app.post_json("/groups/_bulk", groups)
+
+        self.assertEqual(resp.json['results'], [
+            {"status": 200, "result": {"userids": []}},
+            {"status": 409},
+            {"status": 422},
+        ])
+        self.app.get('/groups/developers')
+
+
+class TestAPIListing(APITestBase):
+    def setUp(self):
+        super(TestAPIListing, self).setUp()
+        self.userids = ["user{:02}".format(i) for i in range(5)]
+        for userid in reversed(self.userids):
+            self.app.post_json("/users", {
+                "userid": userid,
+                "first_name": "Bumbleywump",
+                "last_name": "Cucumberpatch",
+                "groups": []
+            })
+        for group in ("wookiees", "admins"):
+            self.app.post_json('/groups', {'name': group})
+
+    def test_list_users(self):
+        resp = self.app.get("/users")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json, {"userids": self.userids, "next": None})
+
+    def test_list_users_paginated(self):
+        seen = []
+        resp = self.app.get("/users", {"limit": 2})
+        while True:
+            seen.extend(resp.json['userids'])
+            self.assertLessEqual(len(resp.json['userids']), 2)
+            if not resp.json['next']:
+                break
+            resp = self.app.get("/users", {"limit": 2,
+                                           "cursor": resp.json['next']})
+
+        self.assertEqual(seen, self.userids)
+
+    def test_list_users_compact(self):
+        resp = self.app.get("/users", {"limit": 1})
+
+        self.assertEqual(resp.body, '{{"userids":["{}"],"next":"{}"}}'.format(
+            self.userids[0], resp.json['next']))
+
+    def test_list_users_exact_page(self):
+        resp = self.app.get("/users", {"limit": 5})
+
+        self.assertEqual(resp.json, {"userids": self.userids, "next": None})
+
+    def test_list_users_invalid_cursor(self):
+        resp = self.app.get("/users", {"cursor": "!!"}, status=400)
+        self.assertEqual(resp.status_code, 400)
+
+    def test_list_users_invalid_limit(self):
+        self.app.get("/users", {"limit": "ten"}, status=400)
+        self.app.get("/users", {"limit": 0}, status=422)
+        self.app.get("/users", {"limit": 1001}, status=422)
+
+    def test_list_users_storage_error_answered(self):
+        def failing_ids(after, limit):
+            raise exceptions.ValidationError()
+            yield
+
+        with mock.patch.object(app.cntrlr.db, 'list_user_ids', failing_ids):
+            self.app.get("/users", status=422)
+
+    def test_list_groups(self):
+        resp = self.app.get("/groups", {"limit": 1})
+        self.assertEqual(resp.json['names'], ["admins"])
+
+        resp = self.app.get("/groups", {"cursor": resp.json['next']})
+        self.assertEqual(resp.json, {"names": ["wookiees"], "next": None})
+
+
+class TestAPIMembers(APITestBase):
+    def setUp(self):
+        super(TestAPIMembers, self).setUp()
+        self.app.post_json('/groups', {'name': 'admins'})
+        for userid in ("bc", "thomasem", "chewie"):
+            self.app.post_json("/users", {
+                "userid": userid,
+                "first_name": "Bumbleywump",
+                "last_name": "Cucumberpatch",
+                "groups": []
+            })
+
+    def test_add_member(self):
+        resp = self.app.post("/groups/admins/members/bc")
+
+        self.assertEqual(resp.status_code, 204)
+        self.assertEqual(self.app.get("/groups/admins").json['userids'],
+                         ['bc'])
+        self.assertEqual(self.app.get("/users/bc").json['groups'],
+                         ['admins'])
+
+    def test_add_member_twice(self):
+        self.app.post("/groups/admins/members/bc")
+        self.app.post("/groups/admins/members/bc")
+
+        self.assertEqual(self.app.get("/groups/admins").json['userids'],
+                         ['bc'])
+
+    def test_add_member_unknown(self):
+        self.app.post("/groups/admins/members/nobody", status=404)
+        self.app.post("/groups/nothing/members/bc", status=404)
+
+    def test_remove_member(self):
+        self.app.post("/groups/admins/members/bc")
+
+        resp = self.app.delete("/groups/admins/members/bc")
+
+        self.assertEqual(resp.status_code, 204)
+        self.assertEqual(self.app.get("/groups/admins").json['userids'], [])
+        self.app.delete("/groups/admins/members/bc", status=404)
+
+    def test_update_members(self):
+        self.app.post("/groups/admins/members/bc")
+
+        resp = self.app.post_json("/groups/admins/members",
+                                  {"add": ["thomasem", "chewie"],
+                                   "remove": ["bc"]})
+
+        self.assertEqual(resp.status_code, 204)
+        self.assertEqual(self.app.get("/groups/admins").json['userids'],
+                         ['thomasem', 'chewie'])
+
+    def test_members_limited_per_user(self):
+        for i in range(models.MAX_USER_GROUPS - 1):
+            self.app.post_json("/groups", {"name": "g{}".format(i)})
+            self.app.post("/groups/g{}/members/bc".format(i))
+        self.app.post("/groups/admins/members/bc")
+        self.app.post_json("/groups", {"name": "extra"})
+
+        self.app.post("/groups/extra/members/bc", status=422)
+        self.app.post_json("/groups/extra/members", {"add": ["bc"]},
+                           status=422)
+        self.app.put_json("/groups/extra", {"userids": ["bc"]}, status=422)
+
+        user = self.app.get("/users/bc").json
+        self.assertEqual(len(user['groups']), models.MAX_USER_GROUPS)
+        self.app.put_json("/users/bc", user)
+
+    def test_update_members_invalid_json(self):
+        self.app.post_json("/groups/admins/members", {"foo": []}, status=422)
+
+    def test_list_members(self):
+        self.app.post_json("/groups/admins/members",
+                           {"add": ["thomasem", "chewie", "bc"]})
+
+        resp = self.app.get("/groups/admins/members", {"limit": 2})
+        self.assertEqual(resp.json['userids'], ['bc', 'chewie'])
+
+        resp = self.app.get("/groups/admins/members",
+                            {"cursor": resp.json['next']})
+        self.assertEqual(resp.json, {"userids": ['thomasem'], "next": None})
+
+    def test_list_members_unknown_group(self):
+        self.app.get("/groups/nothing/members", status=404)
+
+
+class TestAPIConditional(APITestBase):
+    def setUp(self):
+        super(TestAPIConditional, self).setUp()
+        self.app.post_json("/groups", {"name": "admins"})
+        self.user = {
+            "userid": "bc",
+            "first_name": "Bumbleywump",
+            "last_name": "Cucumberpatch",
+            "groups": ["admins"]
+        }
+        self.etag = self.app.post_json("/users", self.user).headers['ETag']
+
+    def test_get_has_etag(self):
+        resp = self.app.get("/users/bc")
+
+        self.assertEqual(resp.headers['ETag'], self.etag)
+        self.assertIn('ETag', self.app.get("/groups/admins").headers)
+
+    def test_if_none_match(self):
+        resp = self.app.get("/users/bc",
+                            headers={"If-None-Match": self.etag}, status=304)
+
+        self.assertEqual(resp.headers['ETag'], self.etag)
+        self.assertEqual(resp.body, '')
+
+    def test_if_none_match_weak_and_listed(self):
+        self.app.get("/users/bc", status=304, headers={
+            "If-None-Match": '"stale", W/{}'.format(self.etag)})
+
+    def test_if_none_match_changed(self):
+        self.user['first_name'] = "Benedict"
+        self.app.put_json("/users/bc", self.user)
+
+        resp = self.app.get("/users/bc", headers={"If-None-Match": self.etag})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], self.etag)
+
+    def test_membership_change_changes_group_etag(self):
+        etag = self.app.get("/groups/admins").headers['ETag']
+        self.app.delete("/users/bc")
+
+        resp = self.app.get("/groups/admins", headers={"If-None-Match": etag})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['userids'], [])
+
+    def test_if_none_match_unknown(self):
+        self.app.get("/users/nobody", headers={"If-None-Match": self.etag},
+                     status=404)
+
+    def test_put_if_match(self):
+        resp = self.app.put_json("/users/bc", self.user,
+                                 headers={"If-Match": self.etag})
+
+        self.assertNotEqual(resp.headers['ETag'], self.etag)
+        self.app.put_json("/users/bc", self.user,
+                          headers={"If-Match": self.etag}, status=412)
+        self.app.put_json("/users/bc", self.user, headers={"If-Match": "*"})
+
+    def test_put_if_match_weak(self):
+        self.app.put_json("/users/bc", self.user,
+                          headers={"If-Match": "W/" + self.etag}, status=412)
+
+    def test_delete_if_match(self):
+        etag = self.app.get("/groups/admins").headers['ETag']
+        self.app.post_json("/groups/admins/members", {"remove": ["bc"]})
+
+        self.app.delete("/groups/admins", headers={"If-Match": etag},
+                        status=412)
+        etag = self.app.get("/groups/admins").headers['ETag']
+        resp = self.app.delete("/groups/admins", headers={"If-Match": etag})
+
+        self.assertEqual(resp.status_code, 204)
+
+
+class TestAPIStatementBudget(APITestBase):
+    def setUp(self):
+        super(TestAPIStatementBudget, self).setUp()
+        if app._engine() == 'memory':
+            self.skipTest("counts SQL statements")
+        self.app = webtest.TestApp(app.application)
+        self.app.post_json("/groups", {"name": "admins"})
+        self.app.post_json("/groups", {"name": "users"})
+        self.user = {
+            "userid": "bc",
+            "first_name": "Bumbleywump",
+            "last_name": "Cucumberpatch",
+            "groups": ["admins"]
+        }
+
+    def _statements(self, resp):
+        return resp.request.environ[metrics.STATEMENTS_KEY]
+
+    def test_create(self):
+        self.assertEqual(self._statements(
+            self.app.post_json("/users", self.user)), 2)
+        self.assertEqual(self._statements(
+            self.app.post_json("/groups", {"name": "staff"})), 1)
+
+    def test_update(self):
+        self.app.post_json("/users", self.user)
+
+        # The row, stale memberships and new ones; a user keeping memberships
+        # is read back for their order.
+        self.user['groups'] = ['users']
+        resp = self.app.put_json("/users/bc", self.user)
+        self.assertEqual(self._statements(resp), 3)
+        self.assertEqual(resp.headers['ETag'],
+                         self.app.get("/users/bc").headers['ETag'])
+        self.user['groups'] = ['admins', 'users']
+        self.assertEqual(self._statements(
+            self.app.put_json("/users/bc", self.user)), 4)
+
+    def test_delete(self):
+        self.app.post_json("/users", self.user)
+
+        self.assertEqual(self._statements(self.app.delete("/users/bc")), 1)
+        self.assertEqual(self._statements(self.app.delete("/groups/users")),
+                         1)
+
+    def test_members(self):
+        self.app.post_json("/users", self.user)
+
+        # The insert, and the count of the user's groups.
+        self.assertEqual(self._statements(
+            self.app.post("/groups/users/members/bc")), 2)
+        self.assertEqual(self._statements(
+            self.app.delete("/groups/users/members/bc")), 1)
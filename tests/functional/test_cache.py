@@ -0,0 +1,302 @@
+""" Storage cache tests """
+import threading
+import unittest
+
+from restytest import models
+from restytest import storage
+from restytest.storage import cache
+from tests.functional import test_storage
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_get_miss_and_hit(self):
+        lru = cache.LRUCache(2)
+
+        self.assertIsNone(lru.get('a'))
+        lru.set('a', 1)
+        self.assertEqual(lru.get('a'), 1)
+
+        self.assertEqual(lru.stats()['hits'], 1)
+        self.assertEqual(lru.stats()['misses'], 1)
+
+    def test_evicts_least_recently_used(self):
+        lru = cache.LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+
+        lru.set('c', 3)
+
+        self.assertEqual(lru.get('a'), 1)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.get('c'), 3)
+        self.assertEqual(lru.evictions, 1)
+        self.assertEqual(len(lru), 2)
+
+    def test_ttl_expires_entries(self):
+        clock = FakeClock()
+        lru = cache.LRUCache(2, ttl=10, clock=clock)
+        lru.set('a', 1)
+
+        clock.now = 9
+        self.assertEqual(lru.get('a'), 1)
+
+        clock.now = 10
+        self.assertIsNone(lru.get('a'))
+        self.assertEqual(len(lru), 0)
+
+    def test_invalidate(self):
+        lru = cache.LRUCache(2)
+        lru.set('a', 1)
+
+        lru.invalidate('a')
+
+        self.assertIsNone(lru.get('a'))
+
+    def test_set_dropped_after_invalidation(self):
+        lru = cache.LRUCache(2)
+        generation = lru.generation()
+
+        lru.invalidate('a')
+        lru.set('a', 1, generation)
+        lru.set('b', 2, generation)
+
+        self.assertIsNone(lru.get('a'))
+        self.assertEqual(lru.get('b'), 2)
+        lru.set('a', 3, lru.generation())
+        self.assertEqual(lru.get('a'), 3)
+
+    def test_set_dropped_once_invalidation_forgotten(self):
+        lru = cache.LRUCache(1)
+        generation = lru.generation()
+
+        lru.invalidate('a')
+        lru.invalidate('b')
+        lru.set('c', 1, generation)
+
+        self.assertIsNone(lru.get('c'))
+
+
+class CachingStorageMixin(object):
+    def _make_storage(self):
+        return storage.CachingStorage(storage.Storage(), 100)
+
+
+class TestCachedUser(CachingStorageMixin, test_storage.TestUser):
+    pass
+
+
+class TestCachedGroup(CachingStorageMixin, test_storage.TestGroup):
+    pass
+
+
+class TestCachedVersions(CachingStorageMixin, test_storage.TestVersions):
+    pass
+
+
+class PausingStorage(object):
+    """Storage whose next get_user stops after reading until released."""
+
+    def __init__(self, db):
+        self.db = db
+        self.read = threading.Event()
+        self.release = threading.Event()
+        self.pause = False
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+    def get_user(self, user_id):
+        user = self.db.get_user(user_id)
+        if self.pause:
+            self.pause = False
+            self.read.set()
+            self.release.wait(5)
+        return user
+
+
+class InterleavingStorage(object):
+    """Storage that runs ``before_write`` just ahead of its next write."""
+
+    def __init__(self, db):
+        self.db = db
+        self.before_write = None
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+    def _interleave(self):
+        before_write, self.before_write = self.before_write, None
+        if before_write:
+            before_write()
+
+    def update_user(self, *args, **kwargs):
+        self._interleave()
+        return self.db.update_user(*args, **kwargs)
+
+    def delete_group(self, *args, **kwargs):
+        self._interleave()
+        return self.db.delete_group(*args, **kwargs)
+
+
+class TestInvalidation(unittest.TestCase):
+    def setUp(self):
+        self.db = storage.CachingStorage(storage.Storage(), 100)
+        [self.db.create_group(models.Group(g)) for g in ('admins', 'users')]
+        self.db.create_user(models.User("bc", "Bumbleywump", "Cucumberpatch",
+                                        groups=['admins']))
+        # Warm the cache on both sides of the membership.
+        self.db.get_user('bc')
+        [self.db.get_group(g) for g in ('admins', 'users')]
+
+    def test_get_is_cached(self):
+        hits = self.db.cache.hits
+
+        self.db.get_user('bc')
+
+        self.assertEqual(self.db.cache.hits, hits + 1)
+
+    def test_update_user_invalidates_groups(self):
+        self.db.update_user('bc', models.User(
+            "bc", "Bumbleywump", "Cucumberpatch", groups=['users']))
+
+        self.assertEqual(self.db.get_group('admins').users, [])
+        self.assertEqual(self.db.get_group('users').users, ['bc'])
+        self.assertEqual(self.db.get_user('bc').groups, ['users'])
+
+    def test_rename_user_invalidates_old_user(self):
+        self.db.update_user('bc', models.User(
+            "cb", "Bumbleywump", "Cucumberpatch", groups=['admins']))
+
+        self.assertIsNone(self.db.get_user('bc'))
+        self.assertEqual(self.db.get_group('admins').users, ['cb'])
+
+    def test_delete_user_invalidates_groups(self):
+        self.db.delete_user('bc')
+
+        self.assertIsNone(self.db.get_user('bc'))
+        self.assertEqual(self.db.get_group('admins').users, [])
+
+    def test_create_user_invalidates_groups(self):
+        self.db.create_user(models.User("thomasem", "Thomas", "Maddox",
+                                        groups=['users']))
+
+        self.assertEqual(self.db.get_group('users').users, ['thomasem'])
+
+    def test_create_users_invalidates_groups(self):
+        self.db.create_users([models.User("thomasem", "Thomas", "Maddox",
+                                          groups=['users'])])
+
+        self.assertEqual(self.db.get_group('users').users, ['thomasem'])
+
+    def test_create_groups_invalidates_users(self):
+        self.db.create_groups([models.Group('wookiees', users=['bc'])])
+
+        self.assertEqual(self.db.get_user('bc').groups,
+                         ['admins', 'wookiees'])
+
+    def test_update_members_invalidates_both_sides(self):
+        self.db.update_members('users', add=['bc'], remove=[])
+        self.db.update_members('admins', remove=['bc'])
+
+        self.assertEqual(self.db.get_user('bc').groups, ['users'])
+        self.assertEqual(self.db.get_group('admins').users, [])
+
+    def test_remove_member_invalidates_both_sides(self):
+        self.db.remove_member('admins', 'bc')
+
+        self.assertEqual(self.db.get_user('bc').groups, [])
+        self.assertEqual(self.db.get_group('admins').users, [])
+
+    def test_update_group_invalidates_users(self):
+        self.db.update_group('admins', models.Group('admins'))
+        self.db.update_group('users', models.Group('users', users=['bc']))
+
+        self.assertEqual(self.db.get_user('bc').groups, ['users'])
+
+    def test_delete_group_invalidates_users(self):
+        self.db.delete_group('admins')
+
+        self.assertIsNone(self.db.get_group('admins'))
+        self.assertEqual(self.db.get_user('bc').groups, [])
+
+    def test_create_group_invalidates_users(self):
+        self.db.create_group(models.Group('wookiees', users=['bc']))
+
+        self.assertEqual(self.db.get_user('bc').groups,
+                         ['admins', 'wookiees'])
+
+
+class TestConcurrentInvalidation(unittest.TestCase):
+    def setUp(self):
+        self.inner = PausingStorage(storage.Storage())
+        self.db = storage.CachingStorage(self.inner, 100)
+        [self.db.create_group(models.Group(g)) for g in ('admins', 'users')]
+        self.db.create_user(models.User("bc", "Bumbleywump", "Cucumberpatch"))
+        self.db.cache.clear()
+
+    def test_slow_read_does_not_cache_replaced_row(self):
+        self.inner.pause = True
+        reader = threading.Thread(target=self.db.get_user, args=('bc',))
+        reader.start()
+        self.assertTrue(self.inner.read.wait(5))
+
+        self.db.update_user('bc', models.User(
+            "bc", "Bumbleywump", "Cucumberpatch", groups=['admins']))
+        self.inner.release.set()
+        reader.join()
+
+        self.assertEqual(self.db.get_user('bc').groups, ['admins'])
+
+    def test_write_does_not_cache_its_result(self):
+        self.db.update_user('bc', models.User(
+            "bc", "Bumbleywump", "Cucumberpatch", groups=['users']))
+
+        self.assertEqual(len(self.db.cache), 0)
+
+
+class TestInterleavedInvalidation(unittest.TestCase):
+    def setUp(self):
+        self.inner = InterleavingStorage(storage.Storage())
+        self.db = storage.CachingStorage(self.inner, 100)
+        [self.db.create_group(models.Group(g)) for g in ('admins', 'users')]
+        self.db.create_user(models.User("bc", "Bumbleywump", "Cucumberpatch",
+                                        groups=['admins']))
+        self.db.get_user('bc')
+        self.db.get_group('admins')
+
+    def test_update_user_invalidates_membership_added_meanwhile(self):
+        def add_and_read():
+            self.db.update_members('users', add=['bc'])
+            self.db.get_group('users')
+        self.inner.before_write = add_and_read
+
+        self.db.update_user('bc', models.User(
+            "bc", "Bumbleywump", "Cucumberpatch", groups=['admins']))
+
+        self.assertEqual(self.db.get_group('users').users, [])
+        self.assertEqual(self.db.get_group_version('users'),
+                         self.inner.get_group_version('users'))
+
+    def test_delete_group_invalidates_membership_added_meanwhile(self):
+        self.db.create_user(models.User("thomasem", "Thomas", "Maddox"))
+        self.db.get_user('thomasem')
+
+        def add_and_read():
+            self.db.update_members('admins', add=['thomasem'])
+            self.db.get_user('thomasem')
+        self.inner.before_write = add_and_read
+
+        self.db.delete_group('admins')
+
+        self.assertEqual(self.db.get_user('thomasem').groups, [])
+        self.assertEqual(self.db.get_user_version('thomasem'),
+                         self.inner.get_user_version('thomasem'))
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+""" JSON codec tests """
+import json
+import StringIO
+import unittest
+
+from restytest import models
+from restytest.api import codec
+from restytest.api import views
+
+
+class TestCodec(unittest.TestCase):
+    def test_stdlib(self):
+        json_codec = codec.get('json')
+
+        self.assertEqual(json_codec.dumps({"a": [1, "b"]}), '{"a":[1,"b"]}')
+        self.assertEqual(json_codec.load(StringIO.StringIO('{"a": 1}')),
+                         {"a": 1})
+
+    def test_auto_uses_an_installed_codec(self):
+        self.assertIn(codec.get().name, codec.CODECS)
+
+    def test_unknown_codec(self):
+        self.assertRaises(ValueError, codec.get, 'yaml')
+
+    def test_malformed_input(self):
+        for name in codec.CODECS:
+            try:
+                json_codec = codec.get(name)
+            except ImportError:
+                continue
+            self.assertRaises(ValueError, json_codec.loads, '{"a": ')
+
+
+class TestJSONViews(unittest.TestCase):
+    def test_user_json(self):
+        user = models.User(u'bç', u'Bumbley "W"', None,
+                           groups=[u'admins', u'<users>\n'])
+
+        self.assertEqual(json.loads(views.user_json(user)), views.user(user))
+
+    def test_group_json(self):
+        for users in ([], [u'bc', u'thömasem']):
+            group = models.Group(u'admins', users=users)
+
+            self.assertEqual(json.loads(views.group_json(group)),
+                             views.group(group))
@@ -0,0 +1,258 @@
+""" Event loop server tests """
+import httplib
+import json
+import socket
+import threading
+import time
+import unittest
+
+import mock
+
+from restytest.api import app
+from restytest.api import evented
+
+
+USER = {
+    "userid": "bc",
+    "first_name": "Bumbleywump",
+    "last_name": "Cucumberpatch",
+    "groups": []
+}
+USER_JSON = json.dumps(USER)
+
+
+class TestEventedWSGIServer(unittest.TestCase):
+    def setUp(self):
+        self.server = evented.EventedWSGIServer(
+            ('127.0.0.1', 0), app.application, workers=1, quiet=True)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        reload(app)
+
+    def _connection(self):
+        return httplib.HTTPConnection('127.0.0.1', self.server.server_port,
+                                      timeout=5)
+
+    def _socket(self):
+        return socket.create_connection(
+            ('127.0.0.1', self.server.server_port), timeout=5)
+
+    def _response(self, sock):
+        response = httplib.HTTPResponse(sock)
+        response.begin()
+        return response.status, response.read()
+
+    def test_requests_share_a_connection(self):
+        conn = self._connection()
+
+        conn.request('POST', '/users', USER_JSON)
+        resp = conn.getresponse()
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(json.loads(resp.read()), USER)
+
+        conn.request('GET', '/users/bc')
+        resp = conn.getresponse()
+        self.assertEqual(resp.status, 200)
+        self.assertTrue(resp.getheader('ETag'))
+        self.assertEqual(json.loads(resp.read()), USER)
+
+    def test_error_mapping(self):
+        conn = self._connection()
+
+        conn.request('GET', '/users/nope')
+        resp = conn.getresponse()
+        resp.read()
+        self.assertEqual(resp.status, 404)
+
+        conn.request('POST', '/users', '{"userid": ')
+        self.assertEqual(conn.getresponse().status, 400)
+
+    def test_slow_upload_holds_no_worker(self):
+        slow = self._socket()
+        slow.sendall('POST /users HTTP/1.1\r\nContent-Length: {}\r\n\r\n{}'
+                     .format(len(USER_JSON), USER_JSON[:10]))
+
+        # The only worker must still be free to answer.
+        conn = self._connection()
+        conn.request('GET', '/users/bc')
+        self.assertEqual(conn.getresponse().status, 404)
+
+        slow.sendall(USER_JSON[10:])
+        self.assertEqual(self._response(slow)[0], 200)
+
+    def test_pipelined_requests_answered_in_order(self):
+        sock = self._socket()
+        sock.sendall(
+            'POST /users HTTP/1.1\r\nContent-Length: {}\r\n\r\n{}'
+            'GET /users/bc HTTP/1.1\r\n\r\n'
+            'DELETE /users/bc HTTP/1.1\r\nConnection: close\r\n\r\n'
+            .format(len(USER_JSON), USER_JSON))
+
+        self.assertEqual(self._response(sock)[0], 200)
+        status, body = self._response(sock)
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body), USER)
+        self.assertEqual(self._response(sock)[0], 204)
+        self.assertEqual(sock.recv(1), '')
+
+    def test_expect_continue(self):
+        sock = self._socket()
+        sock.sendall('POST /users HTTP/1.1\r\nContent-Length: {}\r\n'
+                     'Expect: 100-continue\r\n\r\n'.format(len(USER_JSON)))
+
+        self.assertEqual(sock.recv(len(evented.CONTINUE)), evented.CONTINUE)
+        sock.sendall(USER_JSON)
+        self.assertEqual(self._response(sock)[0], 200)
+
+    def test_chunked_body_rejected(self):
+        sock = self._socket()
+        sock.sendall('POST /users HTTP/1.1\r\n'
+                     'Transfer-Encoding: chunked\r\n\r\n')
+
+        self.assertEqual(self._response(sock)[0], 411)
+
+    def test_malformed_request_line(self):
+        sock = self._socket()
+        sock.sendall('nonsense\r\n\r\n')
+
+        self.assertEqual(self._response(sock)[0], 400)
+
+    def test_request_line_with_extra_spaces(self):
+        sock = self._socket()
+        sock.sendall('GET  /users/bc HTTP/1.1 extra\r\n\r\n')
+
+        self.assertEqual(self._response(sock)[0], 400)
+
+    def test_bare_line_feeds(self):
+        sock = self._socket()
+        sock.sendall('POST /users HTTP/1.1\nContent-Length: {}\n\n{}'
+                     'GET /users/bc HTTP/1.1\nConnection: close\n\n'
+                     .format(len(USER_JSON), USER_JSON))
+
+        self.assertEqual(self._response(sock)[0], 200)
+        status, body = self._response(sock)
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body), USER)
+
+    def test_absolute_form_target(self):
+        conn = self._connection()
+        conn.request('POST', '/users', USER_JSON)
+        conn.getresponse().read()
+        sock = self._socket()
+
+        sock.sendall('GET http://example.com/users/bc?x=1 HTTP/1.1\r\n'
+                     'Host: 127.0.0.1\r\n\r\n')
+
+        status, body = self._response(sock)
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body), USER)
+
+    def test_failed_response_closes_only_its_connection(self):
+        failing = self._socket()
+        respond = evented._Connection.respond
+
+        def fail_once(connection, *args):
+            evented._Connection.respond = respond
+            raise RuntimeError('respond failed')
+
+        with mock.patch('traceback.print_exc'):
+            evented._Connection.respond = fail_once
+            try:
+                failing.sendall('GET /users/bc HTTP/1.1\r\n\r\n')
+                self.assertEqual(failing.recv(1), '')
+            finally:
+                evented._Connection.respond = respond
+
+        conn = self._connection()
+        conn.request('GET', '/users/bc')
+        self.assertEqual(conn.getresponse().status, 404)
+
+    def test_events_only_poll_their_own_connection(self):
+        idle = [self._socket() for _ in range(50)]
+        conn = self._connection()
+        conn.request('GET', '/users/bc')
+        conn.getresponse().read()
+
+        with mock.patch.object(evented._Connection, 'readable', autospec=True,
+                               side_effect=evented._Connection.readable) as r:
+            conn.request('GET', '/users/bc')
+            self.assertEqual(conn.getresponse().status, 404)
+
+        # Polling every connection once per turn of the loop would ask each
+        # idle one at least once.
+        self.assertLess(r.call_count, len(idle) / 5)
+
+
+class TestIdleTimeout(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+
+        def wsgi_app(environ, start_response):
+            self.release.wait(5)
+            start_response('204 No Content', [])
+            return []
+
+        self.server = evented.EventedWSGIServer(
+            ('127.0.0.1', 0), wsgi_app, workers=1, quiet=True,
+            idle_timeout=0.2)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.release.set()
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def _socket(self):
+        return socket.create_connection(
+            ('127.0.0.1', self.server.server_port), timeout=5)
+
+    def test_idle_connection_closed(self):
+        sock = self._socket()
+        start = time.time()
+
+        self.assertEqual(sock.recv(1), '')
+        self.assertLess(time.time() - start, 2)
+
+    def test_half_sent_request_closed(self):
+        sock = self._socket()
+        sock.sendall('POST / HTTP/1.1\r\nContent-Length: 10\r\n\r\n12345')
+
+        self.assertEqual(sock.recv(1), '')
+        self.assertFalse(any(isinstance(c, evented._Connection)
+                             for c in self.server.socket_map.values()))
+
+    def test_request_with_a_worker_kept_open(self):
+        sock = self._socket()
+        sock.sendall('GET / HTTP/1.1\r\n\r\n')
+        time.sleep(0.8)
+        self.release.set()
+
+        response = httplib.HTTPResponse(sock)
+        response.begin()
+        self.assertEqual(response.status, 204)
+
+
+class TestCallApplication(unittest.TestCase):
+    def test_closes_body(self):
+        closed = []
+
+        class Body(list):
+            def close(self):
+                closed.append(True)
+
+        def wsgi_app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return Body(['a', 'b'])
+
+        result = evented.call_application(wsgi_app, {})
+
+        self.assertEqual(result, ('200 OK', [('Content-Type', 'text/plain')],
+                                  'ab'))
+        self.assertEqual(closed, [True])
@@ -0,0 +1,114 @@
+""" Request instrumentation tests """
+import unittest
+
+import webtest
+
+from restytest import storage
+from restytest.api import app
+from restytest.api import metrics
+
+
+USER = {
+    "userid": "bc",
+    "first_name": "Bumbleywump",
+    "last_name": "Cucumberpatch",
+    "groups": []
+}
+
+
+class TestHistogram(unittest.TestCase):
+    def test_cumulative(self):
+        histogram = metrics.Histogram((1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value)
+
+        self.assertEqual(list(histogram.cumulative()),
+                         [(1, 2), (5, 3), ('+Inf', 4)])
+        self.assertEqual(histogram.sum, 14.5)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_render(self):
+        registry = metrics.Metrics()
+        registry.started()
+        registry.finished('/users', 'GET', '200', 0.002, 0, 100, 1)
+
+        text = registry.render()
+
+        self.assertIn('# TYPE restytest_request_duration_seconds histogram',
+                      text)
+        self.assertIn(
+            'restytest_request_duration_seconds_bucket{route="/users",'
+            'method="GET",status="200",le="0.0025"} 1', text)
+        self.assertIn('restytest_response_size_bytes_sum{route="/users",'
+                      'method="GET"} 100', text)
+        self.assertIn('restytest_requests_in_flight 0', text)
+
+    def test_escapes_labels(self):
+        registry = metrics.Metrics()
+        registry.finished('/a"b', 'GET', '200', 0, 0, 0, 0)
+
+        self.assertIn('route="/a\\"b"', registry.render())
+
+    def test_render_cache_stats(self):
+        db = storage.CachingStorage(storage.Storage(), 10)
+        db.get_user('missing')
+
+        text = metrics.Metrics().render(db)
+
+        self.assertIn('restytest_cache_misses_total 1', text)
+        self.assertIn('restytest_cache_entries 0', text)
+
+
+class TestMiddleware(unittest.TestCase):
+    def setUp(self):
+        self.app = webtest.TestApp(app.application)
+
+    def tearDown(self):
+        reload(app)
+
+    def _metrics(self):
+        resp = self.app.get(metrics.METRICS_PATH)
+        self.assertEqual(resp.content_type, 'text/plain')
+        return resp.text
+
+    def test_records_route_and_status(self):
+        self.app.post_json('/users', USER)
+        self.app.get('/users/bc')
+        self.app.get('/users/nope', status=404)
+
+        text = self._metrics()
+
+        self.assertIn('restytest_request_duration_seconds_count{'
+                      'route="/users/<userid>",method="GET",status="200"} 1',
+                      text)
+        self.assertIn('restytest_request_duration_seconds_count{'
+                      'route="/users/<userid>",method="GET",status="404"} 1',
+                      text)
+        self.assertIn('restytest_requests_in_flight 0', text)
+
+    def test_unmatched_route(self):
+        self.app.get('/nowhere', status=404)
+
+        self.assertIn('route="unmatched",method="GET",status="404"',
+                      self._metrics())
+
+    def test_counts_statements(self):
+        self.app.post_json('/users', USER)
+        before = metrics.statement_count()
+
+        self.app.get('/users/bc')
+
+        statements = metrics.statement_count() - before
+        self.assertGreater(statements, 0)
+        self.assertIn('restytest_storage_statements_sum{'
+                      'route="/users/<userid>",method="GET"} ' +
+                      str(statements), self._metrics())
+
+    def test_records_sizes_of_streamed_bodies(self):
+        self.app.post_json('/users', USER)
+        resp = self.app.get('/users')
+
+        self.assertIn('restytest_response_size_bytes_sum{'
+                      'route="/users",method="GET"} ' + str(len(resp.body)),
+                      self._metrics())
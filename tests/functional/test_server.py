@@ -0,0 +1,116 @@
+""" Server mode tests """
+import httplib
+import os
+import threading
+import unittest
+
+import mock
+
+from restytest.api import admission
+from restytest.api import app
+from restytest.api import evented
+from restytest.api import server
+
+
+class TestPooledWSGIServer(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.in_flight = []
+
+        def wsgi_app(environ, start_response):
+            self.in_flight.append(environ['PATH_INFO'])
+            self.release.wait(5)
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [environ['PATH_INFO']]
+
+        server._RequestHandler.quiet = True
+        self.server = server.PooledWSGIServer(
+            ('127.0.0.1', 0), server._RequestHandler, workers=2)
+        self.server.set_app(wsgi_app)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def _get(self, path, results):
+        conn = httplib.HTTPConnection('127.0.0.1', self.server.server_port)
+        conn.request('GET', path)
+        results.append(conn.getresponse().read())
+
+    def test_requests_served_concurrently(self):
+        results = []
+        clients = [threading.Thread(target=self._get, args=(p, results))
+                   for p in ('/a', '/b')]
+        [c.start() for c in clients]
+
+        # Both requests must be in flight at once for either of them to be
+        # released.
+        for _ in range(500):
+            if len(self.in_flight) == 2:
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(sorted(self.in_flight), ['/a', '/b'])
+
+        self.release.set()
+        [c.join() for c in clients]
+        self.assertEqual(sorted(results), ['/a', '/b'])
+
+
+class TestServerOptions(unittest.TestCase):
+    def test_wsgiref(self):
+        self.assertEqual(app._server_options('wsgiref'), {})
+
+    def test_threaded_workers(self):
+        with mock.patch.dict(os.environ, {'RESTYTEST_WORKERS': '16'}):
+            self.assertEqual(app._server_options('threaded'), {'workers': 16})
+
+    def test_evented_workers(self):
+        with mock.patch.dict(os.environ, {'RESTYTEST_WORKERS': '2'}):
+            self.assertEqual(app._server_options('evented'),
+                             {'workers': 2,
+                              'idle_timeout': evented.IDLE_TIMEOUT})
+
+    def test_evented_idle_timeout(self):
+        with mock.patch.dict(os.environ, {'RESTYTEST_IDLE_TIMEOUT': '2.5'}):
+            self.assertEqual(
+                app._server_options('evented')['idle_timeout'], 2.5)
+        with mock.patch.dict(os.environ, {'RESTYTEST_IDLE_TIMEOUT': '0'}):
+            self.assertIsNone(app._server_options('evented')['idle_timeout'])
+
+    def test_admission_must_leave_reads_a_worker(self):
+        gates = {admission.WRITE: admission.Gate(2, queue=2)}
+        with mock.patch.object(app.admitter, 'gates', gates):
+            with mock.patch.dict(os.environ, {'RESTYTEST_WORKERS': '4'}):
+                with self.assertRaises(ValueError):
+                    app._server_options('threaded')
+            with mock.patch.dict(os.environ, {'RESTYTEST_WORKERS': '5'}):
+                self.assertEqual(app._server_options('evented')['workers'],
+                                 5)
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            app._server_options('gevent')
+
+    def test_prefork_requires_file_database(self):
+        with mock.patch.dict(os.environ, {}, clear=True):
+            with self.assertRaises(ValueError):
+                app._server_options('prefork')
+
+    def test_prefork_rejects_cache(self):
+        env = {'RESTYTEST_DB_URI': 'sqlite:////tmp/restytest.db',
+               'RESTYTEST_CACHE_SIZE': '100'}
+        with mock.patch.dict(os.environ, env, clear=True):
+            with self.assertRaises(ValueError):
+                app._server_options('prefork')
+
+    def test_prefork(self):
+        env = {'RESTYTEST_DB_URI': 'sqlite:////tmp/restytest.db'}
+        with mock.patch.dict(os.environ, env, clear=True):
+            options = app._server_options('prefork')
+
+        self.assertEqual(options['workers'], server.DEFAULT_WORKERS)
+        self.assertEqual(options['on_fork'], app._reconnect)
@@ -0,0 +1,138 @@
+""" Storage snapshot tests """
+import os
+import shutil
+import StringIO
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+
+from restytest import models
+from restytest import storage
+from restytest.storage import impl
+from restytest.storage import snapshot
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.workdir, 'snapshot.db')
+        self.out = StringIO.StringIO()
+
+        self.db = storage.Storage()
+        for group_id in ('users', 'admins'):
+            self.db.create_group(models.Group(group_id))
+        self.db.create_user(models.User("bc", "Bumbleywump", "Cucumberpatch",
+                                        groups=['users', 'admins']))
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_snapshot_and_restore(self):
+        snapshot.Snapshotter(self.db, self.path, out=self.out).snapshot()
+
+        restored = storage.Storage()
+        self.assertTrue(
+            snapshot.Snapshotter(restored, self.path, out=self.out).restore())
+
+        user = restored.get_user("bc")
+        self.assertEqual(user.first_name, "Bumbleywump")
+        self.assertEqual(user.groups, ['users', 'admins'])
+        self.assertEqual(restored.get_group('admins').users, ['bc'])
+
+    def test_snapshot_reports_size_and_duration(self):
+        snapshots = snapshot.Snapshotter(self.db, self.path, out=self.out)
+
+        result = snapshots.snapshot()
+
+        self.assertEqual(result['bytes'], os.path.getsize(self.path))
+        self.assertGreaterEqual(result['seconds'], 0)
+        self.assertEqual(snapshots.last, result)
+        self.assertIn("bytes", self.out.getvalue())
+
+    def test_snapshot_replaces_previous(self):
+        snapshots = snapshot.Snapshotter(self.db, self.path, out=self.out)
+        snapshots.snapshot()
+        self.db.delete_user("bc")
+
+        snapshots.snapshot()
+
+        restored = storage.Storage()
+        restored.restore(self.path)
+        self.assertIsNone(restored.get_user("bc"))
+        self.assertEqual(os.listdir(self.workdir), ['snapshot.db'])
+
+    def test_memory_snapshot_leaves_reads_running(self):
+        started = threading.Event()
+        release = threading.Event()
+        connect = self.db._connect_memory
+
+        class SlowConnection(object):
+            def __init__(self):
+                self.conn = connect()
+
+            def execute(self, *args):
+                started.set()
+                release.wait(5)
+                return self.conn.execute(*args)
+
+            def close(self):
+                self.conn.close()
+
+        self.db._connect_memory = SlowConnection
+        snapshots = snapshot.Snapshotter(self.db, self.path, out=self.out)
+        thread = threading.Thread(target=snapshots.snapshot)
+        thread.start()
+        self.assertTrue(started.wait(5))
+
+        written = []
+        writer = threading.Thread(target=lambda: written.append(
+            self.db.delete_user("bc")))
+        writer.start()
+        self.assertEqual(self.db.get_user("bc").groups, ['users', 'admins'])
+        writer.join(0.05)
+        self.assertEqual(written, [])
+
+        release.set()
+        thread.join()
+        writer.join()
+        self.assertIsNone(self.db.get_user("bc"))
+        restored = storage.Storage()
+        restored.restore(self.path)
+        self.assertIsNotNone(restored.get_user("bc"))
+
+    def test_memory_snapshot_without_uri_filenames(self):
+        with mock.patch.object(impl, 'URI_FILENAMES', False):
+            db = storage.Storage()
+        db.create_group(models.Group('admins'))
+
+        db.snapshot(self.path)
+
+        restored = storage.Storage()
+        restored.restore(self.path)
+        self.assertIsNotNone(restored.get_group('admins'))
+        self.assertEqual(os.listdir(self.workdir), ['snapshot.db'])
+
+    def test_memory_uri_opened_as_file_is_refused(self):
+        uri = os.path.join(self.workdir, 'restytest-{}-{}')
+
+        with mock.patch.object(impl, 'SHARED_MEMORY_URI', uri):
+            with self.assertRaises(RuntimeError):
+                storage.Storage()
+
+    def test_restore_without_snapshot(self):
+        snapshots = snapshot.Snapshotter(self.db, self.path, out=self.out)
+
+        self.assertFalse(snapshots.restore())
+
+    def test_periodic_snapshots(self):
+        snapshots = snapshot.Snapshotter(self.db, self.path, interval=0.01,
+                                         out=self.out)
+        snapshots.start()
+        time.sleep(0.1)
+
+        snapshots.stop()
+
+        self.assertGreater(self.out.getvalue().count("Snapshot"), 1)
@@ -1,18 +1,45 @@
 """ SQLite access layer tests"""
+import os
+import random
+import sqlite3
+import tempfile
+import threading
 import unittest
 
+import mock
+import sqlalchemy as sa
+from sqlalchemy import exc as sa_exc
+
+from restytest import exceptions
 from restytest import models
 from restytest import storage
+from restytest.storage import impl
 from restytest.storage import schema
 
 
 class StorageTestBase(unittest.TestCase):
     def setUp(self):
-        self.db = storage.Storage()
+        self.db = self._make_storage()
+
+    def _make_storage(self):
+        return storage.Storage()
 
     def _get_assocs(self):
         return self.db.conn.execute(schema.user_group_associations.select())
 
+    def _count_statements(self, func, *args):
+        statements = []
+
+        def count(*args):
+            statements.append(args[2])
+
+        sa.event.listen(self.db.conn, 'before_cursor_execute', count)
+        try:
+            result = func(*args)
+        finally:
+            sa.event.remove(self.db.conn, 'before_cursor_execute', count)
+        return result, len(statements)
+
 
 class TestUser(StorageTestBase):
     def setUp(self):
@@ -258,3 +285,1030 @@ class TestTransaction(StorageTestBase):
         result = self.db.get_user('bc')
 
         self.assertIsNone(result)
+
+
+class TestAssociationKeys(StorageTestBase):
+    def setUp(self):
+        super(TestAssociationKeys, self).setUp()
+        self.db.create_group(models.Group('admins'))
+
+    def test_duplicate_memberships_are_stored_once(self):
+        user = models.User(
+            user_id="bc",
+            first_name="Bumbleywump",
+            last_name="Cucumberpatch",
+            groups=['admins', 'admins'],
+        )
+
+        result = self.db.create_user(user)
+
+        self.assertEqual(result.groups, ['admins'])
+        self.assertEqual(len(list(self._get_assocs())), 1)
+
+    def test_duplicate_association_insert_fails(self):
+        self.db.create_user(models.User("bc", "Bumbleywump", "Cucumberpatch",
+                                        groups=['admins']))
+
+        with self.assertRaises(sa_exc.IntegrityError):
+            self.db.conn.execute(
+                schema.user_group_associations.insert().values(
+                    user_id="bc", group_id="admins"))
+
+    def test_lookups_use_indexes(self):
+        plans = [
+            "EXPLAIN QUERY PLAN SELECT * FROM users_groups WHERE user_id='bc'",
+            "EXPLAIN QUERY PLAN SELECT * FROM users_groups "
+            "WHERE group_id='admins'",
+        ]
+        for plan in plans:
+            rows = self.db.conn.execute(plan)
+            detail = " ".join(str(row[-1]) for row in rows)
+            self.assertIn("USING", detail)
+
+
+class TestJoinedFetch(StorageTestBase):
+    def setUp(self):
+        super(TestJoinedFetch, self).setUp()
+        [self.db.create_group(models.Group(g)) for g in ('users', 'admins')]
+        self.db.create_user(models.User("bc", "Bumbleywump", "Cucumberpatch",
+                                        groups=['users', 'admins']))
+        self.db.create_user(models.User("thomasem", "Thomas", "Maddox"))
+
+    def test_get_user_single_statement(self):
+        result, count = self._count_statements(self.db.get_user, 'bc')
+
+        self.assertEqual(count, 1)
+        self.assertEqual(result.groups, ['users', 'admins'])
+
+    def test_get_user_without_groups_single_statement(self):
+        result, count = self._count_statements(self.db.get_user, 'thomasem')
+
+        self.assertEqual(count, 1)
+        self.assertEqual(result.first_name, 'Thomas')
+        self.assertEqual(result.groups, [])
+
+    def test_get_user_not_exists_single_statement(self):
+        result, count = self._count_statements(self.db.get_user, 'nobody')
+
+        self.assertEqual(count, 1)
+        self.assertIsNone(result)
+
+    def test_get_group_single_statement(self):
+        result, count = self._count_statements(self.db.get_group, 'users')
+
+        self.assertEqual(count, 1)
+        self.assertEqual(result.users, ['bc'])
+
+    def test_get_group_without_users_single_statement(self):
+        self.db.create_group(models.Group('empty'))
+
+        result, count = self._count_statements(self.db.get_group, 'empty')
+
+        self.assertEqual(count, 1)
+        self.assertEqual(result.group_id, 'empty')
+        self.assertEqual(result.users, [])
+
+
+class TestStatementCache(StorageTestBase):
+    def setUp(self):
+        super(TestStatementCache, self).setUp()
+        [self.db.create_group(models.Group(g)) for g in ('users', 'admins')]
+        for user_id in ('bc', 'thomasem'):
+            self.db.create_user(models.User(user_id, "F", "L"))
+        self.compiled = self.db.engine.get_execution_options()[
+            'compiled_cache']
+
+    def _calls(self, user_id, groups):
+        self.db.get_user(user_id)
+        self.db.update_user(user_id, models.User(user_id, "G", "L",
+                                                 groups=groups))
+        self.db.update_members('users', add=[user_id], remove=[user_id])
+
+    def test_statements_compiled_once(self):
+        self._calls('bc', ['admins'])
+        compiled = len(self.compiled)
+
+        self._calls('thomasem', ['users'])
+
+        self.assertEqual(len(self.compiled), compiled)
+
+    def _compiled_per_read(self, db):
+        compiled = []
+
+        def record(conn, cursor, statement, params, context, executemany):
+            compiled.append(context.compiled)
+
+        sa.event.listen(db.engine, 'before_cursor_execute', record)
+        db.get_user('bc')
+        db.get_user('bc')
+        return compiled
+
+    def test_cache_reuses_compiled_statements(self):
+        first, second = self._compiled_per_read(self.db)
+
+        self.assertIs(first, second)
+
+    def test_cache_disabled(self):
+        db = storage.Storage(statement_cache=0)
+        db.create_user(models.User("bc", "F", "L"))
+
+        first, second = self._compiled_per_read(db)
+
+        self.assertIsNot(first, second)
+        self.assertEqual(db.get_user('bc').first_name, "F")
+
+
+class FileStorageMixin(object):
+    profile = impl.DEFAULT_PROFILE
+
+    def _make_storage(self):
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+        return storage.Storage('sqlite:///{}'.format(self.path),
+                               self.profile)
+
+
+class TestFileUser(FileStorageMixin, TestUser):
+    pass
+
+
+class TestFileGroup(FileStorageMixin, TestGroup):
+    pass
+
+
+class TestProfiles(FileStorageMixin, unittest.TestCase):
+    def _pragma(self, db, name):
+        return db._reader().execute('PRAGMA {}'.format(name)).scalar()
+
+    def test_default_profile(self):
+        db = self._make_storage()
+
+        self.assertEqual(self._pragma(db, 'journal_mode'), 'wal')
+        self.assertEqual(self._pragma(db, 'synchronous'), 1)
+        self.assertEqual(self._pragma(db, 'temp_store'), 2)
+        self.assertEqual(self._pragma(db, 'foreign_keys'), 1)
+
+    def test_stock_profile(self):
+        self.profile = 'stock'
+        db = self._make_storage()
+
+        self.assertEqual(self._pragma(db, 'journal_mode'), 'delete')
+        self.assertEqual(self._pragma(db, 'foreign_keys'), 1)
+
+    def test_unknown_profile(self):
+        self.profile = 'reckless'
+
+        with self.assertRaises(ValueError):
+            self._make_storage()
+
+    def test_memory_is_not_tuned(self):
+        db = storage.Storage()
+
+        self.assertEqual(self._pragma(db, 'journal_mode'), 'memory')
+
+
+class TestMigration(unittest.TestCase):
+    LEGACY_SCHEMA = [
+        "CREATE TABLE groups (id VARCHAR(35) NOT NULL, PRIMARY KEY (id))",
+        "CREATE TABLE users (id VARCHAR(35) NOT NULL, "
+        "first_name VARCHAR(35), last_name VARCHAR(35), PRIMARY KEY (id))",
+        "CREATE TABLE users_groups ("
+        "group_id VARCHAR(35) REFERENCES groups (id) ON DELETE CASCADE, "
+        "user_id VARCHAR(35) REFERENCES users (id) ON DELETE CASCADE)",
+        "INSERT INTO groups VALUES ('users'), ('admins')",
+        "INSERT INTO users VALUES ('bc', 'Bumbleywump', 'Cucumberpatch')",
+        "INSERT INTO users_groups VALUES ('users', 'bc'), ('admins', 'bc'), "
+        "('users', 'bc')",
+    ]
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.uri = 'sqlite:///{}'.format(self.path)
+
+        conn = sqlite3.connect(self.path)
+        for statement in self.LEGACY_SCHEMA:
+            conn.execute(statement)
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_upgrade_adds_keys(self):
+        db = storage.Storage(self.uri)
+
+        pk = sa.inspect(db.conn).get_pk_constraint('users_groups')
+        indexes = sa.inspect(db.conn).get_indexes('users_groups')
+
+        self.assertEqual(pk['constrained_columns'], ['user_id', 'group_id'])
+        self.assertIn(['group_id', 'user_id'],
+                      [i['column_names'] for i in indexes])
+
+    def test_upgrade_keeps_memberships(self):
+        db = storage.Storage(self.uri)
+
+        self.assertEqual(db.get_user('bc').groups, ['users', 'admins'])
+        self.assertEqual(db.get_group('users').users, ['bc'])
+
+    def test_upgrade_drops_dangling_and_duplicate_memberships(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("INSERT INTO users_groups VALUES ('users', 'gone'), "
+                     "('gone', 'bc'), ('admins', 'bc')")
+        conn.commit()
+        conn.close()
+
+        db = storage.Storage(self.uri)
+
+        self.assertEqual(db.get_user('bc').groups, ['users', 'admins'])
+        self.assertEqual(sorted(tuple(a) for a in db.conn.execute(
+            'SELECT user_id, group_id FROM users_groups')),
+            [('bc', 'admins'), ('bc', 'users')])
+
+    def test_upgrade_adds_versions(self):
+        db = storage.Storage(self.uri)
+        version = db.get_group_version('users')
+        self.assertIsNotNone(version)
+
+        db.remove_member('users', 'bc')
+
+        self.assertNotEqual(db.get_group_version('users'), version)
+
+    def test_upgrade_is_idempotent(self):
+        storage.Storage(self.uri)
+        db = storage.Storage(self.uri)
+
+        self.assertEqual(db.get_user('bc').groups, ['users', 'admins'])
+
+    def test_upgrade_replaces_outdated_triggers(self):
+        storage.Storage(self.uri)
+        conn = sqlite3.connect(self.path)
+        conn.execute('DROP TRIGGER users_groups_deleted')
+        conn.execute('CREATE TRIGGER users_groups_deleted AFTER DELETE ON '
+                     'users_groups BEGIN UPDATE groups SET version = random() '
+                     'WHERE id = OLD.group_id; END')
+        conn.commit()
+        conn.close()
+
+        db = storage.Storage(self.uri)
+        version = db.get_group_version('users')
+        db.remove_member('users', 'bc')
+
+        self.assertEqual(db.get_group_version('users'), version + 1)
+
+
+class TestBulk(StorageTestBase):
+    def setUp(self):
+        super(TestBulk, self).setUp()
+        self.db.create_group(models.Group('admins'))
+        self.db.create_user(models.User("thomasem", "Thomas", "Maddox"))
+
+    def test_create_users_in_chunks(self):
+        users = [models.User("user{}".format(i), "F", "L", groups=['admins'])
+                 for i in range(impl.BULK_CHUNK_SIZE + 1)]
+
+        results, count = self._count_statements(self.db.create_users, users)
+
+        self.assertEqual([r.user_id for r in results],
+                         [u.user_id for u in users])
+        self.assertEqual(len(self.db.get_group('admins').users), len(users))
+        # Existence checks for two chunks of user ids and one of group ids,
+        # then two chunks of a users and an associations insert.
+        self.assertEqual(count, 7)
+
+    def test_create_users_reports_failures(self):
+        users = [
+            models.User("bc", "B", "C"),
+            models.User("thomasem", "T", "M"),
+            models.User("cb", "C", "B", groups=['wookiees']),
+        ]
+
+        results = self.db.create_users(users)
+
+        self.assertEqual(results[0].user_id, "bc")
+        self.assertIsInstance(results[1], exceptions.ResourceAlreadyExists)
+        self.assertIsInstance(results[2], exceptions.GroupNotFound)
+        self.assertEqual(self.db.get_user('thomasem').first_name, "Thomas")
+        self.assertIsNone(self.db.get_user('cb'))
+
+    def test_create_users_atomic(self):
+        users = [models.User("bc", "B", "C"), models.User("bc", "B", "C")]
+
+        results = self.db.create_users(users, atomic=True)
+
+        self.assertIsInstance(results[0], exceptions.BatchAborted)
+        self.assertIsInstance(results[1], exceptions.ResourceAlreadyExists)
+        self.assertIsNone(self.db.get_user('bc'))
+
+    def test_create_groups(self):
+        groups = [models.Group('users', users=['thomasem']),
+                  models.Group('admins'),
+                  models.Group('wookiees', users=['chewie'])]
+
+        results = self.db.create_groups(groups)
+
+        self.assertEqual(results[0].users, ['thomasem'])
+        self.assertIsInstance(results[1], exceptions.ResourceAlreadyExists)
+        self.assertIsInstance(results[2], exceptions.UserNotFound)
+        self.assertEqual(self.db.get_user('thomasem').groups, ['users'])
+
+    def test_bulk_results_carry_versions(self):
+        users = self.db.create_users([
+            models.User("bc", "B", "C", groups=['admins', 'admins'])])
+        groups = self.db.create_groups([
+            models.Group('users', users=['thomasem'])])
+
+        self.assertEqual(users[0].groups, ['admins'])
+        self.assertEqual(users[0].version, self.db.get_user_version('bc'))
+        self.assertEqual(groups[0].version,
+                         self.db.get_group_version('users'))
+
+
+class TestBulkRace(StorageTestBase):
+    """Bulk creates that fail after their up-front checks have passed."""
+
+    def setUp(self):
+        super(TestBulkRace, self).setUp()
+        self.db.create_group(models.Group('admins'))
+        self.db.create_user(models.User("thomasem", "Thomas", "Maddox"))
+
+    def _create_unchecked(self, create, entities):
+        with mock.patch.object(self.db, '_bulk_failures',
+                               return_value=[None] * len(entities)):
+            return create(entities)
+
+    def test_create_users_missing_group(self):
+        results = self._create_unchecked(self.db.create_users, [
+            models.User("bc", "B", "C"),
+            models.User("cb", "C", "B", groups=['wookiees']),
+            models.User("thomasem", "T", "M"),
+        ])
+
+        self.assertEqual(results[0].user_id, "bc")
+        self.assertIsInstance(results[1], exceptions.GroupNotFound)
+        self.assertIsInstance(results[2], exceptions.ResourceAlreadyExists)
+
+    def test_create_groups_missing_user(self):
+        results = self._create_unchecked(self.db.create_groups, [
+            models.Group('wookiees', users=['chewie']),
+            models.Group('admins'),
+        ])
+
+        self.assertIsInstance(results[0], exceptions.UserNotFound)
+        self.assertIsInstance(results[1], exceptions.ResourceAlreadyExists)
+
+
+class TestListing(StorageTestBase):
+    def setUp(self):
+        super(TestListing, self).setUp()
+        for group_id in ('users', 'admins', 'wookiees'):
+            self.db.create_group(models.Group(group_id))
+
+    def test_list_group_ids(self):
+        self.assertEqual(list(self.db.list_group_ids()),
+                         ['admins', 'users', 'wookiees'])
+
+    def test_list_group_ids_after(self):
+        self.assertEqual(list(self.db.list_group_ids('admins', 1)),
+                         ['users'])
+
+    def test_list_user_ids_empty(self):
+        self.assertEqual(list(self.db.list_user_ids()), [])
+
+
+class TestUpdate(StorageTestBase):
+    def setUp(self):
+        super(TestUpdate, self).setUp()
+        for group_id in ('users', 'admins', 'wookiees'):
+            self.db.create_group(models.Group(group_id))
+        self.db.create_user(models.User("bc", "Bumbleywump", "Cucumberpatch",
+                                        groups=['users', 'admins']))
+        self.db.create_user(models.User("thomasem", "Thomas", "Maddox",
+                                        groups=['admins']))
+
+    def _assoc_rowids(self):
+        return dict(((a.user_id, a.group_id), a.rowid) for a in
+                    self.db.conn.execute(
+                        'SELECT rowid, user_id, group_id FROM users_groups'))
+
+    def test_update_user_fields_keeps_memberships(self):
+        before = self._assoc_rowids()
+
+        result = self.db.update_user("bc", models.User(
+            "bc", "Bumble", "Patch", groups=['users', 'admins']))
+
+        self.assertEqual(result.first_name, "Bumble")
+        self.assertEqual(result.groups, ['users', 'admins'])
+        self.assertEqual(self._assoc_rowids(), before)
+
+    def test_update_user_applies_membership_diff(self):
+        before = self._assoc_rowids()
+
+        result = self.db.update_user("bc", models.User(
+            "bc", "Bumbleywump", "Cucumberpatch",
+            groups=['admins', 'wookiees']))
+
+        after = self._assoc_rowids()
+        self.assertEqual(result.groups, ['admins', 'wookiees'])
+        self.assertEqual(after[('bc', 'admins')], before[('bc', 'admins')])
+        self.assertNotIn(('bc', 'users'), after)
+        self.assertEqual(after[('thomasem', 'admins')],
+                         before[('thomasem', 'admins')])
+
+    def test_update_user_remove_all_groups(self):
+        result = self.db.update_user("bc", models.User(
+            "bc", "Bumbleywump", "Cucumberpatch"))
+
+        self.assertEqual(result.groups, [])
+        self.assertEqual(self.db.get_group('admins').users, ['thomasem'])
+
+    def test_update_user_rename(self):
+        result = self.db.update_user("bc", models.User(
+            "cb", "Bumbleywump", "Cucumberpatch", groups=['users']))
+
+        self.assertEqual(result.user_id, "cb")
+        self.assertEqual(result.groups, ['users'])
+        self.assertIsNone(self.db.get_user("bc"))
+        self.assertEqual(self.db.get_group('users').users, ['cb'])
+        self.assertEqual(self.db.get_group('admins').users, ['thomasem'])
+
+    def test_update_user_rename_conflict_is_atomic(self):
+        with self.assertRaises(sa_exc.IntegrityError):
+            self.db.update_user("bc", models.User(
+                "thomasem", "Bumbleywump", "Cucumberpatch"))
+
+        self.assertEqual(self.db.get_user("bc").groups, ['users', 'admins'])
+        self.assertEqual(self.db.get_user("thomasem").first_name, "Thomas")
+
+    def test_update_user_unknown_group_is_atomic(self):
+        with self.assertRaises(sa_exc.IntegrityError):
+            self.db.update_user("bc", models.User(
+                "bc", "Bumble", "Patch", groups=['nope']))
+
+        result = self.db.get_user("bc")
+        self.assertEqual(result.first_name, "Bumbleywump")
+        self.assertEqual(result.groups, ['users', 'admins'])
+
+    def test_update_user_records_former_groups(self):
+        former = ['stale']
+
+        self.db.update_user("bc", models.User(
+            "cb", "Bumbleywump", "Cucumberpatch", groups=['wookiees']),
+            former=former)
+
+        self.assertEqual(sorted(former), ['admins', 'users'])
+
+    def test_delete_group_records_former_users(self):
+        former = []
+
+        self.db.delete_group("admins", former=former)
+
+        self.assertEqual(sorted(former), ['bc', 'thomasem'])
+
+    def test_update_group_applies_membership_diff(self):
+        before = self._assoc_rowids()
+
+        result = self.db.update_group("admins", models.Group(
+            "admins", users=['thomasem']))
+
+        self.assertEqual(result.users, ['thomasem'])
+        self.assertEqual(self._assoc_rowids()[('thomasem', 'admins')],
+                         before[('thomasem', 'admins')])
+        self.assertEqual(self.db.get_user("bc").groups, ['users'])
+
+
+class TestMembers(StorageTestBase):
+    def setUp(self):
+        super(TestMembers, self).setUp()
+        self.db.create_group(models.Group('admins'))
+        for user_id in ('bc', 'thomasem'):
+            self.db.create_user(models.User(user_id, "F", "L"))
+
+    def test_group_exists(self):
+        self.assertTrue(self.db.group_exists('admins'))
+        self.assertFalse(self.db.group_exists('users'))
+
+    def test_update_members(self):
+        self.db.update_members('admins', add=['bc', 'thomasem'])
+        self.db.update_members('admins', add=['bc'], remove=['thomasem'])
+
+        self.assertEqual(self.db.get_group('admins').users, ['bc'])
+        self.assertEqual(self.db.get_user('thomasem').groups, [])
+
+    def test_update_members_unknown_user(self):
+        with self.assertRaises(exceptions.UserNotFound):
+            self.db.update_members('admins', add=['bc', 'nobody'])
+
+        self.assertEqual(self.db.get_group('admins').users, [])
+
+    def test_update_members_unknown_group(self):
+        with self.assertRaises(exceptions.GroupNotFound):
+            self.db.update_members('nope', add=['bc'])
+        with self.assertRaises(exceptions.GroupNotFound):
+            self.db.update_members('nope', remove=['bc'])
+
+        self.assertEqual(self.db.get_user('bc').groups, [])
+
+    def test_update_members_statements_independent_of_size(self):
+        self.db.update_members('admins', add=['thomasem'])
+
+        _, count = self._count_statements(
+            self.db.update_members, 'admins', ['bc'], ['thomasem'])
+
+        # One delete and one insert; nothing is read first, only the added
+        # users' group counts after.
+        self.assertEqual(count, 3)
+
+    def test_update_members_limits_groups_per_user(self):
+        for i in range(models.MAX_USER_GROUPS - 1):
+            self.db.create_group(models.Group('g{}'.format(i)))
+            self.db.update_members('g{}'.format(i), add=['bc'])
+        self.db.update_members('admins', add=['bc'])
+        self.db.create_group(models.Group('extra'))
+
+        with self.assertRaises(exceptions.ValidationError):
+            self.db.update_members('extra', add=['thomasem', 'bc'])
+        with self.assertRaises(exceptions.ValidationError):
+            self.db.update_group('extra', models.Group('extra', ['bc']))
+        self.db.update_members('admins', add=['bc'], remove=['bc'])
+
+        self.assertEqual(self.db.get_group('extra').users, [])
+        self.assertEqual(len(self.db.get_user('bc').groups),
+                         models.MAX_USER_GROUPS)
+
+    def test_remove_member(self):
+        self.db.update_members('admins', add=['bc'])
+
+        self.assertTrue(self.db.remove_member('admins', 'bc'))
+        self.assertFalse(self.db.remove_member('admins', 'bc'))
+
+    def test_list_member_ids(self):
+        self.db.update_members('admins', add=['thomasem', 'bc'])
+
+        self.assertEqual(list(self.db.list_member_ids('admins')),
+                         ['bc', 'thomasem'])
+        self.assertEqual(list(self.db.list_member_ids('admins', 'bc', 5)),
+                         ['thomasem'])
+
+    def test_members_keep_order_through_removes_and_renames(self):
+        user_ids = ['u{}'.format(i) for i in range(9, -1, -1)]
+        for user_id in user_ids:
+            self.db.create_user(models.User(user_id, "F", "L"))
+        self.db.update_members('admins', add=user_ids)
+
+        self.db.update_members('admins', remove=user_ids[1:7])
+        self.db.update_user('u0', models.User('a0', "F", "L", ['admins']))
+        self.db.update_members('admins', add=['u5'])
+
+        self.assertEqual(self.db.get_group('admins').users,
+                         ['u9', 'u2', 'u1', 'a0', 'u5'])
+        self.assertEqual(list(self.db.list_member_ids('admins', 'u1')),
+                         ['u2', 'u5', 'u9'])
+
+
+class TestVersions(StorageTestBase):
+    def setUp(self):
+        super(TestVersions, self).setUp()
+        for group_id in ('admins', 'users', 'staff'):
+            self.db.create_group(models.Group(group_id))
+        self.db.create_user(models.User('bc', "F", "L", groups=['admins']))
+        self.db.create_user(models.User('thomasem', "F", "L"))
+
+    def _versions(self):
+        return dict(
+            [(u, self.db.get_user_version(u)) for u in ('bc', 'thomasem')] +
+            [(g, self.db.get_group_version(g))
+             for g in ('admins', 'users', 'staff')])
+
+    def _changed(self, func, *args, **kwargs):
+        before = self._versions()
+        func(*args, **kwargs)
+        after = self._versions()
+        return sorted(k for k in before if before[k] != after[k])
+
+    def test_models_carry_version(self):
+        self.assertEqual(self.db.get_user('bc').version,
+                         self.db.get_user_version('bc'))
+        self.assertEqual(self.db.get_group('admins').version,
+                         self.db.get_group_version('admins'))
+        self.assertIsNone(self.db.get_user_version('nobody'))
+        self.assertIsNone(self.db.get_group_version('nobody'))
+
+    def test_create_user_bumps_groups(self):
+        self.assertEqual(
+            self._changed(self.db.create_user,
+                          models.User('new', "F", "L", groups=['users'])),
+            ['users'])
+
+    def test_create_users_bumps_groups(self):
+        self.assertEqual(
+            self._changed(self.db.create_users,
+                          [models.User('new', "F", "L", groups=['staff'])]),
+            ['staff'])
+
+    def test_update_user_bumps_changed_groups_only(self):
+        self.assertEqual(
+            self._changed(self.db.update_user, 'bc',
+                          models.User('bc', "F", "L",
+                                      groups=['admins', 'users'])),
+            ['bc', 'users'])
+
+    def test_rename_user_bumps_groups(self):
+        self.assertIn('admins', self._changed(
+            self.db.update_user, 'bc',
+            models.User('cb', "F", "L", groups=['admins'])))
+
+    def test_delete_user_bumps_groups(self):
+        self.assertIn('admins', self._changed(self.db.delete_user, 'bc'))
+
+    def test_update_group_bumps_members(self):
+        self.assertEqual(
+            self._changed(self.db.update_group, 'admins',
+                          models.Group('admins', users=['thomasem'])),
+            ['admins', 'bc', 'thomasem'])
+
+    def test_delete_group_bumps_members(self):
+        self.assertIn('bc', self._changed(self.db.delete_group, 'admins'))
+
+    def test_update_members_bumps_both_sides(self):
+        self.assertEqual(
+            self._changed(self.db.update_members, 'staff',
+                          add=['thomasem']),
+            ['staff', 'thomasem'])
+
+    def test_remove_member_bumps_both_sides(self):
+        self.assertEqual(
+            self._changed(self.db.remove_member, 'admins', 'bc'),
+            ['admins', 'bc'])
+
+    def test_written_models_carry_version(self):
+        created = self.db.create_user(
+            models.User('new', "F", "L", groups=['users', 'staff']))
+        self.assertEqual(created.version, self.db.get_user_version('new'))
+
+        for groups in (['staff'], ['admins', 'users'], []):
+            updated = self.db.update_user(
+                'new', models.User('new', "G", "L", groups=groups))
+            stored = self.db.get_user('new')
+            self.assertEqual(updated.groups, stored.groups)
+            self.assertEqual(updated.version, stored.version)
+
+        group = self.db.update_group(
+            'staff', models.Group('staff', users=['thomasem', 'bc']))
+        self.assertEqual(group.users, ['thomasem', 'bc'])
+        self.assertEqual(group.version, self.db.get_group_version('staff'))
+
+    def test_write_missing_entity(self):
+        with self.assertRaises(exceptions.UserNotFound):
+            self.db.update_user('nobody', models.User('nobody', "F", "L"))
+        with self.assertRaises(exceptions.UserNotFound):
+            self.db.delete_user('nobody', if_match=[1])
+        with self.assertRaises(exceptions.GroupNotFound):
+            self.db.update_group('nobody', models.Group('nobody'),
+                                 if_match=[1])
+        with self.assertRaises(exceptions.GroupNotFound):
+            self.db.delete_group('nobody')
+
+        self.assertEqual(list(self.db.list_user_ids()), ['bc', 'thomasem'])
+
+    def test_recreated_user_gets_new_version(self):
+        version = self.db.get_user_version('thomasem')
+        self.db.delete_user('thomasem')
+        self.db.create_user(models.User('thomasem', "F", "L"))
+
+        self.assertNotEqual(self.db.get_user_version('thomasem'), version)
+
+    def test_update_if_match(self):
+        version = self.db.get_user_version('bc')
+
+        user = self.db.update_user('bc', models.User('bc', "G", "L"),
+                                   if_match=[version])
+
+        self.assertEqual(user.first_name, "G")
+
+    def test_update_if_match_stale(self):
+        version = self.db.get_user_version('bc')
+        self.db.remove_member('admins', 'bc')
+
+        with self.assertRaises(exceptions.PreconditionFailed):
+            self.db.update_user('bc', models.User('bc', "G", "L"),
+                                if_match=[version])
+        self.assertEqual(self.db.get_user('bc').first_name, "F")
+
+    def test_delete_if_match_stale(self):
+        version = self.db.get_group_version('admins')
+        self.db.update_members('admins', add=['thomasem'])
+
+        with self.assertRaises(exceptions.PreconditionFailed):
+            self.db.delete_group('admins', if_match=[version])
+        self.assertTrue(self.db.group_exists('admins'))
+
+        self.db.delete_group('admins',
+                             if_match=[self.db.get_group_version('admins')])
+        self.assertFalse(self.db.group_exists('admins'))
+
+
+class TestConcurrency(unittest.TestCase):
+    THREADS = 8
+    USERS_PER_THREAD = 25
+    GROUPS = ['group{}'.format(g) for g in range(5)]
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.errors = []
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def _writer(self, db, thread):
+        rand = random.Random(thread)
+        for i in range(self.USERS_PER_THREAD):
+            user_id = 'user{}-{}'.format(thread, i)
+            db.create_user(models.User(
+                user_id, "F", "L", groups=rand.sample(self.GROUPS, 2)))
+            db.update_user(user_id, models.User(
+                user_id, "F", "L", groups=rand.sample(self.GROUPS, 3)))
+            db.update_members(rand.choice(self.GROUPS), add=[user_id],
+                              remove=['user{}-{}'.format(thread, i - 1)])
+            if i % 5 == 0:
+                db.delete_user(user_id)
+
+    def _reader(self, db, thread):
+        for _ in range(self.USERS_PER_THREAD):
+            for group_id in self.GROUPS:
+                db.get_group(group_id)
+            db.get_user('user{}-0'.format(thread))
+
+    def _run(self, target, db, thread):
+        try:
+            target(db, thread)
+        except Exception as e:
+            self.errors.append(e)
+
+    def _stress(self, db):
+        [db.create_group(models.Group(g)) for g in self.GROUPS]
+        threads = [
+            threading.Thread(target=self._run, args=(target, db, t))
+            for t in range(self.THREADS)
+            for target in (self._writer, self._reader)
+        ]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+
+        self.assertEqual(self.errors, [])
+        by_user = set((u, g) for u in db.list_user_ids()
+                      for g in db.get_user(u).groups)
+        by_group = set((u, g) for g in self.GROUPS
+                       for u in db.get_group(g).users)
+        self.assertEqual(by_user, by_group)
+        self.assertEqual(
+            len(list(db.list_user_ids())),
+            self.THREADS * (self.USERS_PER_THREAD -
+                            self.USERS_PER_THREAD // 5))
+
+    def test_file_database(self):
+        self._stress(storage.Storage('sqlite:///{}'.format(self.path)))
+
+    def test_memory_database(self):
+        self._stress(storage.Storage())
+
+    def test_group_commit(self):
+        db = storage.Storage('sqlite:///{}'.format(self.path),
+                             commit_batch=16, commit_window=0.002)
+        self.addCleanup(db.close)
+        self._stress(db)
+
+    def test_memory_engine(self):
+        self._stress(storage.MemoryStorage())
+
+
+class GroupCommitMixin(object):
+    def _make_storage(self):
+        db = storage.Storage(commit_batch=8)
+        self.addCleanup(db.close)
+        return db
+
+
+class TestGroupCommitUser(GroupCommitMixin, TestUser):
+    pass
+
+
+class TestGroupCommitGroup(GroupCommitMixin, TestGroup):
+    pass
+
+
+class TestGroupCommitBulk(GroupCommitMixin, TestBulk):
+    pass
+
+
+class TestGroupCommitUpdate(GroupCommitMixin, TestUpdate):
+    pass
+
+
+class TestGroupCommitVersions(GroupCommitMixin, TestVersions):
+    pass
+
+
+class TestGroupCommitMembers(GroupCommitMixin, TestMembers):
+    pass
+
+
+class TestGroupCommit(unittest.TestCase):
+    def setUp(self):
+        self.db = storage.Storage(commit_batch=10)
+        self.addCleanup(self.db.close)
+        self.db.create_group(models.Group('admins'))
+        self.commits = []
+        sa.event.listen(self.db.conn, 'commit',
+                        lambda conn: self.commits.append(1))
+
+    def _concurrently(self, *calls):
+        """Run the calls on threads whose writes all land in one batch."""
+        results = [None] * len(calls)
+
+        def run(i, func, args):
+            try:
+                results[i] = func(*args)
+            except Exception as e:
+                results[i] = e
+
+        # A write blocking the committer lets the others queue up behind it.
+        # Its own commit is counted with theirs.
+        started = threading.Event()
+        gate = threading.Event()
+        blocker = threading.Thread(target=self.db._write, args=(
+            lambda conn: started.set() or gate.wait(5),))
+        blocker.start()
+        started.wait(5)
+        threads = [threading.Thread(target=run, args=(i, call[0], call[1:]))
+                   for i, call in enumerate(calls)]
+        [t.start() for t in threads]
+        while self.db._committer._writes.qsize() < len(calls):
+            threading.Event().wait(0.001)
+        del self.commits[:]
+        gate.set()
+        [t.join() for t in [blocker] + threads]
+        return results
+
+    def test_writes_share_a_commit(self):
+        results = self._concurrently(*[
+            (self.db.create_user,
+             models.User('user{}'.format(i), "F", "L", groups=['admins']))
+            for i in range(5)])
+
+        self.assertEqual([r.user_id for r in results],
+                         ['user{}'.format(i) for i in range(5)])
+        self.assertEqual(len(self.commits), 2)
+        self.assertEqual(len(self.db.get_group('admins').users), 5)
+
+    def test_failed_write_fails_alone(self):
+        results = self._concurrently(
+            (self.db.create_user, models.User('a', "F", "L")),
+            (self.db.create_user, models.User('a', "G", "M")),
+            (self.db.create_user, models.User('b', "F", "L", groups=['no'])),
+            (self.db.create_user, models.User('c', "F", "L")),
+        )
+
+        failed = [isinstance(r, sa_exc.IntegrityError) for r in results]
+        self.assertEqual(sorted(failed[:2]), [False, True])
+        self.assertEqual(failed[2:], [True, False])
+        self.assertEqual(list(self.db.list_user_ids()), ['a', 'c'])
+        self.assertIsNone(self.db.get_user('b'))
+
+    def test_failed_check_skips_write(self):
+        self.db.create_user(models.User('a', "F", "L"))
+        version = self.db.get_user_version('a')
+
+        results = self._concurrently(
+            (self.db.delete_user, 'a', [version + 1]),
+            (self.db.update_user, 'a', models.User('a', "G", "L"),
+             [version]),
+        )
+
+        self.assertIsInstance(results[0], exceptions.PreconditionFailed)
+        self.assertEqual(self.db.get_user('a').first_name, "G")
+        self.assertEqual(len(self.commits), 2)
+
+    def test_failed_begin_fails_batch_and_carries_on(self):
+        begin = self.db.conn.begin
+        error = sa_exc.OperationalError(None, None, Exception("disk I/O"))
+        calls = []
+
+        def failing_begin():
+            calls.append(1)
+            if len(calls) == 1:
+                raise error
+            return begin()
+
+        self.db._committer.conn = mock.Mock(wraps=self.db.conn,
+                                            begin=failing_begin)
+
+        with self.assertRaises(sa_exc.OperationalError):
+            self.db.create_user(models.User('a', "F", "L"))
+        self.db.create_user(models.User('b', "F", "L"))
+
+        self.assertEqual(list(self.db.list_user_ids()), ['b'])
+
+    def test_failed_rollback_fails_batch_and_carries_on(self):
+        self.db.create_user(models.User('a', "F", "L"))
+        begin = self.db.conn.begin
+        rollbacks = []
+
+        def failing_rollback(trans):
+            rollbacks.append(1)
+            if len(rollbacks) == 1:
+                raise RuntimeError("rollback failed")
+            trans.rollback()
+
+        def wrapped_begin():
+            trans = begin()
+            return mock.Mock(wraps=trans,
+                             rollback=lambda: failing_rollback(trans))
+
+        self.db._committer.conn = mock.Mock(wraps=self.db.conn,
+                                            begin=wrapped_begin)
+
+        with self.assertRaises(RuntimeError):
+            self.db.create_user(models.User('a', "G", "L"))
+        self.db._committer.conn = self.db.conn
+        self.db.create_user(models.User('b', "F", "L"))
+
+        self.assertEqual(len(rollbacks), 2)
+        self.assertEqual(list(self.db.list_user_ids()), ['a', 'b'])
+        self.assertEqual(self.db.get_user('a').first_name, "F")
+
+    def test_writes_after_close(self):
+        self.db.close()
+
+        self.db.create_user(models.User('a', "F", "L"))
+
+        self.assertIsNotNone(self.db.get_user('a'))
+
+
+class MemoryStorageMixin(object):
+    def _make_storage(self):
+        return storage.MemoryStorage()
+
+    def _get_assocs(self):
+        return self._assoc_rowids().keys()
+
+    def _assoc_rowids(self):
+        # Membership sequence numbers play the part of the association rowids.
+        return dict(((u, g), seq) for u, groups in
+                    self.db._user_groups.items()
+                    for g, seq in groups.items())
+
+
+class TestMemoryUser(MemoryStorageMixin, TestUser):
+    pass
+
+
+class TestMemoryGroup(MemoryStorageMixin, TestGroup):
+    pass
+
+
+class TestMemoryBulk(MemoryStorageMixin, TestBulk):
+    @unittest.skip("counts SQL statements")
+    def test_create_users_in_chunks(self):
+        pass
+
+
+class TestMemoryListing(MemoryStorageMixin, TestListing):
+    pass
+
+
+class TestMemoryUpdate(MemoryStorageMixin, TestUpdate):
+    pass
+
+
+class TestMemoryVersions(MemoryStorageMixin, TestVersions):
+    pass
+
+
+class TestMemoryMembers(MemoryStorageMixin, TestMembers):
+    @unittest.skip("counts SQL statements")
+    def test_update_members_statements_independent_of_size(self):
+        pass
+
+    def test_members_sorted_once_for_every_page(self):
+        user_ids = ['u{:02}'.format(i) for i in range(20)]
+        for user_id in user_ids:
+            self.db.create_user(models.User(user_id, "F", "L"))
+        self.db.update_members('admins', add=user_ids)
+
+        with mock.patch('restytest.storage.memory.sorted', create=True,
+                        side_effect=sorted) as sorts:
+            self.db.get_group('admins')
+            self.assertEqual(sorts.call_count, 0)
+            pages, after = [], None
+            while True:
+                page = list(self.db.list_member_ids('admins', after, 5))
+                if not page:
+                    break
+                pages.extend(page)
+                after = page[-1]
+
+        self.assertEqual(pages, user_ids)
+        self.assertEqual(sorts.call_count, 1)
@@ -0,0 +1,132 @@
+""" Timing span and profiling tests """
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+
+import webtest
+
+from restytest.api import app
+from restytest.api import tracing
+
+
+USER = {
+    "userid": "bc",
+    "first_name": "Bumbleywump",
+    "last_name": "Cucumberpatch",
+    "groups": []
+}
+
+
+class TestTrace(unittest.TestCase):
+    def test_header(self):
+        trace = tracing.Trace()
+        trace.add('controller', 0.002, 'get_user')
+        trace.add('db', 0.001)
+        trace.add('db', 0.0005)
+
+        header = trace.header()
+
+        self.assertTrue(header.startswith(
+            'controller;dur=2.000;desc="get_user", '
+            'db;dur=1.500;desc="2 calls", total;dur='))
+
+    def test_traced_without_trace(self):
+        calls = []
+        func = tracing.traced('span')(lambda: calls.append(1))
+
+        func()
+
+        self.assertEqual(calls, [1])
+        self.assertIsNone(tracing.current())
+
+    def test_unknown_timing_mode(self):
+        self.assertRaises(ValueError, tracing.Middleware, app.app, 'sometimes')
+
+
+class TracingTestBase(unittest.TestCase):
+    def _app(self, **kwargs):
+        return webtest.TestApp(tracing.Middleware(app.app, **kwargs))
+
+    def tearDown(self):
+        reload(app)
+
+
+class TestServerTiming(TracingTestBase):
+    def test_off_by_default(self):
+        resp = self._app().post_json('/users', USER)
+
+        self.assertNotIn('Server-Timing', resp.headers)
+
+    def test_always(self):
+        resp = self._app(timing='always').post_json('/users', USER)
+
+        spans = [entry.split(';')[0] for entry in
+                 resp.headers['Server-Timing'].split(', ')]
+        self.assertEqual(sorted(spans),
+                         ['controller', 'db', 'total', 'validate', 'view'])
+        self.assertIn('desc="create_user"', resp.headers['Server-Timing'])
+        self.assertIsNone(tracing.current())
+
+    def test_requested(self):
+        test_app = self._app(timing='requested')
+
+        resp = test_app.post_json('/users', USER)
+        self.assertNotIn('Server-Timing', resp.headers)
+
+        resp = test_app.get('/users/bc', headers={'X-Restytest-Timing': '1'})
+        self.assertIn('Server-Timing', resp.headers)
+
+    def test_error_response(self):
+        resp = self._app(timing='always').get('/users/nope', status=404)
+
+        self.assertIn('controller', resp.headers['Server-Timing'])
+
+
+class TestProfiling(TracingTestBase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def test_requested(self):
+        test_app = self._app(profile_dir=self.dir, profile_secret='s3cret')
+        test_app.post_json('/users', USER)
+        self.assertEqual(os.listdir(self.dir), [])
+
+        resp = test_app.get('/users/bc',
+                            headers={'X-Restytest-Profile': 's3cret'})
+
+        name = resp.headers[tracing.PROFILE_RESPONSE_HEADER]
+        self.assertEqual(os.listdir(self.dir), [name])
+        self.assertIn('GET-users-bc', name)
+        stats = pstats.Stats(os.path.join(self.dir, name))
+        self.assertTrue(any(func[2] == 'get_user' for func in stats.stats))
+
+    def test_header_ignored_without_secret(self):
+        resp = self._app(profile_dir=self.dir).get(
+            '/users', headers={'X-Restytest-Profile': '1'})
+
+        self.assertNotIn(tracing.PROFILE_RESPONSE_HEADER, resp.headers)
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_header_ignored_with_wrong_secret(self):
+        resp = self._app(profile_dir=self.dir, profile_secret='s3cret').get(
+            '/users', headers={'X-Restytest-Profile': 'guess'})
+
+        self.assertNotIn(tracing.PROFILE_RESPONSE_HEADER, resp.headers)
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_sampled(self):
+        test_app = self._app(profile_dir=self.dir, profile_sample=1.0)
+
+        resp = test_app.post_json('/users', USER)
+
+        self.assertEqual(len(os.listdir(self.dir)), 1)
+        self.assertNotIn(tracing.PROFILE_RESPONSE_HEADER, resp.headers)
+
+    def test_header_ignored_without_directory(self):
+        resp = self._app(profile_secret='s3cret').get(
+            '/users', headers={'X-Restytest-Profile': 's3cret'})
+
+        self.assertNotIn(tracing.PROFILE_RESPONSE_HEADER, resp.headers)
@@ -0,0 +1,66 @@
+""" Request body validation tests """
+import unittest
+
+import jsonschema
+
+from restytest import exceptions
+from restytest.api import validations
+
+
+LONG = "a" * (validations.NAME_LENGTH + 1)
+
+
+class TestValidations(unittest.TestCase):
+    CASES = [
+        (validations.validate_user, validations.user, [
+            {"userid": "bc", "first_name": "B", "last_name": "C",
+             "groups": ["admins"]},
+            {"userid": "bc"},
+            {},
+            {"userid": LONG},
+            {"userid": "bc", "groups": ["g"] * 51},
+            {"userid": "bc", "groups": [1]},
+            {"userid": "bc", "first_eman": "B"},
+            [],
+            None,
+            "bc",
+        ]),
+        (validations.validate_group_post, validations.group_post, [
+            {"name": "admins"},
+            {"name": LONG},
+            {"name": 1},
+            {"foo": "bar"},
+            [],
+        ]),
+        (validations.validate_group_put, validations.group_put, [
+            {"userids": ["bc"]},
+            {"userids": []},
+            {"userids": [LONG]},
+            {"userids": ["bc"] * 51},
+            {"foo": "bar"},
+            "userids",
+        ]),
+    ]
+
+    def _reference_is_valid(self, data, schema):
+        try:
+            jsonschema.validate(data, schema)
+        except jsonschema.ValidationError:
+            return False
+        return True
+
+    def _is_valid(self, validate, data):
+        try:
+            validate(data)
+        except exceptions.ValidationError:
+            return False
+        return True
+
+    def test_matches_jsonschema_validate(self):
+        for validate, schema, payloads in self.CASES:
+            for data in payloads:
+                self.assertEqual(
+                    self._is_valid(validate, data),
+                    self._reference_is_valid(data, schema),
+                    "{} disagrees on {!r}".format(validate.__name__, data)
+                )